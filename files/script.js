@@ -15,7 +15,8 @@ document.addEventListener("DOMContentLoaded", () => {
      */
     state: {
       receptora: { file: null },
-      doadora: { file: null }
+      doadora: { file: null },
+      job: { id: null, events: null, startTime: null }
     },
 
     /**
@@ -57,6 +58,7 @@ document.addEventListener("DOMContentLoaded", () => {
         // Parâmetros
         tamanhoInput: document.getElementById("tamanho"),
         yuvCheckbox: document.getElementById("yuv"),
+        metricaSelect: document.getElementById("metrica"),
         pesoDifImagensSlider: document.getElementById("peso_dif_imagens"), // Renomeado
         pesoVggSlider: document.getElementById("peso_vgg"),
         pesoSobelSlider: document.getElementById("peso_sobel"),
@@ -82,6 +84,13 @@ document.addEventListener("DOMContentLoaded", () => {
       // Sliders de parâmetros
       this.setupWeightSliders();
 
+      // Mudar qualquer parâmetro cancela a tarefa em andamento, que já não corresponde à tela
+      [
+        this.elements.tamanhoInput, this.elements.yuvCheckbox, this.elements.metricaSelect,
+        this.elements.pesoDifImagensSlider, this.elements.pesoVggSlider,
+        this.elements.pesoSobelSlider, this.elements.pesoMediaCorSlider
+      ].forEach(el => el.addEventListener("change", () => this.cancelJob()));
+
       // Botões de ferramentas
       this.elements.btnResizeReceptora.addEventListener('click', () => this.tools.resize('receptora', 'doadora'));
       this.elements.btnResizeDoadora.addEventListener('click', () => this.tools.resize('doadora', 'receptora'));
@@ -153,6 +162,7 @@ document.addEventListener("DOMContentLoaded", () => {
      * @param {File} file - O arquivo de imagem.
      */
     async updateImageState(slot, file) {
+        this.cancelJob();
         this.state[slot].file = file;
         const previewEl = this.elements[`${slot}Preview`];
         previewEl.style.backgroundImage = `url(${URL.createObjectURL(file)})`;
@@ -309,33 +319,81 @@ document.addEventListener("DOMContentLoaded", () => {
     },
 
     // --- Ações Principais ---
-    handleUpdate() {
+    async handleUpdate() {
         if (!this._validateUpdate()) return;
+        this.cancelJob();
         const formData = this._buildFormData();
-        const startTime = Date.now();
-        this.elements.updateBtn.disabled = true;
-        this.elements.updateBtn.textContent = "Processando...";
+        this._setStatus("Enviando...");
 
-        fetch("/update", { method: "POST", body: formData })
-        .then(response => {
+        try {
+            const response = await fetch("/update", { method: "POST", body: formData });
+            if (response.status === 429 || response.status === 503) {
+                throw new Error("Servidor ocupado, tente novamente em instantes");
+            }
             if (!response.ok) throw new Error(`Erro na rede: ${response.statusText}`);
-            return response.json();
-        })
-        .then(data => {
+            const data = await response.json();
             console.log("Resposta do backend:", data);
-            const elapsedTime = ((Date.now() - startTime) / 1000).toFixed(2);
-            this.elements.previewImg.src = `preview.png?t=${new Date().getTime()}`;
-            new Audio("/notification.mp3").play();
-            alert(`Atualização concluída! Tempo: ${Math.floor(elapsedTime / 60)}m ${Math.round(elapsedTime % 60)}s.`);
-        })
-        .catch(error => {
+            if (data.status !== "ok") throw new Error(data.msg);
+            this.followJob(data.id);
+        } catch (error) {
             console.error("Erro ao enviar dados:", error);
             alert(`Ocorreu um erro: ${error.message}.`);
-        })
-        .finally(() => {
-            this.elements.updateBtn.disabled = false;
-            this.elements.updateBtn.textContent = "Update";
-        });
+            this._setStatus(null);
+        }
+    },
+
+    /**
+     * Acompanha o progresso de uma tarefa pelo fluxo de eventos (SSE) do servidor.
+     * @param {string} id - O id devolvido por /update.
+     */
+    followJob(id) {
+        const events = new EventSource(`/jobs/${id}/eventos`);
+        this.state.job = { id, events, startTime: Date.now() };
+
+        events.onmessage = (message) => {
+            const job = JSON.parse(message.data);
+            if (job.estado === "na_fila" || job.estado === "executando") {
+                this._setStatus(`${job.etapa} (${Math.round(100 * job.fracao)}%)`);
+                return;
+            }
+            const elapsedTime = ((Date.now() - this.state.job.startTime) / 1000).toFixed(2);
+            this._finishJob();
+            if (job.estado === "concluida") {
+                this.elements.previewImg.src = `/jobs/${id}/result`;
+                new Audio("/notification.mp3").play();
+                alert(`Atualização concluída! Tempo: ${Math.floor(elapsedTime / 60)}m ${Math.round(elapsedTime % 60)}s.`);
+            } else if (job.estado === "erro") {
+                alert(`Ocorreu um erro: ${job.erro}.`);
+            }
+        };
+        events.onerror = () => {
+            // O servidor fecha o fluxo depois do estado final; só é erro se a tarefa ainda estava ativa
+            if (this.state.job.id === id) {
+                console.error("Conexão de progresso perdida para a tarefa", id);
+                this._finishJob();
+            }
+        };
+    },
+
+    /**
+     * Cancela a tarefa em andamento, se houver. O servidor a interrompe na próxima etapa.
+     */
+    cancelJob() {
+        const { id } = this.state.job;
+        if (!id) return;
+        this._finishJob();
+        fetch(`/jobs/${id}/cancelar`, { method: "POST" })
+            .catch(error => console.error("Erro ao cancelar tarefa:", error));
+    },
+
+    _finishJob() {
+        if (this.state.job.events) this.state.job.events.close();
+        this.state.job = { id: null, events: null, startTime: null };
+        this._setStatus(null);
+    },
+
+    _setStatus(text) {
+        this.elements.updateBtn.textContent = text ? `Processando: ${text}` : "Update";
     },
 
     _validateUpdate() {
@@ -352,6 +410,7 @@ document.addEventListener("DOMContentLoaded", () => {
       formData.append("doadora", this.state.doadora.file);
       formData.append("tamanho", this.elements.tamanhoInput.value);
       formData.append("yuv", this.elements.yuvCheckbox.checked);
+      formData.append("metrica", this.elements.metricaSelect.value);
       formData.append("peso_dif_imagens", this.elements.pesoDifImagensSlider.value); // Renomeado
       formData.append("peso_vgg", this.elements.pesoVggSlider.value);
       formData.append("peso_sobel", this.elements.pesoSobelSlider.value);
@@ -0,0 +1,295 @@
+import numpy as np
+import lap
+from numba import njit, prange
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import maximum_bipartite_matching
+from scipy.spatial import cKDTree
+
+from src.Fragmentos import contar_fragmentos
+
+
+def descritores_compactos(fragmentos: np.ndarray, celulas: int = 2) -> np.ndarray:
+    """
+    Resume cada fragmento em um descritor curto: a média de cor de cada célula de uma grade
+    celulas×celulas sobre o fragmento. Cada célula é reduzida direto sobre a entrada, sem copiar
+    os pixels.
+    :param fragmentos: Fragmentos achatados com forma (n, fh, fw, 3), ou um grid (h, w, fh, fw, 3).
+    :param celulas: Número de células por lado da grade.
+    :return: Array (n, celulas * celulas * 3) float32.
+    """
+    n = contar_fragmentos(fragmentos)
+    fh, fw, c = fragmentos.shape[-3:]
+    celulas = max(1, min(celulas, fh, fw))
+    ch, cw = fh // celulas, fw // celulas
+
+    descritores = np.empty((n, celulas, celulas, c), dtype=np.float32)
+    for y in range(celulas):
+        for x in range(celulas):
+            celula = fragmentos[..., y * ch:(y + 1) * ch, x * cw:(x + 1) * cw, :]
+            descritores[:, y, x] = celula.mean(axis=(-3, -2), dtype=np.float32).reshape((n, c))
+    return descritores.reshape((n, -1))
+
+
+def candidatos_knn(descritores1: np.ndarray, descritores2: np.ndarray, k: int) -> np.ndarray:
+    """
+    Encontra, para cada fragmento do conjunto 1, os k fragmentos mais próximos do conjunto 2
+    usando uma KD-tree sobre os descritores.
+    :param descritores1: Descritores (n, d) dos fragmentos alvo.
+    :param descritores2: Descritores (m, d) dos fragmentos doadores.
+    :param k: Número de candidatos por fragmento alvo.
+    :return: Array (n, k) com os índices dos candidatos.
+    """
+    k = min(k, descritores2.shape[0])
+    _, indices = cKDTree(descritores2).query(descritores1, k=k, workers=-1)
+    return indices.reshape((descritores1.shape[0], k))
+
+
+def _emparelhamento_maximo(linhas: np.ndarray, colunas: np.ndarray, n: int) -> np.ndarray:
+    """Retorna, para cada linha, a coluna de um emparelhamento máximo do grafo (-1 se sem par)."""
+    grafo = csr_matrix((np.ones(linhas.shape[0], dtype=np.int8), (linhas, colunas)), shape=(n, n))
+    return maximum_bipartite_matching(grafo, perm_type='column')
+
+
+def completar_emparelhamento(
+        linhas: np.ndarray,
+        colunas: np.ndarray,
+        descritores1: np.ndarray,
+        descritores2: np.ndarray,
+        k: int,
+        max_rodadas: int = 4
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Verifica se o grafo esparso de candidatos admite um emparelhamento perfeito. Caso não admita,
+    liga as linhas sem par aos k doadores livres mais próximos (segundo os descritores) e repete.
+    Se ainda restarem linhas sem par após `max_rodadas`, elas são ligadas uma a uma às colunas
+    livres, garantindo que a atribuição esparsa tenha solução.
+    :param linhas: Índices de linha das arestas.
+    :param colunas: Índices de coluna das arestas.
+    :param descritores1: Descritores (n, d) dos fragmentos alvo.
+    :param descritores2: Descritores (n, d) dos fragmentos doadores.
+    :param k: Número de doadores livres ligados a cada linha sem par por rodada.
+    :param max_rodadas: Número máximo de rodadas de busca por vizinhos livres.
+    :return: Tupla (linhas_extra, colunas_extra), vazia quando o grafo já admite emparelhamento perfeito.
+    """
+    n = descritores1.shape[0]
+    linhas_extra = [np.empty(0, dtype=np.int64)]
+    colunas_extra = [np.empty(0, dtype=np.int64)]
+
+    for rodada in range(max_rodadas + 1):
+        par = _emparelhamento_maximo(
+            np.concatenate([linhas, *linhas_extra]), np.concatenate([colunas, *colunas_extra]), n
+        )
+        linhas_livres = np.flatnonzero(par < 0)
+        if linhas_livres.size == 0:
+            break
+
+        colunas_usadas = np.zeros(n, dtype=bool)
+        colunas_usadas[par[par >= 0]] = True
+        colunas_livres = np.flatnonzero(~colunas_usadas)
+
+        if rodada == max_rodadas:
+            # Último recurso: pareia diretamente as linhas e colunas que sobraram
+            linhas_extra.append(linhas_livres)
+            colunas_extra.append(colunas_livres)
+            break
+
+        vizinhos = candidatos_knn(descritores1[linhas_livres], descritores2[colunas_livres], k)
+        linhas_extra.append(np.repeat(linhas_livres, vizinhos.shape[1]))
+        colunas_extra.append(colunas_livres[vizinhos.ravel()])
+
+    return np.concatenate(linhas_extra), np.concatenate(colunas_extra)
+
+
+def resolver_esparso(n: int, linhas: np.ndarray, colunas: np.ndarray, custos: np.ndarray) -> tuple[float, np.ndarray]:
+    """
+    Resolve o problema de atribuição restrito às arestas dadas com `lap.lapmod`.
+    As arestas precisam admitir um emparelhamento perfeito (ver `completar_emparelhamento`).
+    :param n: Número de linhas (e colunas) do problema.
+    :param linhas: Índices de linha das arestas.
+    :param colunas: Índices de coluna das arestas.
+    :param custos: Custo de cada aresta.
+    :return: Tupla (custo total, col_ind), onde col_ind[i] é a coluna atribuída à linha i.
+    """
+    # Ordena as arestas por linha e coluna, removendo duplicatas, no formato CSR do lapmod
+    chaves, unicos = np.unique(linhas.astype(np.int64) * n + colunas, return_index=True)
+    linhas_ord, kk = np.divmod(chaves, n)
+    cc = custos[unicos].astype(np.float64)
+    ii = np.concatenate(([0], np.cumsum(np.bincount(linhas_ord, minlength=n))))
+
+    # O lapmod exige custos não negativos
+    deslocamento = min(cc.min(), 0.0)
+    custo, col_ind, _ = lap.lapmod(n, cc - deslocamento, ii, kk)
+    return custo + n * deslocamento, col_ind
+
+
+def particionar_por_luminancia(
+        medias1: np.ndarray,
+        medias2: np.ndarray,
+        n_grupos: int
+) -> list[tuple[np.ndarray, np.ndarray]]:
+    """
+    Divide alvos e doadores em grupos balanceados pelos quantis de luminância da cor média.
+    O k-ésimo grupo de alvos e o k-ésimo grupo de doadores têm sempre o mesmo tamanho.
+    :param medias1: Médias de cor RGB (n, 3) dos fragmentos alvo.
+    :param medias2: Médias de cor RGB (n, 3) dos fragmentos doadores.
+    :param n_grupos: Número de grupos.
+    :return: Lista de tuplas (linhas, colunas) com os índices de cada grupo.
+    """
+    pesos_luma = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    ordem1 = np.argsort(medias1 @ pesos_luma, kind='stable')
+    ordem2 = np.argsort(medias2 @ pesos_luma, kind='stable')
+    return list(zip(np.array_split(ordem1, n_grupos), np.array_split(ordem2, n_grupos)))
+
+
+def resolver_denso(cost_matrix: np.ndarray) -> tuple[float, np.ndarray]:
+    """
+    Resolve um problema de atribuição denso com `lap.lapjv`.
+    Definida no nível do módulo para poder ser enviada a um pool de processos.
+    :param cost_matrix: Matriz de custo quadrada.
+    :return: Tupla (custo total, col_ind).
+    """
+    custo, col_ind, _ = lap.lapjv(np.asarray(cost_matrix, dtype=np.float32))
+    return custo, col_ind
+
+
+def resolver_denso_sem_copia(cost_matrix: np.ndarray) -> tuple[float, np.ndarray]:
+    """
+    Resolve um problema de atribuição denso com `lap.lapjvs`, cujo kernel trabalha diretamente
+    sobre uma matriz float32 contígua. Ao contrário de `lap.lapjv`, que converte a entrada para
+    float64, não materializa uma segunda cópia da matriz (ela pode ser um `np.memmap`).
+    :param cost_matrix: Matriz de custo quadrada float32 e contígua.
+    :return: Tupla (custo total, col_ind).
+    """
+    custo, col_ind, _ = lap.lapjvs(cost_matrix, jvx_like=False, prefer_float32=True)
+    return custo, col_ind
+
+
+@njit
+def _aumentar(cost_matrix, u, v, linha_de, inicio):
+    """
+    Insere a linha livre `inicio` na atribuição por um caminho aumentante de custo reduzido
+    mínimo (Dijkstra sobre os custos reduzidos), atualizando os potenciais duais u e v para
+    que continuem viáveis e justos nas arestas atribuídas. Altera os arrays no lugar.
+    :return: Número de colunas visitadas (iterações) até encontrar uma coluna livre.
+    """
+    n = cost_matrix.shape[0]
+    # A coluna virtual n guarda a linha de partida do caminho
+    min_red = np.full(n, np.inf)
+    via = np.full(n, n, dtype=np.int64)
+    usado = np.zeros(n + 1, dtype=np.bool_)
+    linha_da_coluna = np.empty(n + 1, dtype=np.int64)
+    linha_da_coluna[:n] = linha_de
+    linha_da_coluna[n] = inicio
+
+    j0 = n
+    passos = 0
+    while True:
+        usado[j0] = True
+        i0 = linha_da_coluna[j0]
+        delta = np.inf
+        j1 = -1
+        for j in range(n):
+            if not usado[j]:
+                reduzido = cost_matrix[i0, j] - u[i0] - v[j]
+                if reduzido < min_red[j]:
+                    min_red[j] = reduzido
+                    via[j] = j0
+                if min_red[j] < delta:
+                    delta = min_red[j]
+                    j1 = j
+
+        for j in range(n):
+            if usado[j]:
+                u[linha_da_coluna[j]] += delta
+                v[j] -= delta
+            else:
+                min_red[j] -= delta
+        u[inicio] += delta
+
+        j0 = j1
+        passos += 1
+        if linha_da_coluna[j0] < 0:
+            break
+
+    # Inverte as arestas ao longo do caminho aumentante
+    while j0 != n:
+        anterior = via[j0]
+        linha_da_coluna[j0] = linha_da_coluna[anterior]
+        j0 = anterior
+
+    linha_de[:] = linha_da_coluna[:n]
+    return passos
+
+
+@njit(parallel=True)
+def _violacoes_duais(cost_matrix, u, v, col_ind, tol):
+    """
+    Marca as linhas cuja atribuição deixou de ser ótima para os potenciais (u, v): linhas sem
+    coluna, com algum custo reduzido negativo ou cuja aresta atribuída não é mais justa.
+    """
+    n = cost_matrix.shape[0]
+    violacoes = np.zeros(n, dtype=np.bool_)
+    for i in prange(n):
+        j = col_ind[i]
+        if j < 0:
+            violacoes[i] = True
+            continue
+        minimo = np.inf
+        for k in range(n):
+            reduzido = cost_matrix[i, k] - u[i] - v[k]
+            if reduzido < minimo:
+                minimo = reduzido
+        violacoes[i] = minimo < -tol or cost_matrix[i, j] - u[i] - v[j] > tol
+    return violacoes
+
+
+def resolver_incremental(
+        cost_matrix: np.ndarray,
+        u: np.ndarray | None = None,
+        v: np.ndarray | None = None,
+        col_ind: np.ndarray | None = None,
+        tol: float = 1e-6
+) -> tuple[float, np.ndarray, np.ndarray, np.ndarray, int, int]:
+    """
+    Resolve o problema de atribuição por caminhos aumentantes mínimos (método húngaro / JV),
+    aceitando uma solução inicial com suas variáveis duais. As linhas que continuam ótimas para
+    os potenciais (u, v) anteriores mantêm a coluna; só as demais são desfeitas e reinseridas,
+    cada uma com um caminho aumentante O(n²). Quando poucas linhas do custo mudaram entre
+    chamadas, o reparo custa O(k·n²) em vez de O(n³).
+    :param cost_matrix: Matriz de custo quadrada.
+    :param u: Potenciais das linhas da solução anterior.
+    :param v: Potenciais das colunas da solução anterior.
+    :param col_ind: Permutação da solução anterior.
+    :param tol: Tolerância numérica das condições de otimalidade.
+    :return: Tupla (custo total, col_ind, u, v, linhas reinseridas, iterações até convergir).
+    """
+    n = cost_matrix.shape[0]
+    cost_matrix = np.ascontiguousarray(cost_matrix, dtype=np.float32)
+
+    if u is None or v is None or col_ind is None:
+        u = np.zeros(n, dtype=np.float64)
+        v = np.zeros(n, dtype=np.float64)
+        col_ind = np.full(n, -1, dtype=np.int64)
+    else:
+        u = np.array(u, dtype=np.float64)
+        v = np.array(v, dtype=np.float64)
+        col_ind = np.array(col_ind, dtype=np.int64)
+
+    # Desfaz apenas as atribuições que deixaram de satisfazer as condições de otimalidade
+    livres = np.flatnonzero(_violacoes_duais(cost_matrix, u, v, col_ind, tol))
+    col_ind[livres] = -1
+    linha_de = np.full(n, -1, dtype=np.int64)
+    atribuidas = np.flatnonzero(col_ind >= 0)
+    linha_de[col_ind[atribuidas]] = atribuidas
+
+    # Potenciais viáveis para as linhas reinseridas
+    if livres.size > 0:
+        u[livres] = (cost_matrix[livres] - v[None, :]).min(axis=1)
+
+    iteracoes = 0
+    for i in livres:
+        iteracoes += _aumentar(cost_matrix, u, v, linha_de, i)
+
+    col_ind[linha_de] = np.arange(n)
+    custo = float(cost_matrix[np.arange(n), col_ind].sum(dtype=np.float64))
+    return custo, col_ind, u, v, int(livres.size), iteracoes
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import tempfile
+from collections.abc import Callable
+
+import numpy as np
+
+
+def hash_grid(fragmentos: np.ndarray) -> str:
+    """
+    Hash do conteúdo de um grid de fragmentos: os pixels e a forma (o que inclui o tamanho do
+    fragmento). Calculado uma vez por grid e combinado com cada descritor em `chave_descritor`.
+    :param fragmentos: Grid de fragmentos (h, w, fh, fw, 3).
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(str(fragmentos.shape).encode())
+    h.update(np.ascontiguousarray(fragmentos).data)
+    return h.hexdigest()
+
+
+def chave_descritor(hash_fragmentos: str, nome: str, parametros: dict) -> str:
+    """
+    Chave de um descritor no cache: o hash do grid, o nome do descritor e só os parâmetros que
+    alteram esse descritor, para que mudar uma opção não invalide os demais.
+    :param hash_fragmentos: Resultado de `hash_grid`.
+    :param parametros: Parâmetros serializáveis em JSON que influenciam o cálculo.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(hash_fragmentos.encode())
+    h.update(nome.encode())
+    h.update(json.dumps(parametros, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def carregar_descritor(diretorio: str, chave: str) -> np.ndarray | None:
+    """
+    Procura um descritor no cache. O array é mapeado do disco com np.load(mmap_mode="c"): nada é
+    copiado na leitura e eventuais escritas ficam só na memória do processo, sem alterar o cache.
+    Um acerto marca a entrada como usada agora (LRU).
+    :return: O descritor, ou None se não estiver no cache.
+    """
+    arquivo = os.path.join(diretorio, f"{chave}.npy")
+    try:
+        descritor = np.load(arquivo, mmap_mode="c")
+        os.utime(arquivo)
+    except (FileNotFoundError, ValueError):
+        return None
+    return descritor
+
+
+def salvar_descritor(diretorio: str, chave: str, descritor: np.ndarray, max_bytes: int):
+    """
+    Grava o descritor num arquivo .npy temporário que depois é renomeado para o arquivo da chave,
+    para que leitores nunca vejam uma entrada incompleta. Em seguida remove as entradas usadas há
+    mais tempo até o cache caber em `max_bytes`.
+    """
+    os.makedirs(diretorio, exist_ok=True)
+    fd, temporario = tempfile.mkstemp(prefix=".parcial_", suffix=".npy", dir=diretorio)
+    try:
+        with os.fdopen(fd, "wb") as arquivo:
+            np.save(arquivo, np.ascontiguousarray(descritor))
+        os.replace(temporario, os.path.join(diretorio, f"{chave}.npy"))
+    finally:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+
+    limitar_cache(diretorio, max_bytes)
+
+
+def descritor_em_cache(
+        diretorio: str | None,
+        chave: str,
+        max_bytes: int,
+        calcular: Callable[[], np.ndarray]
+) -> np.ndarray:
+    """
+    Devolve o descritor do cache ou, em caso de falta, o calcula com `calcular()` e o grava.
+    Sem `diretorio`, apenas calcula.
+    """
+    if diretorio is not None:
+        descritor = carregar_descritor(diretorio, chave)
+        if descritor is not None:
+            print(f"Descritor encontrado no cache ({chave[:12]})")
+            return descritor
+
+    descritor = calcular()
+    if diretorio is not None:
+        salvar_descritor(diretorio, chave, descritor, max_bytes)
+    return descritor
+
+
+def limitar_cache(diretorio: str, max_bytes: int):
+    """Remove as entradas menos usadas recentemente até o total caber em `max_bytes`."""
+    entradas = []
+    total = 0
+    for entrada in os.scandir(diretorio):
+        if entrada.name.startswith(".") or not entrada.name.endswith(".npy") or not entrada.is_file():
+            continue
+        info = entrada.stat()
+        entradas.append((info.st_mtime, entrada.path, info.st_size))
+        total += info.st_size
+
+    for _, arquivo, tamanho in sorted(entradas):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(arquivo)
+        except FileNotFoundError:
+            pass
+        total -= tamanho
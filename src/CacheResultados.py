@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Resultados já codificados (bytes do arquivo de imagem), do usado há mais tempo para o mais recente
+_memoria: OrderedDict[str, bytes] = OrderedDict()
+_config = {"max_bytes": 0, "diretorio": None, "max_bytes_disco": 0}
+_estatisticas = {"acertos_memoria": 0, "acertos_disco": 0, "faltas": 0, "bytes_memoria": 0}
+_trava = threading.Lock()
+# Serializa as gravações na camada em disco, para duas remoções simultâneas não contarem o mesmo
+# espaço liberado
+_trava_disco = threading.Lock()
+
+
+def configurar_cache_resultados(max_bytes: int, diretorio: str | None = None, max_bytes_disco: int = 0):
+    """
+    :param max_bytes: Tamanho máximo dos resultados mantidos em memória.
+    :param diretorio: Pasta da camada em disco, consultada quando a memória não tem o resultado
+        (None desativa a camada).
+    :param max_bytes_disco: Tamanho máximo da camada em disco.
+    """
+    with _trava:
+        _config.update(max_bytes=max_bytes, diretorio=diretorio, max_bytes_disco=max_bytes_disco)
+        _limitar_memoria()
+
+
+def chave_resultado(imagem_1: bytes, imagem_2: bytes, parametros: dict) -> str:
+    """
+    Chave de um resultado: hashes do conteúdo das duas imagens enviadas, em ordem, e dos
+    parâmetros normalizados (serializáveis em JSON) que alteram a saída.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(hashlib.blake2b(imagem_1, digest_size=20).digest())
+    h.update(hashlib.blake2b(imagem_2, digest_size=20).digest())
+    h.update(json.dumps(parametros, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def obter_resultado(chave: str) -> bytes | None:
+    """
+    Procura o resultado na memória e depois no disco; um acerto no disco volta para a memória.
+    :return: Os bytes da imagem codificada, ou None.
+    """
+    with _trava:
+        dados = _memoria.get(chave)
+        if dados is not None:
+            _memoria.move_to_end(chave)
+            _estatisticas["acertos_memoria"] += 1
+            return dados
+
+    dados = _ler_disco(chave)
+    with _trava:
+        if dados is None:
+            _estatisticas["faltas"] += 1
+            return None
+        _estatisticas["acertos_disco"] += 1
+        _guardar_memoria(chave, dados)
+    return dados
+
+
+def guardar_resultado(chave: str, dados: bytes):
+    """Guarda o resultado codificado na memória e, se configurada, na camada em disco."""
+    with _trava:
+        _guardar_memoria(chave, dados)
+    if _config["diretorio"] is not None:
+        _gravar_disco(chave, dados)
+
+
+def estatisticas_cache_resultados() -> dict:
+    """Acertos (por camada), faltas, taxa de acerto e ocupação da memória."""
+    with _trava:
+        acertos = _estatisticas["acertos_memoria"] + _estatisticas["acertos_disco"]
+        consultas = acertos + _estatisticas["faltas"]
+        return {
+            **_estatisticas,
+            "taxa_acerto": acertos / consultas if consultas else 0.0,
+            "entradas_memoria": len(_memoria),
+            "max_bytes": _config["max_bytes"],
+            "diretorio": _config["diretorio"],
+        }
+
+
+def _guardar_memoria(chave: str, dados: bytes):
+    """Chamada com `_trava`. Resultados maiores que o limite inteiro ficam só no disco."""
+    if len(dados) > _config["max_bytes"]:
+        return
+    if chave in _memoria:
+        _estatisticas["bytes_memoria"] -= len(_memoria[chave])
+    _memoria[chave] = dados
+    _memoria.move_to_end(chave)
+    _estatisticas["bytes_memoria"] += len(dados)
+    _limitar_memoria()
+
+
+def _limitar_memoria():
+    """Chamada com `_trava`: descarta os resultados usados há mais tempo até caber em `max_bytes`."""
+    while _estatisticas["bytes_memoria"] > _config["max_bytes"]:
+        _, dados = _memoria.popitem(last=False)
+        _estatisticas["bytes_memoria"] -= len(dados)
+
+
+def _ler_disco(chave: str) -> bytes | None:
+    if _config["diretorio"] is None:
+        return None
+    caminho = os.path.join(_config["diretorio"], chave)
+    try:
+        with open(caminho, "rb") as arquivo:
+            dados = arquivo.read()
+        os.utime(caminho)
+    except FileNotFoundError:
+        return None
+    return dados
+
+
+def _gravar_disco(chave: str, dados: bytes):
+    """
+    Grava num arquivo temporário renomeado para o nome da chave (leitores nunca veem um arquivo
+    incompleto) e remove os arquivos usados há mais tempo até a pasta caber em `max_bytes_disco`.
+    Se a gravação falha, o arquivo temporário é removido.
+    """
+    diretorio = _config["diretorio"]
+    os.makedirs(diretorio, exist_ok=True)
+    fd, temporario = tempfile.mkstemp(prefix=".parcial_", dir=diretorio)
+    try:
+        with os.fdopen(fd, "wb") as arquivo:
+            arquivo.write(dados)
+        os.replace(temporario, os.path.join(diretorio, chave))
+    finally:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+
+    with _trava_disco:
+        entradas = []
+        total = 0
+        for entrada in os.scandir(diretorio):
+            if entrada.name.startswith(".") or not entrada.is_file():
+                continue
+            try:
+                info = entrada.stat()
+            except FileNotFoundError:
+                continue
+            entradas.append((info.st_mtime, entrada.path, info.st_size))
+            total += info.st_size
+        for _, caminho, tamanho in sorted(entradas):
+            if total <= _config["max_bytes_disco"]:
+                break
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
+            total -= tamanho
@@ -1,6 +1,75 @@
 import numpy as np
 from numba import njit, cuda, float32
 
+# Espaços de cor aceitos por `converter_espaco_cor`
+ESPACOS_COR = ("rgb", "yuv", "lab")
+
+# RGB (0-255) -> YUV (BT.601): Y em 0-255, U e V com sinal
+MATRIZ_YUV = np.array([
+    [0.299, 0.587, 0.114],
+    [-0.14713, -0.28886, 0.436],
+    [0.615, -0.51499, -0.10001],
+], dtype=np.float32)
+
+# sRGB linear -> XYZ e branco de referência D65, usados na conversão para CIELAB
+MATRIZ_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+], dtype=np.float32)
+BRANCO_D65 = np.array([0.95047, 1.0, 1.08883], dtype=np.float32)
+
+# Amplitude (máximo - mínimo) de cada canal de `converter_espaco_cor` sobre todo o cubo RGB de
+# 8 bits, arredondada para cima. As similaridades de cor dividem a diferença de cada canal por
+# ela, então ficam em [0, 1] em qualquer espaço.
+AMPLITUDES_COR = {
+    "rgb": (255.0, 255.0, 255.0),
+    "yuv": (255.0, 222.36, 313.65),
+    "lab": (100.0, 184.42, 202.34),
+}
+
+
+def converter_espaco_cor(img: np.ndarray, espaco: str) -> np.ndarray:
+    """
+    Converte de uma vez uma imagem, um fragmento ou um grid inteiro de fragmentos (qualquer
+    forma terminada em 3 canais RGB uint8) para o espaço de cor pedido, em float32.
+    Diferente de `covert_to_YUV`, os valores negativos de U e V são mantidos.
+    :param espaco: Um de `ESPACOS_COR`. "yuv" dá Y em 0-255 e U, V com sinal; "lab" dá CIELAB
+        (D65) com L* em 0-100 e a*, b* com sinal, em que a distância euclidiana é a ΔE*76.
+    :return: Array float32 com a forma de `img`.
+    """
+    if espaco not in ESPACOS_COR:
+        raise ValueError(f"Espaço de cor '{espaco}' inválido. Use um de {ESPACOS_COR}.")
+
+    # Uma só cópia, já em float32 e C-contígua, mesmo para uma visão de `fragmentos_view`
+    pixels = np.array(img, dtype=np.float32, order="C").reshape((-1, 3))
+    if espaco == "yuv":
+        pixels = pixels @ MATRIZ_YUV.T
+    elif espaco == "lab":
+        # sRGB -> linear -> XYZ normalizado pelo branco
+        pixels /= 255.0
+        pixels = np.where(pixels <= 0.04045, pixels / 12.92, ((pixels + 0.055) / 1.055) ** 2.4)
+        xyz = (pixels @ MATRIZ_XYZ.T) / BRANCO_D65
+
+        delta = 6 / 29
+        f = np.where(xyz > delta ** 3, np.cbrt(xyz), xyz / (3 * delta ** 2) + 4 / 29)
+        pixels = np.empty_like(f)
+        pixels[:, 0] = 116 * f[:, 1] - 16
+        pixels[:, 1] = 500 * (f[:, 0] - f[:, 1])
+        pixels[:, 2] = 200 * (f[:, 1] - f[:, 2])
+
+    return pixels.astype(np.float32, copy=False).reshape(img.shape)
+
+
+def amplitude_cor(espaco: str) -> np.ndarray:
+    """
+    :param espaco: Um de `ESPACOS_COR`.
+    :return: Array float32 (3,) com a amplitude de cada canal, passado aos kernels de similaridade.
+    """
+    if espaco not in ESPACOS_COR:
+        raise ValueError(f"Espaço de cor '{espaco}' inválido. Use um de {ESPACOS_COR}.")
+    return np.array(AMPLITUDES_COR[espaco], dtype=np.float32)
+
 
 @njit
 def covert_to_YUV(img: np.ndarray) -> np.ndarray:
@@ -32,36 +101,101 @@ def covert_to_RGB(yuv: np.ndarray) -> np.ndarray:
     return rgb
 
 
-@njit
-def comp_imgs_dif(img1: np.ndarray, img2: np.ndarray) -> float:
+@njit(cache=True)
+def comp_imgs_dif(img1: np.ndarray, img2: np.ndarray, amplitude: np.ndarray) -> float:
     """
     Compares two images.
     :param img1: The first image.
     :param img2: The second image.
-    :return: The similarity between the two images.
+    :param amplitude: Range of each channel (see `amplitude_cor`).
+    :return: The similarity between the two images (0 to 1).
     """
-    # Calculate the difference between the two images
-    # diff = np.abs(img1 - img2)
-    diff = np.abs(img1.astype(np.int32) - img2.astype(np.int32))
+    # Calculate the difference between the two images, per channel range
+    # (float32 so that signed or fractional color spaces from `converter_espaco_cor` are exact)
+    diff = np.abs(img1.astype(np.float32) - img2.astype(np.float32)) / amplitude
 
     # Calculate the similarity
-    similarity = 1 - np.sum(diff) / (img1.shape[0] * img1.shape[1] * 3 * 255)
+    similarity = 1 - np.sum(diff) / (img1.shape[0] * img1.shape[1] * 3)
+    return similarity
+
+
+@njit(cache=True)
+def comp_imgs_dif_l2(img1: np.ndarray, img2: np.ndarray, amplitude: np.ndarray) -> float:
+    """
+    Compares two images using the sum of squared differences.
+    :param img1: The first image.
+    :param img2: The second image.
+    :param amplitude: Range of each channel (see `amplitude_cor`).
+    :return: The similarity between the two images (0 to 1).
+    """
+    diff = (img1.astype(np.float32) - img2.astype(np.float32)) / amplitude
+
+    similarity = 1 - np.sum(diff * diff) / (img1.shape[0] * img1.shape[1] * 3)
     return similarity
 
 
+def preparar_l2(frag: np.ndarray, amplitude: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Prepara um conjunto de fragmentos para `matriz_similaridade_l2`: os pixels normalizados pela
+    amplitude de cada canal, um vetor por fragmento, e a norma quadrada de cada vetor.
+    Permite calcular o lado doador uma única vez quando a matriz é montada em vários blocos.
+    :param frag: Fragmentos (n, fh, fw, 3), ou um grid (h, w, fh, fw, 3).
+    :param amplitude: Amplitude de cada canal (ver `amplitude_cor`).
+    :return: Tupla (vetores (n, fh*fw*3) float32, normas quadradas (n,) float32).
+    """
+    vetores = (np.array(frag, dtype=np.float32, order="C") / amplitude).reshape((-1, np.prod(frag.shape[-3:])))
+    return vetores, np.einsum('ij,ij->i', vetores, vetores)
+
+
+def matriz_similaridade_l2(
+        frag1: np.ndarray,
+        frag2: np.ndarray,
+        amplitude: np.ndarray,
+        preparado2: tuple[np.ndarray, np.ndarray] | None = None
+) -> np.ndarray:
+    """
+    Calcula o bloco (n, m) de similaridade por soma das diferenças quadráticas (L2) entre
+    todos os pares de fragmentos, usando ‖a‖² + ‖b‖² − 2·A·Bᵀ para que o trabalho seja
+    feito por uma multiplicação de matrizes (BLAS).
+    :param frag1: Fragmentos (n, fh, fw, 3) do primeiro conjunto, ou um grid (h, w, fh, fw, 3).
+    :param frag2: Fragmentos (m, fh, fw, 3) do segundo conjunto, ou um grid.
+    :param amplitude: Amplitude de cada canal (ver `amplitude_cor`); os canais são divididos por
+        ela antes do produto.
+    :param preparado2: Resultado de `preparar_l2(frag2, amplitude)` já calculado; se dado, `frag2`
+        não é convertido de novo.
+    :return: Matriz (n, m) float32 de similaridades (0 a 1).
+    """
+    a, sq_a = preparar_l2(frag1, amplitude)
+    b, sq_b = preparar_l2(frag2, amplitude) if preparado2 is None else preparado2
+
+    ssd = a @ b.T
+    ssd *= -2.0
+    ssd += sq_a[:, None]
+    ssd += sq_b[None, :]
+    # Erros de arredondamento podem gerar valores levemente negativos
+    np.maximum(ssd, 0.0, out=ssd)
+
+    # A soma máxima possível das diferenças quadráticas (cada valor normalizado varia no máximo 1)
+    max_ssd = np.float32(a.shape[1])
+    ssd /= max_ssd
+    np.subtract(1.0, ssd, out=ssd)
+    return ssd
+
+
 @cuda.jit(device=True)
-def cu_comp_imgs_dif(img1, img2):
+def cu_comp_imgs_dif(img1, img2, amplitude):
     """
     Compara duas imagens na GPU. Esta é uma 'device function'.
     :param img1: A primeira imagem (um fragmento 3D).
     :param img2: A segunda imagem (um fragmento 3D).
+    :param amplitude: Amplitude de cada canal (ver `amplitude_cor`).
     :return: A similaridade entre as duas imagens.
     """
     # A forma (shape) da imagem é conhecida (ex: 64, 64, 3)
     height, width, channels = img1.shape
 
-    # O valor máximo possível da soma das diferenças absolutas
-    max_diff_sum = height * width * channels * 255.0
+    # O valor máximo possível da soma das diferenças absolutas, já divididas pela amplitude
+    max_diff_sum = height * width * channels * 1.0
 
     # Acumulador para a soma das diferenças
     diff_sum = 0.0
@@ -71,7 +205,7 @@ def cu_comp_imgs_dif(img1, img2):
         for x in range(width):
             for c in range(channels):
                 # Usamos float32 para evitar overflow com uint8
-                d = abs(float32(img1[y, x, c]) - float32(img2[y, x, c]))
+                d = abs(float32(img1[y, x, c]) - float32(img2[y, x, c])) / amplitude[c]
                 diff_sum += d
 
     # Calcula a similaridade
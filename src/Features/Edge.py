@@ -2,6 +2,14 @@ import os
 import numpy as np
 from numba import njit, cuda
 
+# Horizontal and vertical Sobel kernels, shared with `Filtros.gradientes_sobel`
+SOBEL_X = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]], dtype=np.float32)
+SOBEL_Y = np.array([[-1, -2, -1], [0, 0, 0], [1, 2, 1]], dtype=np.float32)
+# Exact separable factors: SOBEL_X = outer(SOBEL_SUAVIZACAO, SOBEL_DERIVADA) and
+# SOBEL_Y = outer(SOBEL_DERIVADA, SOBEL_SUAVIZACAO)
+SOBEL_SUAVIZACAO = np.array([1, 2, 1], dtype=np.float32)
+SOBEL_DERIVADA = np.array([-1, 0, 1], dtype=np.float32)
+
 
 @njit
 def grayscale(img: np.ndarray) -> np.ndarray:
@@ -48,13 +56,10 @@ def sobel(img: np.ndarray) -> np.ndarray:
     Applies the Sobel operator and returns a 3-channel representation
     encoding both edge magnitude and direction.
     """
-    kernel_x = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]], dtype=np.float32)
-    kernel_y = np.array([[-1, -2, -1], [0, 0, 0], [1, 2, 1]], dtype=np.float32)
-
     gray_channel = img[:, :, 0].astype(np.float32)
 
-    img_x = convolve(gray_channel, kernel_x)
-    img_y = convolve(gray_channel, kernel_y)
+    img_x = convolve(gray_channel, SOBEL_X)
+    img_y = convolve(gray_channel, SOBEL_Y)
 
     magnitude = np.sqrt(img_x ** 2 + img_y ** 2)
     angle = np.arctan2(img_y, img_x)
@@ -72,7 +77,34 @@ def sobel(img: np.ndarray) -> np.ndarray:
     return sobel_output
 
 
-@njit
+def sobel_imagem(img: np.ndarray) -> np.ndarray:
+    """
+    Whole-image version of `sobel`: the gradients are computed once over the full image by
+    `Filtros.gradientes_sobel` in its separable form (vectorised 1-D passes instead of a per-pixel
+    loop). Gradients across fragment borders are kept and the magnitude is normalised by the
+    maximum of the whole image.
+    The result can be sliced into the fragment grid with `get_fragmentos` or `fragmentos_view`.
+    """
+    # Filtros imports this module, so the import has to wait until both are loaded
+    from src.Features.Filtros import gradientes_sobel
+
+    img_x, img_y = gradientes_sobel(img[:, :, 0].astype(np.float32), "separavel")
+
+    magnitude = np.hypot(img_x, img_y)
+    angle = np.arctan2(img_y, img_x)
+
+    max_magnitude = magnitude.max()
+    mag_norm = (magnitude * (255 / max_magnitude) if max_magnitude > 0 else magnitude).astype(np.uint8)
+
+    sobel_output = np.empty(img.shape[:2] + (3,), dtype=np.uint8)
+    sobel_output[:, :, 0] = mag_norm
+    sobel_output[:, :, 1] = (((angle + np.pi) / (2 * np.pi)) * 255).astype(np.uint8)
+    sobel_output[:, :, 2] = mag_norm
+
+    return sobel_output
+
+
+@njit(cache=True)
 def comp_sobel_dif(sobel_frag1: np.ndarray, sobel_frag2: np.ndarray) -> float:
     """
     Compares two Sobel feature fragments and returns a similarity score.
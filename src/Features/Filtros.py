@@ -0,0 +1,223 @@
+import os
+import time
+from functools import lru_cache
+
+import numpy as np
+import scipy.fft
+
+from src.Features.Edge import convolve, SOBEL_X, SOBEL_Y, SOBEL_SUAVIZACAO, SOBEL_DERIVADA
+from src.Fragmentos import SaveImage
+
+# Métodos de convolução; "auto" escolhe pelo formato do kernel (ver `escolher_metodo`)
+METODOS = ("auto", "direto", "separavel", "fft")
+
+# Pontos de cruzamento medidos com `benchmark_convolucao` (CPU, imagens de 32x32 a 512x512):
+# kernels não separáveis a partir deste lado ficam mais rápidos via FFT do que pelo `convolve`
+# direto (3x3 empata em imagens pequenas; de 5x5 em diante a FFT vence em todos os tamanhos)
+LIMIAR_FFT = 5
+# kernels separáveis a partir deste lado ficam mais rápidos via FFT do que em duas passadas 1-D
+# (entre 9 e 15 em 512x512; em imagens pequenas a FFT vence antes)
+LIMIAR_FFT_SEPARAVEL = 11
+
+
+def decompor_separavel(kernel: np.ndarray, tol: float = 1e-6) -> tuple[np.ndarray, np.ndarray] | None:
+    """
+    Detecta se o kernel é separável (posto 1), isto é, o produto externo de uma coluna por uma linha.
+    :return: (coluna, linha) tais que kernel == np.outer(coluna, linha), ou None se não for separável.
+    """
+    if kernel.ndim != 2 or min(kernel.shape) == 1:
+        return None
+    u, s, vt = np.linalg.svd(kernel.astype(np.float64))
+    if s[0] == 0 or s[1] > tol * s[0]:
+        return None
+    escala = np.sqrt(s[0])
+    return (u[:, 0] * escala).astype(np.float32), (vt[0] * escala).astype(np.float32)
+
+
+def escolher_metodo(kernel: np.ndarray) -> str:
+    """Método mais rápido para o kernel, pelos limiares medidos em `benchmark_convolucao`."""
+    lado = max(kernel.shape)
+    if decompor_separavel(kernel) is not None:
+        return "separavel" if lado < LIMIAR_FFT_SEPARAVEL else "fft"
+    return "direto" if lado < LIMIAR_FFT else "fft"
+
+
+def correlacao_1d(canal: np.ndarray, pesos: np.ndarray, eixo: int) -> np.ndarray:
+    """
+    Passada 1-D ao longo de um eixo, com borda zerada e saída do mesmo tamanho: soma de cópias
+    deslocadas da imagem, vetorizada sobre todos os pixels.
+    """
+    k = pesos.shape[0]
+    pad = [(0, 0), (0, 0)]
+    pad[eixo] = (k // 2, k - 1 - k // 2)
+    padded = np.pad(canal.astype(np.float32, copy=False), pad)
+
+    n = canal.shape[eixo]
+    saida = np.zeros(canal.shape, dtype=np.float32)
+    for i, peso in enumerate(pesos):
+        if peso != 0:
+            saida += np.float32(peso) * (padded[i:i + n] if eixo == 0 else padded[:, i:i + n])
+    return saida
+
+
+@lru_cache(maxsize=32)
+def _espectro_kernel(kernel_bytes: bytes, forma_kernel: tuple[int, int], forma_fft: tuple[int, int]) -> np.ndarray:
+    """
+    Transformada do kernel invertido para um tamanho de FFT. Fica em cache: aplicar o mesmo filtro
+    a vários canais ou imagens do mesmo tamanho paga a transformada do kernel uma só vez.
+    """
+    kernel = np.frombuffer(kernel_bytes, dtype=np.float32).reshape(forma_kernel)
+    return scipy.fft.rfft2(kernel[::-1, ::-1], s=forma_fft, workers=-1)
+
+
+def convolucao_fft(canal: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    """
+    Mesma operação de `convolve` (correlação com borda zerada, saída do mesmo tamanho) via
+    scipy.fft, com o tamanho da transformada arredondado para um comprimento rápido.
+    """
+    h, w = canal.shape
+    kh, kw = kernel.shape
+    forma_fft = (scipy.fft.next_fast_len(h + kh - 1, real=True), scipy.fft.next_fast_len(w + kw - 1, real=True))
+
+    kernel = np.ascontiguousarray(kernel, dtype=np.float32)
+    espectro = _espectro_kernel(kernel.tobytes(), kernel.shape, forma_fft)
+    completa = scipy.fft.irfft2(
+        scipy.fft.rfft2(canal.astype(np.float32, copy=False), s=forma_fft, workers=-1) * espectro,
+        s=forma_fft, workers=-1
+    )
+    topo, esquerda = kh - 1 - kh // 2, kw - 1 - kw // 2
+    return completa[topo:topo + h, esquerda:esquerda + w].astype(np.float32)
+
+
+def filtrar(img: np.ndarray, kernel: np.ndarray, metodo: str = "auto") -> np.ndarray:
+    """
+    Aplica um kernel a uma imagem de um canal (h, w) ou a cada canal de (h, w, c).
+    Todos os métodos dão o resultado de `Edge.convolve` (a menos de arredondamento).
+    :param metodo: Um de `METODOS`. "direto" usa `Edge.convolve`, "separavel" faz duas passadas
+        1-D e "fft" usa scipy.fft; "auto" escolhe por `escolher_metodo`.
+    :return: Array float32 com a forma de `img`.
+    """
+    if metodo not in METODOS:
+        raise ValueError(f"Método '{metodo}' inválido. Use um de {METODOS}.")
+    kernel = np.asarray(kernel, dtype=np.float32)
+    if metodo == "auto":
+        metodo = escolher_metodo(kernel)
+
+    if img.ndim == 3:
+        return np.stack([filtrar(img[:, :, c], kernel, metodo) for c in range(img.shape[2])], axis=2)
+
+    if metodo == "separavel":
+        partes = decompor_separavel(kernel)
+        if partes is None:
+            raise ValueError("O kernel não é separável.")
+        coluna, linha = partes
+        return correlacao_1d(correlacao_1d(img, coluna, 0), linha, 1)
+    if metodo == "fft":
+        return convolucao_fft(img, kernel)
+    return convolve(img.astype(np.float32), kernel)
+
+
+def kernel_gaussiano(sigma: float = 1.0, tamanho: int | None = None) -> np.ndarray:
+    """
+    Kernel gaussiano 2-D normalizado (soma 1).
+    :param tamanho: Lado do kernel; por padrão 2 * ceil(3 * sigma) + 1.
+    """
+    tamanho = tamanho or 2 * int(np.ceil(3 * sigma)) + 1
+    x = np.arange(tamanho, dtype=np.float32) - (tamanho - 1) / 2
+    g = np.exp(-x ** 2 / (2 * sigma ** 2))
+    g /= g.sum()
+    return np.outer(g, g).astype(np.float32)
+
+
+def kernel_caixa(tamanho: int = 3) -> np.ndarray:
+    """Kernel de média (box) tamanho x tamanho."""
+    return np.full((tamanho, tamanho), 1 / tamanho ** 2, dtype=np.float32)
+
+
+def _para_uint8(img: np.ndarray) -> np.ndarray:
+    return np.clip(np.rint(img), 0, 255).astype(np.uint8)
+
+
+def gaussian_blur(img: np.ndarray, sigma: float = 1.0, tamanho: int | None = None, metodo: str = "auto") -> np.ndarray:
+    """Desfoque gaussiano de uma imagem uint8 (h, w) ou (h, w, c); devolve uint8 da mesma forma."""
+    return _para_uint8(filtrar(img, kernel_gaussiano(sigma, tamanho), metodo))
+
+
+def box_blur(img: np.ndarray, tamanho: int = 3, metodo: str = "auto") -> np.ndarray:
+    """Desfoque por média (box) de uma imagem uint8 (h, w) ou (h, w, c); devolve uint8 da mesma forma."""
+    return _para_uint8(filtrar(img, kernel_caixa(tamanho), metodo))
+
+
+def gradientes_sobel(canal: np.ndarray, metodo: str = "auto") -> tuple[np.ndarray, np.ndarray]:
+    """
+    Gradientes horizontal e vertical de Sobel de uma imagem de um canal, com os kernels de
+    `Edge.sobel` (`SOBEL_X` e `SOBEL_Y`). Na forma separável usa os fatores exatos dos kernels
+    (`SOBEL_SUAVIZACAO` e `SOBEL_DERIVADA`), sem a decomposição em ponto flutuante de `filtrar`;
+    é a implementação usada por `Edge.sobel_imagem`.
+    :param metodo: Um de `METODOS`; ver `filtrar`.
+    :return: (gx, gy) em float32.
+    """
+    if metodo not in METODOS:
+        raise ValueError(f"Método '{metodo}' inválido. Use um de {METODOS}.")
+    if metodo == "auto":
+        metodo = escolher_metodo(SOBEL_X)
+    if metodo == "separavel":
+        gx = correlacao_1d(correlacao_1d(canal, SOBEL_SUAVIZACAO, 0), SOBEL_DERIVADA, 1)
+        gy = correlacao_1d(correlacao_1d(canal, SOBEL_DERIVADA, 0), SOBEL_SUAVIZACAO, 1)
+        return gx, gy
+    return filtrar(canal, SOBEL_X, metodo), filtrar(canal, SOBEL_Y, metodo)
+
+
+def save_array_as_image(img: np.ndarray, output_dir: str, filename: str):
+    """
+    Saves an array as an image inside `output_dir`, creating the directory if needed.
+    Float arrays are clipped to 0-255 and converted to uint8.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if img.dtype != np.uint8:
+        img = _para_uint8(img)
+    SaveImage(img, os.path.join(output_dir, filename))
+
+
+def benchmark_convolucao(
+        tamanho_imagem: int = 512,
+        lados: tuple[int, ...] = (3, 5, 7, 9, 15, 21, 31, 45, 63),
+        repeticoes: int = 3
+) -> list[dict]:
+    """
+    Mede o tempo de cada método para kernels separáveis (gaussiano) e não separáveis (aleatórios)
+    de vários lados sobre uma imagem aleatória, e imprime uma tabela. Os limiares `LIMIAR_FFT` e
+    `LIMIAR_FFT_SEPARAVEL` vêm dos pontos em que a FFT passa a vencer.
+    :return: Uma linha por (tipo de kernel, lado), com o tempo médio de cada método em ms.
+    """
+    rng = np.random.default_rng(0)
+    canal = rng.random((tamanho_imagem, tamanho_imagem), dtype=np.float32) * 255
+    convolve(canal[:8, :8], np.ones((3, 3), dtype=np.float32))  # compila o kernel numba
+
+    linhas = []
+    print(f"Imagem {tamanho_imagem}x{tamanho_imagem}, média de {repeticoes} execuções (ms)")
+    print(f"{'kernel':>14} {'lado':>5} {'direto':>10} {'separavel':>10} {'fft':>10}  auto")
+    for tipo in ("separavel", "nao_separavel"):
+        for lado in lados:
+            if tipo == "separavel":
+                kernel = kernel_gaussiano(lado / 6, lado)
+                metodos = ("direto", "separavel", "fft")
+            else:
+                kernel = rng.random((lado, lado), dtype=np.float32)
+                metodos = ("direto", "fft")
+
+            tempos = {}
+            for metodo in metodos:
+                inicio = time.perf_counter()
+                for _ in range(repeticoes):
+                    filtrar(canal, kernel, metodo)
+                tempos[metodo] = 1000 * (time.perf_counter() - inicio) / repeticoes
+
+            linhas.append({"kernel": tipo, "lado": lado, **tempos, "auto": escolher_metodo(kernel)})
+            colunas = " ".join(f"{tempos[m]:10.2f}" if m in tempos else f"{'-':>10}" for m in ("direto", "separavel", "fft"))
+            print(f"{tipo:>14} {lado:>5} {colunas}  {escolher_metodo(kernel)}")
+    return linhas
+
+
+if __name__ == "__main__":
+    benchmark_convolucao()
@@ -83,3 +83,39 @@ def cu_comp_imgs_media_cor(img1, img2):
 
     similarity = 1.0 - (total_diff_medias / max_total_diff)
     return similarity
+
+
+def medias_fragmentos(fragmentos: np.ndarray) -> np.ndarray:
+    """
+    Calcula a média de cor de cada fragmento uma única vez, sem copiar os pixels.
+    :param fragmentos: Fragmentos achatados com forma (n, fh, fw, 3), ou um grid (h, w, fh, fw, 3)
+        (em ordem de linhas).
+    :return: Array (n, 3) float32 com a média de cada canal por fragmento.
+    """
+    return fragmentos.mean(axis=(-3, -2), dtype=np.float32).reshape((-1, fragmentos.shape[-1]))
+
+
+def matriz_similaridade_media_cor(medias1: np.ndarray, medias2: np.ndarray, amplitude: np.ndarray) -> np.ndarray:
+    """
+    Calcula o bloco (n, m) de similaridade por média de cor em uma única operação vetorizada.
+    Equivalente a aplicar `comp_imgs_media_cor` a todos os pares, mas com custo O(n·m·3).
+    :param medias1: Médias de cor (n, 3) do primeiro conjunto.
+    :param medias2: Médias de cor (m, 3) do segundo conjunto.
+    :param amplitude: Amplitude de cada canal no espaço de cor das médias (ver `amplitude_cor`).
+    :return: Matriz (n, m) float32 de similaridades (0 a 1).
+    """
+    # Acumula canal a canal, no lugar, para não materializar um array (n, m, 3): o pico é de
+    # dois arrays (n, m), o resultado e a diferença do canal
+    sum_diff_medias = np.zeros((medias1.shape[0], medias2.shape[0]), dtype=np.float32)
+    diff = np.empty_like(sum_diff_medias)
+    for c in range(medias1.shape[1]):
+        np.subtract(medias1[:, c, None], medias2[None, :, c], out=diff)
+        np.abs(diff, out=diff)
+        diff /= amplitude[c]
+        sum_diff_medias += diff
+    del diff
+
+    max_total_diff = np.float32(medias1.shape[1])
+    sum_diff_medias /= max_total_diff
+    np.subtract(1.0, sum_diff_medias, out=sum_diff_medias)
+    return sum_diff_medias
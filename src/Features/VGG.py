@@ -1,26 +1,94 @@
+import threading
+import time
+from collections.abc import Callable
+from itertools import chain
+
 import numpy as np
 import torch
+import torch.nn.functional as F
 from torchvision import models, transforms
 from PIL import Image
 
+from src.Fragmentos import contar_fragmentos, selecionar_fragmentos
+
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-print(f"Usando dispositivo: {device}")
 
-model = None
-try:
-    # Carrega o modelo VGG16 pré-treinado
-    vgg16 = models.vgg16(weights=models.VGG16_Weights.IMAGENET1K_V1).to(device)
+
+def construir_vgg16() -> torch.nn.Module:
+    """Carrega a VGG16 pré-treinada e mantém só as camadas convolucionais usadas aqui."""
+    vgg16 = models.vgg16(weights=models.VGG16_Weights.IMAGENET1K_V1)
 
     # Remove as camadas de classificação (fully connected)
     # Usaremos a saída da penúltima camada de max pooling
-    model = torch.nn.Sequential(*list(vgg16.features.children())[:24])
+    model = torch.nn.Sequential(*list(vgg16.features.children())[:24]).to(device)
 
     # Coloca o modelo em modo de avaliação (desativa dropout, batchnorm, etc.)
     model.eval()
+    return model
+
+
+# Modelos disponíveis, por nome. Nenhum é carregado na importação: cada um é construído no
+# primeiro uso (`obter_modelo`) ou quando pré-carregado (`pre_carregar_modelos`)
+CONSTRUTORES = {"vgg16": construir_vgg16}
+
+_modelos: dict[str, torch.nn.Module | None] = {}
+_info_modelos: dict[str, dict] = {}
+_trava_modelos = threading.Lock()
+
+
+def obter_modelo(nome: str = "vgg16") -> torch.nn.Module | None:
+    """
+    Devolve o modelo registrado com esse nome, carregando-o na primeira chamada.
+    O tempo de carga e a memória ocupada ficam disponíveis em `info_modelos`.
+    :return: O modelo, ou None se a carga falhou (a falha também fica registrada e não é
+        tentada de novo).
+    """
+    if nome in _modelos:
+        return _modelos[nome]
+
+    with _trava_modelos:
+        if nome not in _modelos:
+            print(f"Carregando o modelo {nome} (dispositivo: {device})...")
+            inicio = time.perf_counter()
+            model, erro = None, None
+            try:
+                model = CONSTRUTORES[nome]()
+            except Exception as e:
+                erro = str(e)
+                print(f"Erro ao carregar o modelo VGG16 com PyTorch: {e}")
+                print("Certifique-se de que PyTorch e Torchvision estão instalados e que você tem uma conexão com a internet.")
+            segundos = time.perf_counter() - inicio
+
+            memoria = 0
+            if model is not None:
+                memoria = sum(t.numel() * t.element_size() for t in chain(model.parameters(), model.buffers()))
+                print(f"Modelo {nome} carregado em {segundos:.2f} s, ocupando {memoria / 2 ** 20:.1f} MB")
+
+            _info_modelos[nome] = {
+                "carregado": model is not None,
+                "dispositivo": str(device),
+                "segundos_carga": round(segundos, 3),
+                "memoria_mb": round(memoria / 2 ** 20, 1),
+                "erro": erro,
+            }
+            _modelos[nome] = model
+    return _modelos[nome]
+
+
+def pre_carregar_modelos(nomes: tuple[str, ...] = ("vgg16",)) -> dict[str, dict]:
+    """
+    Carrega já os modelos indicados, para que a primeira requisição não pague a carga.
+    :return: As informações de carga de cada modelo (ver `info_modelos`).
+    """
+    for nome in nomes:
+        obter_modelo(nome)
+    return {nome: _info_modelos[nome] for nome in nomes}
+
+
+def info_modelos() -> dict[str, dict]:
+    """Informações dos modelos já carregados: sucesso, dispositivo, tempo de carga e memória."""
+    return {nome: dict(info) for nome, info in _info_modelos.items()}
 
-except Exception as e:
-    print(f"Erro ao carregar o modelo VGG16 com PyTorch: {e}")
-    print("Certifique-se de que PyTorch e Torchvision estão instalados e que você tem uma conexão com a internet.")
 
 # Define a sequência de transformações para pré-processar a imagem
 # 1. Redimensiona para 224x224, o tamanho de entrada esperado pela VGG
@@ -33,11 +101,30 @@ preprocess = transforms.Compose([
     transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
 ])
 
+# Média e desvio padrão do ImageNet no formato (1, C, 1, 1), para normalizar lotes inteiros
+MEDIA_IMAGENET = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+DESVIO_IMAGENET = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+
+# Quantos fragmentos passam pela rede de uma vez em `extract_features_lote`
+TAMANHO_LOTE = 64
+
+# Reduções espaciais aplicáveis ao mapa 14x14x512 de cada fragmento: nenhuma (vetor de 100.352
+# valores) ou média global por canal (global average pooling, 512 valores)
+REDUCOES_VGG = ("nenhuma", "gap")
+# Dimensão padrão da projeção PCA e máximo de vetores usados para ajustá-la
+COMPONENTES_PCA = 64
+AMOSTRAS_PCA = 4096
+
+# Camadas até a conv4_3 (com ReLU) usadas pelos descritores densos: mapa com 512 canais e passo
+# de 8 pixels, como em Atividades/feature_matching.vgg_matching
+CAMADAS_DENSAS = 23
+
 
 def extract_features(img_array: np.ndarray) -> np.ndarray:
     """
     Extrai o vetor de características de uma imagem usando o modelo VGG16 com PyTorch.
     """
+    model = obter_modelo()
     if model is None:
         # Retorna um vetor de zeros com a dimensão esperada se o modelo falhou ao carregar
         return np.zeros(14 * 14 * 512)
@@ -59,3 +146,160 @@ def extract_features(img_array: np.ndarray) -> np.ndarray:
     # aplaina o tensor e o converte para um array numpy.
     return features.cpu().squeeze(0).flatten().numpy()
 
+
+def preprocess_lote(fragmentos: torch.Tensor) -> torch.Tensor:
+    """
+    Equivalente em operações de tensor a `preprocess`, aplicado a um lote inteiro.
+    :param fragmentos: Tensor uint8 (n, altura, largura, 3).
+    :return: Tensor float32 (n, 3, 224, 224) normalizado.
+    """
+    lote = fragmentos.permute(0, 3, 1, 2).float().div_(255.0)
+
+    # Resize(256): o menor lado vai para 256 e o maior é truncado, como no torchvision
+    altura, largura = lote.shape[2:]
+    curto, longo = min(altura, largura), max(altura, largura)
+    longo = int(256 * longo / curto)
+    tamanho = (256, longo) if altura <= largura else (longo, 256)
+    lote = F.interpolate(lote, size=tamanho, mode="bilinear", align_corners=False, antialias=True)
+
+    # CenterCrop(224), com o deslocamento arredondado como no torchvision
+    topo = int(round((tamanho[0] - 224) / 2.0))
+    esquerda = int(round((tamanho[1] - 224) / 2.0))
+    lote = lote[:, :, topo:topo + 224, esquerda:esquerda + 224]
+
+    return normalizar_lote(lote)
+
+
+def normalizar_lote(lote: torch.Tensor) -> torch.Tensor:
+    """Normaliza um lote (n, 3, altura, largura) em [0, 1] com a média e o desvio do ImageNet."""
+    return (lote - MEDIA_IMAGENET.to(lote.device)) / DESVIO_IMAGENET.to(lote.device)
+
+
+def extract_features_lote(
+        fragmentos: np.ndarray,
+        tamanho_lote: int = TAMANHO_LOTE,
+        reducao: str = "nenhuma",
+        progresso: Callable[[float], None] | None = None
+) -> np.ndarray:
+    """
+    Extrai os vetores de características de um conjunto de fragmentos de uma vez.
+    O redimensionamento e a normalização são feitos em tensores e a rede roda sobre mini-lotes;
+    só os fragmentos de cada mini-lote são copiados para o tensor.
+    :param fragmentos: Array uint8 (n, altura, largura, 3), ou um grid (h, w, altura, largura, 3)
+        (ex.: uma visão de `fragmentos_view`), em ordem de linhas.
+    :param tamanho_lote: Quantos fragmentos passam pela rede por vez.
+    :param reducao: Um de `REDUCOES_VGG`. Com "gap", cada mapa é reduzido à média por canal
+        ainda no tensor, e o vetor completo nunca é materializado.
+    :param progresso: Chamado como progresso(fracao) depois de cada mini-lote; uma exceção levantada
+        por ele interrompe a extração (ver o cancelamento em `replace`).
+    :return: Array float32 (n, 14 * 14 * 512) com as mesmas características de `extract_features`,
+        ou (n, 512) com "gap".
+    """
+    n = contar_fragmentos(fragmentos)
+    dimensao = 512 if reducao == "gap" else 14 * 14 * 512
+    model = obter_modelo()
+    if model is None:
+        return np.zeros((n, dimensao), dtype=np.float32)
+
+    features = np.empty((n, dimensao), dtype=np.float32)
+    with torch.inference_mode():
+        for inicio in range(0, n, tamanho_lote):
+            indices = np.arange(inicio, min(inicio + tamanho_lote, n))
+            lote = torch.from_numpy(np.asarray(selecionar_fragmentos(fragmentos, indices), dtype=np.uint8))
+            lote = preprocess_lote(lote.to(device))
+            mapa = model(lote)
+            mapa = mapa.mean(dim=(2, 3)) if reducao == "gap" else mapa.flatten(1)
+            features[inicio:inicio + lote.shape[0]] = mapa.cpu().numpy()
+            if progresso is not None:
+                progresso((inicio + lote.shape[0]) / n)
+    return features
+
+
+def ajustar_pca(features: np.ndarray, componentes: int = COMPONENTES_PCA) -> dict[str, np.ndarray]:
+    """
+    Ajusta uma projeção PCA aos vetores de características (no máximo `AMOSTRAS_PCA` deles,
+    sorteados). Pensada para vetores já reduzidos ("gap" ou modo denso): sobre os 100.352
+    valores completos a decomposição fica muito cara.
+    :param features: Array (n, d).
+    :param componentes: Dimensão da projeção; limitada a min(n, d).
+    :return: Dicionário com "media" (d,) e "componentes" (k, d), ambos float32.
+    """
+    features = np.asarray(features, dtype=np.float32)
+    if features.shape[0] > AMOSTRAS_PCA:
+        amostra = np.random.default_rng(0).choice(features.shape[0], AMOSTRAS_PCA, replace=False)
+        features = features[amostra]
+
+    media = features.mean(axis=0)
+    _, _, vt = np.linalg.svd(features - media, full_matrices=False)
+    return {"media": media, "componentes": np.ascontiguousarray(vt[:componentes], dtype=np.float32)}
+
+
+def salvar_pca(pca: dict[str, np.ndarray], caminho: str):
+    """
+    Salva a projeção PCA no formato .npz, exatamente em `caminho` (com um nome de arquivo,
+    np.savez acrescentaria ".npz" a um caminho sem essa extensão).
+    """
+    with open(caminho, "wb") as arquivo:
+        np.savez(arquivo, **pca)
+
+
+def carregar_pca(caminho: str) -> dict[str, np.ndarray]:
+    """Carrega uma projeção PCA salva por `salvar_pca`."""
+    with np.load(caminho) as dados:
+        return {"media": dados["media"], "componentes": dados["componentes"]}
+
+
+def projetar_pca(features: np.ndarray, pca: dict[str, np.ndarray]) -> np.ndarray:
+    """
+    Projeta os vetores de características (n, d) na base PCA.
+    :return: Array float32 (n, k).
+    """
+    if features.shape[1] != pca["media"].shape[0]:
+        raise ValueError(
+            f"A projeção PCA foi ajustada para vetores de dimensão {pca['media'].shape[0]}, "
+            f"mas os descritores têm dimensão {features.shape[1]}."
+        )
+    return (np.asarray(features, dtype=np.float32) - pca["media"]) @ pca["componentes"].T
+
+
+def matriz_similaridade_cosseno(features1: np.ndarray, features2: np.ndarray) -> np.ndarray:
+    """
+    Similaridade de cosseno entre todos os pares, com uma única multiplicação de matrizes.
+    Os vetores devem estar normalizados; vetores em float16 são promovidos a float32.
+    :param features1: Array (n1, d).
+    :param features2: Array (n2, d).
+    :return: Matriz float32 (n1, n2).
+    """
+    return np.asarray(features1, dtype=np.float32) @ np.asarray(features2, dtype=np.float32).T
+
+
+def extract_features_densas(img: np.ndarray, grade: tuple[int, int]) -> np.ndarray:
+    """
+    Extrai um vetor de características por fragmento com uma única passada da rede sobre a
+    imagem inteira, na resolução original. O mapa denso da conv4_3 (passo de 8 pixels) é
+    agrupado por média sobre a área que cada fragmento ocupa.
+    Se o lado do fragmento não é múltiplo de 8, a imagem é antes redimensionada para que cada
+    fragmento cubra um número inteiro de posições do mapa e todos os grupos tenham o mesmo tamanho.
+    :param img: Imagem uint8 (altura, largura, 3) formada pelo grid de fragmentos.
+    :param grade: Número de fragmentos (linhas, colunas) do grid.
+    :return: Array float32 (linhas * colunas, 512), na mesma ordem dos fragmentos achatados.
+    """
+    n = grade[0] * grade[1]
+    model = obter_modelo()
+    if model is None:
+        return np.zeros((n, 512), dtype=np.float32)
+
+    # Posições do mapa (passo de 8 pixels) sob cada fragmento, em cada eixo
+    celulas = tuple(max(1, round(img.shape[eixo] / grade[eixo] / 8)) for eixo in (0, 1))
+    tamanho = (grade[0] * celulas[0] * 8, grade[1] * celulas[1] * 8)
+
+    imagem = torch.from_numpy(np.ascontiguousarray(img, dtype=np.uint8)).to(device)
+    lote = imagem.permute(2, 0, 1).unsqueeze(0).float().div_(255.0)
+    if lote.shape[2:] != tamanho:
+        lote = F.interpolate(lote, size=tamanho, mode="bilinear", align_corners=False, antialias=True)
+    lote = normalizar_lote(lote)
+    with torch.inference_mode():
+        mapa = model[:CAMADAS_DENSAS](lote)
+        # Cada célula de saída é a média exata das celulas[0] × celulas[1] posições sob um fragmento
+        mapa = F.avg_pool2d(mapa, celulas)
+    return np.ascontiguousarray(mapa.squeeze(0).flatten(1).t().cpu().numpy())
@@ -1,4 +1,5 @@
 import io
+import numbers
 import os
 from typing import NewType
 
@@ -11,6 +12,9 @@ ImageType = NewType('ImageType', np.ndarray[np.uint8])  # Uma imagem completa
 Fragment = NewType('Fragment', np.ndarray[np.uint8])  # Um único fragmento (ex: 16x16x3)
 FragmentGrid = NewType('FragmentGrid', np.ndarray[np.uint8])  # Grid de fragmentos: (N, M, 16, 16, 3)
 
+# Políticas para as bordas que não completam um fragmento (ver `fragmentos_view`)
+POLITICAS_BORDA = ("recortar", "preencher", "replicar")
+
 
 def LoadImage(img_path: str) -> ImageType:
     """
@@ -23,16 +27,76 @@ def LoadImage(img_path: str) -> ImageType:
         return np.array(img)
 
 
-def FromWeb(img: UploadFile) -> ImageType:
+def ReadUpload(img: UploadFile, max_bytes: int | None = None) -> bytes:
+    """
+    Reads a web upload into memory, reading at most one byte past the limit.
+    :param img: The uploaded file.
+    :param max_bytes: Maximum accepted size; a larger upload raises ValueError.
+    :return: The bytes of the uploaded file.
+    """
+    dados = img.file.read() if max_bytes is None else img.file.read(max_bytes + 1)
+    if max_bytes is not None and len(dados) > max_bytes:
+        raise ValueError(f"'{img.filename}' passa do limite de {max_bytes} bytes.")
+    return dados
+
+
+def ImageSize(dados: bytes, max_pixels: int | None = None) -> tuple[int, int]:
+    """
+    Reads only the header of an encoded image, without decoding the pixels.
+    :param dados: The bytes of the image file.
+    :param max_pixels: Maximum accepted width * height; a larger image raises ValueError.
+    :return: (width, height).
+    """
+    with Image.open(io.BytesIO(dados)) as img:
+        largura, altura = img.size
+    if max_pixels is not None and largura * altura > max_pixels:
+        raise ValueError(f"Imagem de {largura}x{altura} passa do limite de {max_pixels} pixels.")
+    return largura, altura
+
+
+def FromBytes(
+        dados: bytes,
+        max_pixels: int | None = None,
+        tamanho_fragmento: int | None = None,
+        max_fragmentos: int | None = None
+) -> ImageType:
+    """
+    Decodes an image held in memory using Pillow, optionally downscaling it while decoding.
+    :param dados: The bytes of the image file.
+    :param max_pixels: Maximum accepted width * height of the encoded image (see `ImageSize`).
+    :param tamanho_fragmento: Fragment side used with `max_fragmentos`.
+    :param max_fragmentos: If the image holds more whole fragments than this, it is scaled down
+        (keeping the aspect ratio, except that a side is never made thinner than one fragment) to
+        at most this many. JPEGs are decoded straight at a reduced DCT scale (draft mode) and the
+        remainder uses an integer reduce step before the final resample, so a large photo is
+        never decoded at full resolution.
+    :return: The decoded RGB image as a numpy array.
+    """
+    ImageSize(dados, max_pixels)
+    with Image.open(io.BytesIO(dados)) as img:
+        if max_fragmentos is not None and tamanho_fragmento is not None:
+            largura, altura = img.size
+            escala = (max_fragmentos * tamanho_fragmento ** 2 / (largura * altura)) ** 0.5
+            if escala < 1:
+                # Com a escala real (não a contagem truncada), o grid reduzido nunca passa do limite
+                alvo_l = min(largura, max(tamanho_fragmento, int(largura * escala)))
+                alvo_a = min(altura, max(tamanho_fragmento, int(altura * escala)))
+                # Numa imagem fina o lado menor sobe até um fragmento; o outro encolhe para compensar
+                alvo_l = min(alvo_l, max(1, max_fragmentos // max(1, alvo_a // tamanho_fragmento)) * tamanho_fragmento)
+                alvo_a = min(alvo_a, max(1, max_fragmentos // max(1, alvo_l // tamanho_fragmento)) * tamanho_fragmento)
+                img.draft("RGB", (alvo_l, alvo_a))
+                img = img.resize((alvo_l, alvo_a), reducing_gap=2.0)
+        return np.array(img.convert('RGB'))
+
+
+def FromWeb(img: UploadFile, max_bytes: int | None = None, **kwargs) -> ImageType:
     """
-    Converts an image from a web upload to a numpy array using Pillow.
+    Converts an image from a web upload to a numpy array in memory, using `ReadUpload` and
+    `FromBytes` (whose keyword arguments are accepted).
     :param img: The image to convert.
     :return: The converted image as a numpy array.
     """
-    image_data = io.BytesIO(img.file.read())
-    with Image.open(image_data) as img:
-        img = img.convert('RGB')
-        return np.array(img)
+    return FromBytes(ReadUpload(img, max_bytes), **kwargs)
 
 
 def SaveImage(img: ImageType, output_path: str):
@@ -44,6 +108,23 @@ def SaveImage(img: ImageType, output_path: str):
     Image.fromarray(img).save(output_path)
 
 
+def EncodeImage(img: ImageType, formato: str = "PNG", nivel: int | None = None) -> bytes:
+    """
+    Encodes the image in memory using Pillow.
+    :param img: The image to encode as a numpy array.
+    :param formato: A Pillow format name (e.g. "PNG", "WEBP", "JPEG").
+    :param nivel: PNG compression level (0-9, lower is faster) or JPEG/WebP quality (1-100).
+        None uses Pillow's default.
+    :return: The bytes of the encoded file.
+    """
+    opcoes = {}
+    if nivel is not None:
+        opcoes = {"compress_level": nivel} if formato.upper() == "PNG" else {"quality": nivel}
+    buffer = io.BytesIO()
+    Image.fromarray(img).save(buffer, format=formato, **opcoes)
+    return buffer.getvalue()
+
+
 @njit
 def get_fragmentos(img: ImageType, fragmentos_size: int) -> FragmentGrid:
     """
@@ -65,6 +146,53 @@ def get_fragmentos(img: ImageType, fragmentos_size: int) -> FragmentGrid:
     return kernels
 
 
+def fragmentos_view(
+        img: ImageType,
+        altura: int,
+        largura: int | None = None,
+        passo: int | tuple[int, int] | None = None,
+        borda: str = "recortar",
+        valor_preenchimento: int = 0
+) -> FragmentGrid:
+    """
+    Extrai o grid de fragmentos como uma visão da imagem (numpy.lib.stride_tricks), sem copiar
+    pixels. Com passo igual ao tamanho e borda "recortar", o resultado é igual ao de
+    `get_fragmentos`.
+    :param img: A imagem (H, W, 3).
+    :param altura: Altura de cada fragmento.
+    :param largura: Largura de cada fragmento (padrão: igual à altura).
+    :param passo: Deslocamento entre fragmentos vizinhos, um inteiro ou (vertical, horizontal).
+        Menor que o tamanho gera fragmentos sobrepostos. Padrão: o próprio tamanho.
+    :param borda: O que fazer quando a imagem não é coberta por um número inteiro de passos:
+        "recortar" descarta a sobra (uma imagem menor que o fragmento levanta ValueError);
+        "preencher" completa com `valor_preenchimento` e "replicar" repete os pixels da borda. Os
+        dois últimos copiam a imagem uma vez para o preenchimento.
+    :return: Visão somente leitura (N, M, altura, largura, 3).
+    """
+    if borda not in POLITICAS_BORDA:
+        raise ValueError(f"Política de borda '{borda}' inválida. Use uma de {POLITICAS_BORDA}.")
+    largura = largura or altura
+    passo_v, passo_h = (passo, passo) if isinstance(passo, numbers.Integral) else (passo or (altura, largura))
+
+    h, w, _ = img.shape
+    if borda == "recortar" and (h < altura or w < largura):
+        raise ValueError(
+            f"Imagem de {w}x{h} menor que o fragmento de {largura}x{altura}; use outra política de borda."
+        )
+    if borda != "recortar":
+        falta_v = (-(h - altura) % passo_v) if h > altura else altura - h
+        falta_h = (-(w - largura) % passo_h) if w > largura else largura - w
+        if falta_v or falta_h:
+            pad = ((0, falta_v), (0, falta_h), (0, 0))
+            if borda == "preencher":
+                img = np.pad(img, pad, constant_values=valor_preenchimento)
+            else:
+                img = np.pad(img, pad, mode="edge")
+
+    janelas = np.lib.stride_tricks.sliding_window_view(img, (altura, largura, img.shape[2]))
+    return janelas[::passo_v, ::passo_h, 0]
+
+
 def save_fragmentos(fragmentos: FragmentGrid, output_dir: str):
     """
     Saves the fragmentos to the output directory using Pillow.
@@ -80,19 +208,121 @@ def save_fragmentos(fragmentos: FragmentGrid, output_dir: str):
             Image.fromarray(kernel).save(filename)
 
 
-@njit
-def img_from_fragmentos(fragmentos: FragmentGrid) -> ImageType:
+def blocos_da_imagem(img: ImageType, altura: int, largura: int) -> FragmentGrid:
     """
-    Reconstructs the image from the fragmentos.
+    Visão (N, M, altura, largura, c) de uma imagem C-contígua, com um bloco por fragmento.
+    Escrever na visão escreve direto na imagem.
+    """
+    if not img.flags.c_contiguous:
+        raise ValueError("A imagem precisa ser C-contígua para ser vista como blocos.")
+    h, w, c = img.shape
+    return img.reshape((h // altura, altura, w // largura, largura, c)).swapaxes(1, 2)
+
+
+def como_grade(fragmentos: np.ndarray) -> FragmentGrid:
+    """
+    Vê fragmentos achatados (n, fh, fw, c) como um grid (1, n, fh, fw, c), sem cópia; um grid
+    (h, w, fh, fw, c) volta como está. Os kernels de custo leem o fragmento k de um grid como
+    grid[k // w, k % w], o que vale para as duas formas.
+    """
+    return fragmentos[None] if fragmentos.ndim == 4 else fragmentos
+
+
+def contar_fragmentos(fragmentos: np.ndarray) -> int:
+    """Número de fragmentos de um grid (h, w, fh, fw, c) ou de fragmentos achatados (n, fh, fw, c)."""
+    return int(np.prod(fragmentos.shape[:-3]))
+
+
+def selecionar_fragmentos(fragmentos: np.ndarray, indices: np.ndarray) -> np.ndarray:
+    """
+    Copia só os fragmentos pedidos de um grid (ou de fragmentos achatados).
+    :param indices: Índices dos fragmentos, em ordem de linhas do grid.
+    :return: Array (len(indices), fh, fw, c).
+    """
+    grade = como_grade(fragmentos)
+    return grade[indices // grade.shape[1], indices % grade.shape[1]]
+
+
+def imagem_da_grade(fragmentos: FragmentGrid) -> ImageType:
+    """
+    Imagem coberta pelo grid. Se o grid é uma visão lado a lado de uma imagem (ex.:
+    `fragmentos_view` com passo igual ao tamanho), devolve uma visão somente leitura dessa imagem,
+    sem cópia; senão, monta a imagem com `img_from_fragmentos`.
+    """
+    h, w, fh, fw, c = fragmentos.shape
+    passos = fragmentos.strides
+    if passos[0] == fh * passos[2] and passos[1] == fw * passos[3]:
+        return np.lib.stride_tricks.as_strided(fragmentos, (h * fh, w * fw, c), passos[2:], writeable=False)
+    return img_from_fragmentos(fragmentos)
+
+
+def img_from_fragmentos(fragmentos: FragmentGrid, out: ImageType | None = None) -> ImageType:
+    """
+    Reconstructs the image from the fragmentos with a single reshape/transpose copy.
     :param fragmentos: The fragmentos to reconstruct the image from.
-    :return: The reconstructed image.
+    :param out: Optional C-contiguous buffer (N * fh, M * fw, c) to write the image into.
+    :return: The reconstructed image (`out`, when given).
+    """
+    height, width, fh, fw, c = fragmentos.shape
+    if out is None:
+        out = np.empty((height * fh, width * fw, c), dtype=fragmentos.dtype)
+    blocos_da_imagem(out, fh, fw)[...] = fragmentos
+    return out
+
+
+@njit(cache=True)
+def _copiar_fragmentos(grade, indices, blocos, bgr):
+    """
+    Copia o fragmento `indices[k]` do grid para o bloco k da imagem, pixel a pixel, sem montar
+    uma cópia intermediária dos fragmentos coletados. Com `bgr`, inverte os canais na mesma passada.
+    """
+    w = grade.shape[1]
+    colunas = blocos.shape[1]
+    fh, fw, c = grade.shape[2], grade.shape[3], grade.shape[4]
+    for k in range(indices.shape[0]):
+        origem = grade[indices[k] // w, indices[k] % w]
+        destino = blocos[k // colunas, k % colunas]
+        for y in range(fh):
+            for x in range(fw):
+                for canal in range(c):
+                    destino[y, x, canal] = origem[y, x, c - 1 - canal if bgr else canal]
+
+
+def reconstruir_imagem(
+        fragmentos: np.ndarray,
+        indices: np.ndarray,
+        grade: tuple[int, int],
+        out: ImageType | None = None,
+        bgr: bool = False
+) -> ImageType:
+    """
+    Monta a imagem em que a posição k do grid recebe o fragmento `indices[k]`, copiando cada
+    fragmento direto do grid para o seu bloco na imagem (ver `_copiar_fragmentos`).
+    :param fragmentos: Grid (h, w, fh, fw, 3) ou fragmentos achatados (n, fh, fw, 3) de onde os
+        blocos são tirados.
+    :param indices: Índice do fragmento de cada posição do grid, em ordem de linhas (ex.: `col_ind`).
+    :param grade: Número de fragmentos (linhas, colunas) da imagem de saída.
+    :param out: Buffer C-contíguo uint8 (linhas * fh, colunas * fw, 3) a preencher, por exemplo
+        o quadro de um codificador de vídeo. Se None, um novo array é alocado.
+    :param bgr: Escreve os canais na ordem BGR (a do OpenCV) na mesma passada.
+    :return: A imagem montada (`out`, quando fornecido).
     """
-    height, width, fragmentos_size, _, _ = fragmentos.shape
-    img = np.zeros((height * fragmentos_size, width * fragmentos_size, 3), dtype=np.uint8)
+    linhas, colunas = grade
+    fh, fw, c = fragmentos.shape[-3:]
+    forma = (linhas * fh, colunas * fw, c)
+    if out is None:
+        out = np.empty(forma, dtype=np.uint8)
+    elif out.dtype != np.uint8:
+        raise ValueError(f"O buffer de saída tem tipo {out.dtype}, mas a imagem montada é uint8.")
+    elif out.shape != forma:
+        raise ValueError(f"O buffer de saída tem forma {out.shape}, mas a imagem montada tem {forma}.")
 
-    for i in range(height):
-        for j in range(width):
-            img[i * fragmentos_size:(i + 1) * fragmentos_size, j * fragmentos_size:(j + 1) * fragmentos_size] = \
-                fragmentos[i][j]
+    # O laço compilado não confere limites: índices fora do grid são recusados aqui
+    indices = np.asarray(indices, dtype=np.int64)
+    if indices.shape != (linhas * colunas,):
+        raise ValueError(f"Esperados {linhas * colunas} índices (um por posição do grid), não {indices.shape}.")
+    if indices.size and (indices.min() < 0 or indices.max() >= contar_fragmentos(fragmentos)):
+        raise ValueError("Há índices fora do intervalo de fragmentos.")
 
-    return img
\ No newline at end of file
+    _copiar_fragmentos(como_grade(fragmentos), indices, blocos_da_imagem(out, fh, fw), bgr)
+    return out
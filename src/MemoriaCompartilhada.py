@@ -0,0 +1,57 @@
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# Descrição de um array compartilhado: (nome do bloco, forma, dtype)
+EspecArray = tuple[str, tuple[int, ...], str]
+
+
+def compartilhar_arrays(arrays: dict[str, np.ndarray]) -> tuple[list[SharedMemory], dict[str, EspecArray]]:
+    """
+    Copia cada array para um bloco de memória compartilhada.
+    O processo que chama é o dono dos blocos e deve liberá-los com `liberar_arrays`.
+    :param arrays: Arrays a compartilhar, por nome.
+    :return: Tupla (blocos, especificações). As especificações são pequenas e podem ser
+        enviadas aos workers, que as usam em `anexar_arrays`.
+    """
+    blocos = []
+    specs = {}
+    for nome, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        bloco = SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=bloco.buf)[...] = array
+        blocos.append(bloco)
+        specs[nome] = (bloco.name, array.shape, array.dtype.str)
+    return blocos, specs
+
+
+def anexar_arrays(
+        specs: dict[str, EspecArray],
+        somente_leitura: bool = True
+) -> tuple[dict[str, np.ndarray], list[SharedMemory]]:
+    """
+    Anexa os arrays criados por `compartilhar_arrays` em outro processo.
+    Os blocos retornados devem ser mantidos vivos enquanto os arrays forem usados.
+    :param specs: Especificações retornadas por `compartilhar_arrays`.
+    :param somente_leitura: Se False, os arrays podem ser escritos (ex.: buffers de saída).
+    :return: Tupla (arrays por nome, blocos anexados).
+    """
+    arrays = {}
+    blocos = []
+    for nome, (nome_bloco, forma, dtype) in specs.items():
+        bloco = SharedMemory(name=nome_bloco)
+        array = np.ndarray(forma, dtype=np.dtype(dtype), buffer=bloco.buf)
+        array.flags.writeable = not somente_leitura
+        arrays[nome] = array
+        blocos.append(bloco)
+    return arrays, blocos
+
+
+def liberar_arrays(blocos: list[SharedMemory]):
+    """
+    Fecha e remove os blocos de memória compartilhada criados por `compartilhar_arrays`.
+    :param blocos: Blocos a liberar.
+    """
+    for bloco in blocos:
+        bloco.close()
+        bloco.unlink()
@@ -0,0 +1,365 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+import numba
+import numpy as np
+import torch
+
+from src.Features.VGG import info_modelos
+from src.Fragmentos import FromBytes, fragmentos_view
+from src.Replace import replace, METRICAS
+from src.Tarefas import publicar, TarefaCancelada
+
+# Tempo máximo, em segundos, que o encerramento espera cada worker terminar
+TIMEOUT_ENCERRAMENTO = 5.0
+# Threads que rodam o `ao_concluir` (codificação e gravação do resultado) fora da thread leitora,
+# para que uma tarefa salvando não atrase as mensagens das outras
+THREADS_FINALIZACAO = 2
+
+# Estado do pool no processo do servidor; só é alterado com `_trava`
+_pool: dict = {}
+_trava = threading.Lock()
+
+
+def aquecer_kernels(pre_carregar_vgg: bool):
+    """
+    Roda o `replace` sobre imagens sintéticas pequenas com cada combinação de métrica e espaço de
+    cor que o servidor usa, para que o numba compile (para os tipos de entrada reais) todos os
+    kernels antes da primeira tarefa. Com `pre_carregar_vgg`, carrega a VGG16 e inclui o termo VGG.
+    """
+    rng = np.random.default_rng(0)
+    img_1 = rng.integers(0, 256, (32, 32, 3), dtype=np.uint8)
+    img_2 = rng.integers(0, 256, (32, 32, 3), dtype=np.uint8)
+    pesos = (1.0, 0.0, 1.0, 1.0)
+    if pre_carregar_vgg:
+        from src.Features.VGG import pre_carregar_modelos
+        if pre_carregar_modelos()["vgg16"]["carregado"]:
+            pesos = (1.0, 1.0, 1.0, 1.0)
+
+    for metrica in METRICAS:
+        for yuv in (False, True):
+            replace(fragmentos_view(img_1, 8), fragmentos_view(img_2, 8), weights=pesos, yuv=yuv, metrica=metrica)
+
+
+def renderizar(
+        receptora: bytes,
+        doadora: bytes,
+        tamanho: int,
+        max_pixels: int | None = None,
+        max_fragmentos: int | None = None,
+        **kwargs
+) -> np.ndarray:
+    """
+    Corpo de uma tarefa: decodifica em memória os arquivos das duas imagens (reduzidas a no máximo
+    `max_fragmentos` fragmentos cada, ver `FromBytes`), fragmenta e chama o `replace`.
+    """
+    fragmentos_1 = fragmentos_view(FromBytes(receptora, max_pixels, tamanho, max_fragmentos), tamanho)
+    fragmentos_2 = fragmentos_view(FromBytes(doadora, max_pixels, tamanho, max_fragmentos), tamanho)
+    return replace(fragmentos_1, fragmentos_2, **kwargs)
+
+
+def worker_replace(indice, tarefas, resultados, cancelamento, pre_carregar_vgg, threads):
+    """
+    Laço de um worker: limita as threads do numba e do torch à sua parte dos núcleos, aquece os
+    kernels, avisa que está pronto (com o tempo de aquecimento e os modelos que carregou) e então
+    atende (id, argumentos de `renderizar`) até receber None. O progresso e o resultado voltam como
+    mensagens (tipo, índice, id, dados) na fila de resultados. `cancelamento` guarda o id de uma
+    tarefa a interromper na próxima chamada de progresso. Se o aquecimento falha, o worker avisa e termina.
+    """
+    numba.set_num_threads(threads)
+    torch.set_num_threads(threads)
+
+    inicio = time.perf_counter()
+    try:
+        aquecer_kernels(pre_carregar_vgg)
+    except Exception as e:
+        resultados.put(("falha_aquecimento", indice, None, f"{type(e).__name__}: {e}"))
+        return
+    resultados.put(("pronto", indice, None, (round(time.perf_counter() - inicio, 3), info_modelos())))
+
+    while (item := tarefas.get()) is not None:
+        id_tarefa, argumentos = item
+
+        def progresso(etapa: str, fracao: float):
+            resultados.put(("progresso", indice, id_tarefa, (etapa, fracao)))
+            if cancelamento.value == id_tarefa.encode():
+                raise TarefaCancelada()
+
+        try:
+            img = renderizar(**argumentos, progresso=progresso)
+            resultados.put(("concluida", indice, id_tarefa, img))
+        except TarefaCancelada:
+            resultados.put(("cancelada", indice, id_tarefa, None))
+        except Exception as e:
+            resultados.put(("erro", indice, id_tarefa, str(e)))
+
+
+def iniciar_pool(
+        processos: int,
+        max_fila: int,
+        pre_carregar_vgg: bool = True,
+        ao_concluir: Callable[[dict, np.ndarray], None] | None = None
+):
+    """
+    Sobe `processos` workers (contexto spawn) que aquecem os kernels em paralelo com o resto da
+    inicialização do servidor, e uma thread que despacha as tarefas e recebe as mensagens deles.
+    Cada worker roda uma tarefa por vez, então `processos` é o limite de concorrência.
+    :param max_fila: Máximo de tarefas esperando um worker livre; além disso `fila_cheia` é True.
+    :param ao_concluir: Chamado como ao_concluir(tarefa, imagem), numa das `THREADS_FINALIZACAO`
+        threads de finalização, com a imagem de cada tarefa concluída, antes de a tarefa ser
+        marcada como concluída. O worker já volta aos livres enquanto ele roda.
+    """
+    contexto = multiprocessing.get_context("spawn")
+    threads = max(1, (os.cpu_count() or 1) // processos)
+    _pool.update(
+        contexto=contexto,
+        pre_carregar_vgg=pre_carregar_vgg,
+        threads=threads,
+        ao_concluir=ao_concluir,
+        finalizacao=ThreadPoolExecutor(max_workers=THREADS_FINALIZACAO, thread_name_prefix="finalizacao"),
+        max_fila=max_fila,
+        resultados=contexto.Queue(),
+        filas=[contexto.Queue() for _ in range(processos)],
+        # Um id de tarefa hexadecimal (32 caracteres) por worker
+        cancelamentos=[contexto.Array("c", 32) for _ in range(processos)],
+        workers=[None] * processos,
+        livres=set(),
+        em_execucao={},
+        pendentes=deque(),
+        segundos_aquecimento={},
+        modelos={},
+        erro=None,
+        ativo=True,
+    )
+    for indice in range(processos):
+        _iniciar_worker(indice)
+    _pool["leitor"] = threading.Thread(target=_ler_resultados, daemon=True)
+    _pool["leitor"].start()
+
+
+def _iniciar_worker(indice: int):
+    worker = _pool["contexto"].Process(
+        target=worker_replace,
+        args=(indice, _pool["filas"][indice], _pool["resultados"], _pool["cancelamentos"][indice],
+              _pool["pre_carregar_vgg"], _pool["threads"]),
+        daemon=True
+    )
+    worker.start()
+    _pool["workers"][indice] = worker
+
+
+def encerrar_pool():
+    """
+    Cancela as tarefas na fila e em execução, pede a cada worker que termine, espera um pouco e
+    encerra os que não terminaram.
+    """
+    with _trava:
+        if not _pool.get("ativo"):
+            return
+        _pool["ativo"] = False
+        for tarefa, _ in _pool["pendentes"]:
+            publicar(tarefa, tarefa["etapa"], tarefa["fracao"], estado="cancelada")
+        _pool["pendentes"].clear()
+        for indice, tarefa in _pool["em_execucao"].items():
+            _pool["cancelamentos"][indice].value = tarefa["id"].encode()
+            publicar(tarefa, tarefa["etapa"], tarefa["fracao"], estado="cancelada")
+        _pool["em_execucao"].clear()
+
+    for fila in _pool["filas"]:
+        fila.put(None)
+    for worker in _pool["workers"]:
+        if worker is None:
+            continue
+        worker.join(timeout=TIMEOUT_ENCERRAMENTO)
+        if worker.is_alive():
+            worker.terminate()
+    _pool["leitor"].join(timeout=TIMEOUT_ENCERRAMENTO)
+    # Deixa terminar as gravações de resultados já iniciadas
+    _pool["finalizacao"].shutdown(wait=True)
+    for fila in _pool["filas"] + [_pool["resultados"]]:
+        fila.close()
+
+
+def pool_ativo() -> bool:
+    """False antes de `iniciar_pool`, depois de `encerrar_pool` ou se um worker falhou no aquecimento."""
+    return bool(_pool.get("ativo")) and _pool.get("erro") is None
+
+
+def fila_cheia() -> bool:
+    return len(_pool["pendentes"]) >= _pool["max_fila"]
+
+
+def submeter(tarefa: dict, argumentos: dict):
+    """
+    Põe a tarefa na fila do pool; ela vai para o primeiro worker pronto e livre.
+    :param argumentos: Argumentos de `renderizar` (arquivos das imagens, tamanho e opções do `replace`).
+    """
+    with _trava:
+        if _pool["erro"] is not None:
+            publicar(tarefa, tarefa["etapa"], tarefa["fracao"], estado="erro", erro=_pool["erro"])
+            return
+        _pool["pendentes"].append((tarefa, argumentos))
+        _despachar()
+
+
+def cancelar(tarefa: dict):
+    """
+    Tira a tarefa da fila, se ainda não começou, ou avisa o worker que a executa, que a
+    interrompe na próxima chamada de progresso do `replace` (ver o parâmetro `progresso` dele).
+    """
+    with _trava:
+        for item in _pool["pendentes"]:
+            if item[0] is tarefa:
+                _pool["pendentes"].remove(item)
+                publicar(tarefa, tarefa["etapa"], tarefa["fracao"], estado="cancelada")
+                return
+        for indice, em_execucao in _pool["em_execucao"].items():
+            if em_execucao is tarefa:
+                _pool["cancelamentos"][indice].value = tarefa["id"].encode()
+
+
+def info_pool() -> dict:
+    """
+    Workers prontos, ocupados, tarefas na fila, tempo de aquecimento de cada worker e o erro que
+    deixou o pool indisponível, se houver.
+    """
+    with _trava:
+        return {
+            "ativo": pool_ativo(),
+            "erro": _pool.get("erro"),
+            "processos": len(_pool.get("workers", [])),
+            "threads_por_processo": _pool.get("threads"),
+            "livres": len(_pool.get("livres", ())),
+            "ocupados": len(_pool.get("em_execucao", {})),
+            "na_fila": len(_pool.get("pendentes", ())),
+            "max_fila": _pool.get("max_fila"),
+            "segundos_aquecimento": dict(_pool.get("segundos_aquecimento", {})),
+        }
+
+
+def modelos_pool() -> dict[int, dict]:
+    """Informações dos modelos carregados em cada worker (ver `info_modelos`), informadas quando ele fica pronto."""
+    with _trava:
+        return {indice: dict(modelos) for indice, modelos in _pool.get("modelos", {}).items()}
+
+
+def _despachar():
+    """Entrega tarefas da fila aos workers livres. Chamada com `_trava`."""
+    while _pool["livres"] and _pool["pendentes"]:
+        tarefa, argumentos = _pool["pendentes"].popleft()
+        indice = _pool["livres"].pop()
+        _pool["em_execucao"][indice] = tarefa
+        _pool["cancelamentos"][indice].value = b""
+        publicar(tarefa, "iniciando", 0.0, estado="executando")
+        _pool["filas"][indice].put((tarefa["id"], argumentos))
+
+
+def _ler_resultados():
+    """
+    Thread do servidor que recebe as mensagens dos workers: registra o progresso nas tarefas,
+    entrega a imagem das concluídas às threads de finalização (ver `_finalizar`) e devolve o
+    worker aos livres. A cada volta
+    verifica os workers: um que morre é substituído, e a tarefa que ele executava termina com erro.
+    Um worker que falha no aquecimento deixa o pool indisponível (ver `_marcar_indisponivel`).
+    """
+    while _pool["ativo"]:
+        _substituir_mortos()
+        try:
+            tipo, indice, id_tarefa, dados = _pool["resultados"].get(timeout=1.0)
+        except queue.Empty:
+            continue
+
+        if tipo == "pronto":
+            segundos, modelos = dados
+            print(f"Worker {indice} pronto em {segundos:.1f} s")
+            with _trava:
+                _pool["segundos_aquecimento"][indice] = segundos
+                _pool["modelos"][indice] = modelos
+                _pool["livres"].add(indice)
+                _despachar()
+            continue
+        if tipo == "falha_aquecimento":
+            with _trava:
+                _marcar_indisponivel(f"O worker {indice} falhou no aquecimento: {dados}")
+            continue
+
+        tarefa = _pool["em_execucao"].get(indice)
+        if tarefa is None or tarefa["id"] != id_tarefa:
+            continue
+        if tipo == "progresso":
+            publicar(tarefa, *dados)
+            continue
+
+        if tipo == "concluida":
+            _pool["finalizacao"].submit(_finalizar, tarefa, dados)
+        elif tipo == "cancelada":
+            print(f"Tarefa {id_tarefa} cancelada.")
+            publicar(tarefa, tarefa["etapa"], tarefa["fracao"], estado="cancelada")
+        else:
+            print(f"Erro na tarefa {id_tarefa}: {dados}")
+            publicar(tarefa, tarefa["etapa"], tarefa["fracao"], estado="erro", erro=dados)
+
+        with _trava:
+            del _pool["em_execucao"][indice]
+            _pool["livres"].add(indice)
+            _despachar()
+
+
+def _finalizar(tarefa: dict, imagem: np.ndarray):
+    """Roda o `ao_concluir` de uma tarefa concluída (numa thread de finalização) e a publica."""
+    try:
+        if _pool["ao_concluir"] is not None:
+            publicar(tarefa, "salvando", 0.99)
+            _pool["ao_concluir"](tarefa, imagem)
+        publicar(tarefa, "concluida", 1.0, estado="concluida")
+    except Exception as e:
+        print(f"Erro ao salvar a tarefa {tarefa['id']}: {e}")
+        publicar(tarefa, tarefa["etapa"], tarefa["fracao"], estado="erro", erro=str(e))
+
+
+def _substituir_mortos():
+    """
+    Substitui os workers que morreram. Um que morre ainda no aquecimento (nem livre nem
+    ocupado) não é substituído, já que o substituto falharia do mesmo jeito: o pool fica
+    indisponível. Depois disso nenhum worker é substituído.
+    """
+    with _trava:
+        if not _pool["ativo"]:
+            return
+        for indice, worker in enumerate(_pool["workers"]):
+            if worker is None or worker.is_alive():
+                continue
+            if indice not in _pool["livres"] and indice not in _pool["em_execucao"]:
+                _marcar_indisponivel(f"O worker {indice} terminou durante o aquecimento (código {worker.exitcode})")
+                _pool["workers"][indice] = None
+                continue
+
+            _pool["livres"].discard(indice)
+            tarefa = _pool["em_execucao"].pop(indice, None)
+            if tarefa is not None:
+                publicar(tarefa, tarefa["etapa"], tarefa["fracao"], estado="erro", erro="O worker terminou inesperadamente")
+            if _pool["erro"] is not None:
+                _pool["workers"][indice] = None
+                continue
+            print(f"Worker {indice} terminou inesperadamente (código {worker.exitcode}); iniciando outro")
+            _iniciar_worker(indice)
+
+
+def _marcar_indisponivel(erro: str):
+    """
+    Chamada com `_trava`: registra o erro que deixa o pool indisponível (`pool_ativo` passa a ser
+    False e o servidor responde 503) e termina com esse erro as tarefas que esperavam na fila.
+    Só o primeiro erro é guardado.
+    """
+    if _pool["erro"] is None:
+        print(f"Pool de workers indisponível: {erro}")
+        _pool["erro"] = erro
+    for tarefa, _ in _pool["pendentes"]:
+        publicar(tarefa, tarefa["etapa"], tarefa["fracao"], estado="erro", erro=_pool["erro"])
+    _pool["pendentes"].clear()
@@ -1,119 +1,944 @@
+import atexit
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+from collections.abc import Callable
+from concurrent.futures import Executor, ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+
 import numpy as np
 from numba import prange, njit, cuda
-import lap
 from tqdm import tqdm
 
-from src.Features.Dif import comp_imgs_dif, covert_to_YUV, cu_comp_imgs_dif
-from src.Features.Edge import sobel, comp_sobel_dif, cu_comp_sobel_dif
-from src.Features.MediaCor import comp_imgs_media_cor, cu_comp_imgs_media_cor
-from src.Features.VGG import extract_features
-from src.Fragmentos import Image, FragmentGrid
+from src.MemoriaCompartilhada import compartilhar_arrays, anexar_arrays, liberar_arrays
+from src.CacheDescritores import hash_grid, chave_descritor, descritor_em_cache
+from src.Atribuicao import descritores_compactos, candidatos_knn, completar_emparelhamento, resolver_esparso, \
+    particionar_por_luminancia, resolver_denso, resolver_denso_sem_copia, resolver_incremental
+from src.Features.Dif import comp_imgs_dif, comp_imgs_dif_l2, cu_comp_imgs_dif, matriz_similaridade_l2, \
+    preparar_l2, converter_espaco_cor, amplitude_cor, ESPACOS_COR
+from src.Features.Edge import sobel, sobel_imagem, comp_sobel_dif, cu_comp_sobel_dif
+from src.Features.MediaCor import medias_fragmentos, matriz_similaridade_media_cor
+from src.Features.VGG import extract_features_lote, extract_features_densas, REDUCOES_VGG, ajustar_pca, \
+    salvar_pca, carregar_pca, projetar_pca, matriz_similaridade_cosseno
+from src.Fragmentos import Image, FragmentGrid, fragmentos_view, reconstruir_imagem, como_grade, contar_fragmentos, \
+    selecionar_fragmentos, imagem_da_grade
+
+# Descritores calculados para cada conjunto de fragmentos (ver `calcular_descritores`)
+DESCRITORES = ("fragmentos", "cor", "vgg", "sobel", "medias")
+# Métricas disponíveis para o termo de diferença de imagens
+METRICAS = ("l1", "l2")
+# Modos de resolução do problema de atribuição
+ATRIBUICOES = ("densa", "esparsa", "clusters", "incremental")
+# Modos de extração dos descritores VGG: um fragmento por vez ou uma passada densa na imagem toda
+MODOS_VGG = ("fragmento", "denso")
+# Modos do Sobel: mapa da imagem inteira fatiado no grid, ou cada fragmento isolado (comportamento antigo)
+MODOS_SOBEL = ("imagem", "fragmento")
+# Número mínimo de blocos de linhas em que a matriz de custo densa é montada: o callback de
+# progresso, que também é o ponto de cancelamento, é chamado entre eles
+BLOCOS_MATRIZ = 16
+# Etapas do `replace` informadas ao callback de progresso, em ordem; a doadora vem primeiro
+# porque é sobre ela que a projeção PCA dos descritores VGG é ajustada
+ETAPAS = ("descritores_2", "descritores_1", "atribuicao", "reconstrucao")
 
 
 def replace(
         fragmentos_1: FragmentGrid,
-        fragmentos_2: FragmentGrid,
+        fragmentos_2: FragmentGrid | None,
         weights: tuple[float, float, float, float] = (1.0, 0.0, 0.0, 0.0), # Tupla atualizada
-        yuv: bool = False
+        yuv: bool = False,
+        espaco_cor: str | None = None,
+        metrica: str = "l1",
+        modo_vgg: str = "fragmento",
+        reducao_vgg: str = "nenhuma",
+        pca_vgg: str | None = None,
+        vgg_float16: bool = False,
+        modo_sobel: str = "imagem",
+        atribuicao: str = "densa",
+        k_candidatos: int = 32,
+        n_grupos: int = 8,
+        processos: int | None = None,
+        executor: Executor | None = None,
+        comparar_exato: bool = False,
+        matriz_em_disco: bool = False,
+        memoria_bloco_mb: float = 512.0,
+        diretorio_temp: str | None = None,
+        descritores_2: dict[str, np.ndarray] | None = None,
+        estado: dict | None = None,
+        cache_descritores: str | None = None,
+        cache_max_mb: float = 1024.0,
+        saida: np.ndarray | None = None,
+        saida_bgr: bool = False,
+        progresso: Callable[[str, float], None] | None = None
 ) -> Image:
     """
     Substitui fragmentos de forma otimizada, usando uma combinação ponderada de
     similaridade de cor, VGG e bordas Sobel, e média de cor. Detecta automaticamente o hardware
     disponível (GPU com CUDA ou CPU).
+    Os grids podem ser visões de `fragmentos_view`, inclusive com fragmentos retangulares, mas sem
+    sobreposição: a imagem de saída é montada com os fragmentos lado a lado.
+    :param yuv: Atalho para `espaco_cor="yuv"`.
+    :param espaco_cor: Espaço de cor das métricas de cor, um de `ESPACOS_COR` ("rgb", "yuv" ou
+        "lab"). A conversão é feita no grid inteiro, em float32, e as diferenças de cada canal são
+        divididas pela sua amplitude (`AMPLITUDES_COR`). None usa "yuv" se `yuv`, senão "rgb".
+    :param metrica: Métrica da diferença de imagens: "l1" (diferença absoluta, par a par)
+        ou "l2" (diferença quadrática, calculada via multiplicação de matrizes).
+    :param modo_vgg: "fragmento" (cada fragmento ampliado para 224×224 passa pela rede) ou
+        "denso" (uma passada sobre a imagem inteira, com o mapa agrupado por fragmento).
+    :param reducao_vgg: No modo "fragmento", "nenhuma" (vetor 14×14×512) ou "gap" (média
+        global por canal, 512 valores). O modo "denso" já produz 512 valores por fragmento.
+    :param pca_vgg: Caminho (.npz) de uma projeção PCA para os descritores VGG. Se o arquivo não
+        existir, a projeção é ajustada aos descritores da doadora e salva nele; com `descritores_2`
+        prontos, o arquivo já precisa existir.
+    :param vgg_float16: Guarda os descritores VGG normalizados em float16.
+    :param modo_sobel: "imagem" (Sobel vetorizado sobre a imagem inteira, normalizado pelo máximo
+        global e fatiado no grid) ou "fragmento" (cada fragmento isolado, com borda zerada e
+        normalização própria).
+    :param atribuicao: "densa" (matriz de custo n×n completa e lap.lapjvs), "esparsa"
+        (apenas os k melhores candidatos de cada fragmento e lap.lapmod) ou "clusters"
+        (grupos balanceados por luminância resolvidos em paralelo) ou "incremental" (caminhos
+        aumentantes que partem da solução guardada em `estado`, para frames consecutivos).
+    :param k_candidatos: Número de candidatos por fragmento no modo esparso.
+    :param n_grupos: Número de grupos no modo "clusters".
+    :param processos: Número de processos do pool no modo "clusters" (None usa todos os núcleos).
+    :param executor: Pool de processos do modo "clusters"; sem ele é usado o pool persistente do
+        módulo (ver `obter_pool_clusters`).
+    :param comparar_exato: No modo "clusters", também resolve o problema exato com lap.lapjv
+        e informa a diferença de custo total, para ajudar a escolher `n_grupos`. Com `estado`,
+        os custos ficam em "custo_grupos", "custo_exato" e "diferenca_exato".
+    :param matriz_em_disco: No modo "densa", monta a matriz de custo em blocos de linhas gravados
+        num arquivo temporário mapeado em memória (np.memmap) e resolve direto sobre ele.
+    :param memoria_bloco_mb: Orçamento de memória de cada bloco de linhas, em MB.
+    :param diretorio_temp: Diretório do arquivo temporário (None usa o padrão do sistema).
+    :param descritores_2: Descritores da doadora já calculados por `calcular_descritores` com os
+        mesmos `weights`, `yuv` e opções de VGG e Sobel (as opções guardadas com eles são
+        comparadas às da receptora). Quando fornecidos, `fragmentos_2` é ignorado e pode ser None.
+    :param estado: No modo "incremental", dicionário reaproveitado entre chamadas. Guarda a matriz
+        de custo anterior, da qual só as linhas de fragmentos alterados são recalculadas, e a
+        solução anterior ("u", "v", "col_ind"), usada como ponto de partida. Ao final recebe as
+        métricas "fracao_recalculada", "linhas_reinseridas" e "iteracoes". A doadora é hasheada
+        uma vez e reconhecida depois pela identidade dos arrays (ver `hash_doadora`): alterá-los no
+        lugar exige descartar o estado. No modo "clusters" com
+        `comparar_exato`, recebe a comparação com o custo exato.
+    :param cache_descritores: Diretório de um cache em disco dos descritores, indexado pelo
+        conteúdo de cada grid e, para cada descritor, só pelas opções que o alteram (ver
+        `calcular_descritores`). Consultado antes de cada cálculo; None desativa o cache.
+    :param cache_max_mb: Tamanho máximo do cache; as entradas usadas há mais tempo são removidas.
+    :param saida: Buffer C-contíguo uint8 (h * fh, w * fw, 3) onde escrever a imagem final, em vez
+        de alocar uma nova (ex.: o quadro de um codificador de vídeo).
+    :param saida_bgr: Escreve a imagem final na ordem de canais BGR (a do OpenCV).
+    :param progresso: Chamado como progresso(etapa, fracao) no início de cada etapa (uma de
+        `ETAPAS`), com a fração aproximada do trabalho já feito, e também dentro delas: entre os
+        mini-lotes da VGG, entre os blocos de linhas da matriz de custo densa e entre os grupos do
+        modo "clusters". Uma exceção levantada por ele interrompe o `replace` (é assim que o
+        servidor cancela uma tarefa). A resolução do problema de atribuição (lap) em si não é
+        interrompível.
     """
+    if metrica not in METRICAS:
+        raise ValueError(f"Métrica '{metrica}' inválida. Use uma de {METRICAS}.")
+    espaco_cor = espaco_cor or ("yuv" if yuv else "rgb")
+    if espaco_cor not in ESPACOS_COR:
+        raise ValueError(f"Espaço de cor '{espaco_cor}' inválido. Use um de {ESPACOS_COR}.")
+    if atribuicao not in ATRIBUICOES:
+        raise ValueError(f"Atribuição '{atribuicao}' inválida. Use uma de {ATRIBUICOES}.")
+    if modo_vgg not in MODOS_VGG:
+        raise ValueError(f"Modo VGG '{modo_vgg}' inválido. Use um de {MODOS_VGG}.")
+    if reducao_vgg not in REDUCOES_VGG:
+        raise ValueError(f"Redução VGG '{reducao_vgg}' inválida. Use uma de {REDUCOES_VGG}.")
+    if modo_sobel not in MODOS_SOBEL:
+        raise ValueError(f"Modo Sobel '{modo_sobel}' inválido. Use um de {MODOS_SOBEL}.")
+
+    progresso = progresso or (lambda etapa, fracao: None)
     h, w, fh, fw, _ = fragmentos_1.shape
+
+    # Descritores de cada conjunto; os da doadora podem vir prontos (ex.: compartilhados entre frames)
+    opcoes = {
+        "modo_vgg": modo_vgg, "reducao_vgg": reducao_vgg, "pca_vgg": pca_vgg, "vgg_float16": vgg_float16,
+        "modo_sobel": modo_sobel, "espaco_cor": espaco_cor
+    }
+    # A doadora é calculada primeiro: se a projeção PCA ainda não existe, é ajustada sobre ela
+    progresso("descritores_2", 0.0)
+    if descritores_2 is None:
+        descritores_2 = calcular_descritores(
+            fragmentos_2, weights, yuv, "2", cache_descritores=cache_descritores, cache_max_mb=cache_max_mb,
+            progresso=lambda fracao: progresso("descritores_2", 0.3 * fracao), **opcoes
+        )
+    if pca_vgg is not None and weights[1] > 0 and not os.path.exists(pca_vgg):
+        raise ValueError(f"A projeção PCA '{pca_vgg}' não existe; ela é ajustada sobre os descritores da doadora.")
+    progresso("descritores_1", 0.3)
+    descritores_1 = calcular_descritores(
+        fragmentos_1, weights, yuv, "1", cache_descritores=cache_descritores, cache_max_mb=cache_max_mb,
+        progresso=lambda fracao: progresso("descritores_1", 0.3 + 0.3 * fracao), **opcoes
+    )
+    # `.item()`: o array de texto pode voltar com forma (1,) da memória compartilhada
+    opcoes_1, opcoes_2 = descritores_1["opcoes"].item(), descritores_2["opcoes"].item()
+    if opcoes_1 != opcoes_2:
+        raise ValueError(
+            f"Os descritores dos dois conjuntos foram extraídos com opções diferentes: {opcoes_1} (receptora) "
+            f"e {opcoes_2} (doadora)."
+        )
+
+    frag1_grade, frag1_proc_color, features1_vgg, sobel1, medias1 = (descritores_1[k] for k in DESCRITORES)
+    frag2_grade, frag2_proc_color, features2_vgg, sobel2, medias2 = (descritores_2[k] for k in DESCRITORES)
+
+    progresso("atribuicao", 0.6)
+
+    def progresso_atribuicao(fracao: float):
+        progresso("atribuicao", 0.6 + 0.25 * fracao)
+
+    if atribuicao == "esparsa":
+        cost, col_ind = atribuir_esparso(
+            features1_vgg, features2_vgg, frag1_proc_color, frag2_proc_color, sobel1, sobel2, medias1, medias2,
+            weights, metrica, k_candidatos, espaco_cor
+        )
+        print(f"Custo total da atribuição: {cost}")
+    elif atribuicao == "clusters":
+        cost, col_ind = atribuir_por_clusters(
+            features1_vgg, features2_vgg, frag1_proc_color, frag2_proc_color, sobel1, sobel2, medias1, medias2,
+            medias_fragmentos(frag1_grade), medias_fragmentos(frag2_grade), weights, metrica, n_grupos, processos,
+            executor, espaco_cor, progresso_atribuicao
+        )
+        print(f"Custo total da atribuição: {cost}")
+
+        if comparar_exato:
+            print("Resolvendo o problema exato para comparação...")
+            cost_exato, _ = resolver_denso(montar_matriz_custo(
+                features1_vgg, features2_vgg, frag1_proc_color, frag2_proc_color, sobel1, sobel2, medias1, medias2,
+                weights, metrica, espaco_cor
+            ))
+            gap = cost - cost_exato
+            print(f"Custo exato (lap.lapjv): {cost_exato} | Diferença com {n_grupos} grupos: {gap} "
+                  f"({100 * gap / abs(cost_exato) if cost_exato != 0 else 0.0:.2f}%)")
+            if estado is not None:
+                estado.update(custo_grupos=cost, custo_exato=cost_exato, diferenca_exato=gap)
+    elif atribuicao == "incremental":
+        estado = {} if estado is None else estado
+        cost_matrix = atualizar_matriz_custo(estado, descritores_1, descritores_2, weights, metrica, espaco_cor)
+
+        print("Resolvendo atribuição por caminhos aumentantes a partir da solução anterior...")
+        cost, col_ind, u, v, linhas_reinseridas, iteracoes = resolver_incremental(
+            cost_matrix, estado.get("u"), estado.get("v"), estado.get("col_ind")
+        )
+        estado.update(u=u, v=v, col_ind=col_ind, linhas_reinseridas=linhas_reinseridas, iteracoes=iteracoes)
+        print(f"Custo total da atribuição: {cost} ({linhas_reinseridas} linhas reinseridas, {iteracoes} iterações)")
+    elif matriz_em_disco:
+        fd, caminho = tempfile.mkstemp(suffix=".dat", prefix="custo_", dir=diretorio_temp)
+        os.close(fd)
+        try:
+            cost_matrix = montar_matriz_custo_em_disco(
+                features1_vgg, features2_vgg, frag1_proc_color, frag2_proc_color, sobel1, sobel2, medias1, medias2,
+                weights, metrica, caminho, memoria_bloco_mb, espaco_cor, progresso_atribuicao
+            )
+
+            print("Resolvendo atribuição sobre a matriz em disco (lap.lapjvs)...")
+            cost, col_ind = resolver_denso_sem_copia(cost_matrix)
+            print(f"Custo total da atribuição: {cost}")
+            del cost_matrix
+        finally:
+            os.remove(caminho)
+    else:
+        # Montada em blocos de linhas para que um cancelamento seja atendido entre eles
+        cost_matrix = np.empty((contar_fragmentos(frag1_grade), contar_fragmentos(frag2_grade)), dtype=np.float32)
+        preencher_matriz_custo(
+            cost_matrix, features1_vgg, features2_vgg, frag1_proc_color, frag2_proc_color, sobel1, sobel2,
+            medias1, medias2, weights, metrica, espaco_cor, progresso=progresso_atribuicao
+        )
+
+        # Resolução do problema de atribuição: lap.lapjvs trabalha sobre a própria matriz float32,
+        # enquanto lap.lapjv faria uma cópia float64 dela
+        print("Resolvendo atribuição com Algoritmo do Jonker-Volgenant (lap.lapjvs)...")
+        cost, col_ind = resolver_denso_sem_copia(cost_matrix)
+        print(f"Custo total da atribuição: {cost}")
+
+    # Reconstrução da imagem final
+    progresso("reconstrucao", 0.95)
+    print("Reconstruindo a imagem final...")
+    output_array = reconstruir_imagem(frag2_grade, col_ind, (h, w), saida, saida_bgr)
+
+    print("Processo finalizado.")
+    return output_array
+
+
+def versao_pca(pca_vgg: str | None) -> list | None:
+    """
+    Identifica o conteúdo do arquivo da projeção PCA pelo caminho absoluto, data de modificação e
+    tamanho.
+    :return: A versão, ou None sem arquivo (ou se ele ainda não existe).
+    """
+    if pca_vgg is None or not os.path.exists(pca_vgg):
+        return None
+    info = os.stat(pca_vgg)
+    return [os.path.abspath(pca_vgg), info.st_mtime_ns, info.st_size]
+
+
+def calcular_descritores(
+        fragmentos: FragmentGrid,
+        weights: tuple[float, float, float, float],
+        yuv: bool = False,
+        rotulo: str = "",
+        modo_vgg: str = "fragmento",
+        reducao_vgg: str = "nenhuma",
+        pca_vgg: str | None = None,
+        vgg_float16: bool = False,
+        modo_sobel: str = "imagem",
+        espaco_cor: str | None = None,
+        cache_descritores: str | None = None,
+        cache_max_mb: float = 1024.0,
+        progresso: Callable[[float], None] | None = None
+) -> dict[str, np.ndarray]:
+    """
+    Calcula todos os descritores de um conjunto de fragmentos usados na matriz de custo.
+    Apenas os descritores com peso maior que zero são calculados; os demais ficam como
+    arrays de zeros com a forma esperada pelos kernels.
+    Os descritores por pixel ("fragmentos", "cor" e "sobel") mantêm a forma de grid (h, w, fh, fw, 3):
+    com uma visão de `fragmentos_view`, "fragmentos" e a cor RGB são a própria visão, sem cópia, e
+    os kernels leem o fragmento k como grid[k // w, k % w]. "vgg" e "medias" são (n, d).
+    :param fragmentos: Grid de fragmentos (h, w, fh, fw, 3).
+    :param weights: Pesos (diferença de imagens, VGG, Sobel, média de cor).
+    :param yuv: Se True, converte os fragmentos para YUV antes das métricas de cor.
+    :param espaco_cor: Um de `ESPACOS_COR`; tem precedência sobre `yuv`. Ver `replace`.
+    :param rotulo: Identificação do conjunto nas mensagens de progresso.
+    :param modo_vgg: Um de `MODOS_VGG`; ver `replace`.
+    :param reducao_vgg: Um de `REDUCOES_VGG`; ver `replace`.
+    :param pca_vgg: Arquivo da projeção PCA dos descritores VGG; ver `replace`.
+    :param vgg_float16: Guarda os descritores VGG em float16.
+    :param modo_sobel: Um de `MODOS_SOBEL`; ver `replace`.
+    :param cache_descritores: Diretório do cache em disco. Cada descritor é guardado à parte, com
+        uma chave formada pelo conteúdo do grid e só pelas opções que o alteram: a cor pelo espaço
+        de cor, o VGG pelo modo, redução, PCA e float16, o Sobel pelo modo e as médias pelo espaço
+        de cor. O VGG só vai ao cache reduzido (modo denso, "gap" ou PCA); sem redução ele tem
+        100352 valores por fragmento. None desativa o cache.
+    :param cache_max_mb: Tamanho máximo do cache; as entradas usadas há mais tempo são removidas.
+    :param progresso: Chamado como progresso(fracao) entre os mini-lotes da VGG e antes de cada
+        descritor seguinte; uma exceção levantada por ele interrompe o cálculo.
+    :return: Dicionário com as chaves de `DESCRITORES` e "opcoes", as opções de extração
+        serializadas em JSON (array de texto com um elemento, para ir à memória compartilhada
+        como os demais).
+    """
+    h, w, fh, fw, _ = fragmentos.shape
     n = h * w
-    peso_dif_imagens, peso_vgg, peso_sobel, peso_media_cor = weights # Desempacotar novos pesos
+    _, peso_vgg, peso_sobel, peso_media_cor = weights
+    espaco_cor = espaco_cor or ("yuv" if yuv else "rgb")
+    progresso = progresso or (lambda fracao: None)
 
-    frag1_flat = fragmentos_1.reshape((n, fh, fw, 3))
-    frag2_flat = fragmentos_2.reshape((n, fh, fw, 3))
+    # O conteúdo do grid é hasheado uma única vez e combinado com as opções de cada descritor
+    hash_fragmentos = hash_grid(fragmentos) if cache_descritores is not None else ""
+    max_bytes = int(cache_max_mb * 2 ** 20)
+
+    def em_cache(nome: str, parametros: dict, calcular: Callable[[], np.ndarray], guardar: bool = True):
+        diretorio = cache_descritores if guardar else None
+        chave = chave_descritor(hash_fragmentos, nome, parametros) if diretorio is not None else ""
+        return descritor_em_cache(diretorio, chave, max_bytes, calcular)
 
     # Extração de características VGG (se o peso for maior que zero)
-    features1_vgg = np.zeros((n, 1), dtype=np.float32)
-    features2_vgg = np.zeros((n, 1), dtype=np.float32)
-    if peso_vgg > 0:
-        print("Extraindo características VGG do conjunto 1...")
-        features1_vgg = np.array([extract_features(f) for f in tqdm(frag1_flat)])
-        print("Extraindo características VGG do conjunto 2...")
-        features2_vgg = np.array([extract_features(f) for f in tqdm(frag2_flat)])
+    def calcular_vgg() -> np.ndarray:
+        print(f"Extraindo características VGG do conjunto {rotulo} (modo {modo_vgg})...")
+        if modo_vgg == "denso":
+            features_vgg = extract_features_densas(imagem_da_grade(fragmentos), (h, w))
+        else:
+            # A VGG domina o tempo: ocupa os primeiros 80% da fração informada
+            features_vgg = extract_features_lote(
+                fragmentos, reducao=reducao_vgg, progresso=lambda fracao: progresso(0.8 * fracao)
+            )
+
+        if pca_vgg is not None:
+            if os.path.exists(pca_vgg):
+                pca = carregar_pca(pca_vgg)
+            else:
+                print(f"Ajustando a projeção PCA dos descritores VGG e salvando em {pca_vgg}...")
+                pca = ajustar_pca(features_vgg)
+                salvar_pca(pca, pca_vgg)
+            features_vgg = projetar_pca(features_vgg, pca)
 
         # Normalização dos vetores de características VGG
-        norm1 = np.linalg.norm(features1_vgg, axis=1, keepdims=True)
-        norm2 = np.linalg.norm(features2_vgg, axis=1, keepdims=True)
-        features1_vgg = np.divide(features1_vgg, norm1, out=np.zeros_like(features1_vgg), where=norm1 != 0)
-        features2_vgg = np.divide(features2_vgg, norm2, out=np.zeros_like(features2_vgg), where=norm2 != 0)
-
-    # Processamento de cor (conversão para YUV se solicitado)
-    frag1_proc_color = frag1_flat.astype(np.uint8)
-    frag2_proc_color = frag2_flat.astype(np.uint8)
-    if yuv:
-        print("Convertendo imagens para YUV...")
-        frag1_proc_color = np.array([covert_to_YUV(f) for f in frag1_flat])
-        frag2_proc_color = np.array([covert_to_YUV(f) for f in frag2_flat])
+        norm = np.linalg.norm(features_vgg, axis=1, keepdims=True)
+        features_vgg = np.divide(features_vgg, norm, out=np.zeros_like(features_vgg), where=norm != 0)
+        if vgg_float16:
+            features_vgg = features_vgg.astype(np.float16)
+        return features_vgg
+
+    features_vgg = np.zeros((n, 1), dtype=np.float32)
+    if peso_vgg > 0:
+        # Sem redução o descritor não vai ao cache; com uma PCA ainda não ajustada também não,
+        # para que o ajuste (e o arquivo dela) aconteça
+        versao = versao_pca(pca_vgg)
+        reduzido = modo_vgg == "denso" or reducao_vgg != "nenhuma" or versao is not None
+        parametros_vgg = {
+            "modo_vgg": modo_vgg, "reducao_vgg": reducao_vgg if modo_vgg == "fragmento" else None,
+            "versao_pca": versao, "vgg_float16": vgg_float16,
+        }
+        features_vgg = em_cache("vgg", parametros_vgg, calcular_vgg, guardar=reduzido)
+
+    progresso(0.8)
+    # Processamento de cor: RGB fica em uint8 (a própria visão); YUV e LAB são convertidos no
+    # grid inteiro, em float32
+    frag_proc_color = np.asarray(fragmentos, dtype=np.uint8)
+    if espaco_cor != "rgb":
+        def calcular_cor() -> np.ndarray:
+            print(f"Convertendo o conjunto {rotulo} para {espaco_cor.upper()}...")
+            return converter_espaco_cor(fragmentos, espaco_cor)
+
+        frag_proc_color = em_cache("cor", {"espaco_cor": espaco_cor}, calcular_cor)
 
     # Cálculo das características Sobel (se o peso for maior que zero)
-    sobel1 = np.zeros_like(frag1_flat, dtype=np.uint8)
-    sobel2 = np.zeros_like(frag2_flat, dtype=np.uint8)
+    def calcular_sobel() -> np.ndarray:
+        print(f"Calculando características Sobel para o conjunto {rotulo} (modo {modo_sobel})...")
+        if modo_sobel == "imagem":
+            return fragmentos_view(sobel_imagem(imagem_da_grade(fragmentos)), fh, fw)
+        return np.array([sobel(fragmentos[k // w, k % w]) for k in tqdm(range(n))]).reshape(fragmentos.shape)
+
+    progresso(0.85)
+    sobel_frag = np.zeros(fragmentos.shape, dtype=np.uint8)
     if peso_sobel > 0:
-        print("Calculando características Sobel para o conjunto 1...")
-        sobel1 = np.array([sobel(f) for f in tqdm(frag1_flat)])
-        print("Calculando características Sobel para o conjunto 2...")
-        sobel2 = np.array([sobel(f) for f in tqdm(frag2_flat)])
+        sobel_frag = em_cache("sobel", {"modo_sobel": modo_sobel}, calcular_sobel)
+
+    # Médias de cor calculadas uma vez por fragmento (n, 3)
+    medias = np.zeros((n, 3), dtype=np.float32)
+    if peso_media_cor > 0:
+        medias = em_cache("medias", {"espaco_cor": espaco_cor}, lambda: medias_fragmentos(frag_proc_color))
+
+    # Opções que alteram os descritores, comparadas pelo `replace` entre receptora e doadora
+    opcoes = {
+        "calculados": [peso > 0 for peso in weights[1:]], "espaco_cor": espaco_cor, "modo_sobel": modo_sobel,
+        "modo_vgg": modo_vgg, "reducao_vgg": reducao_vgg, "versao_pca": versao_pca(pca_vgg) if peso_vgg > 0 else None,
+        "vgg_float16": vgg_float16,
+    }
+
+    return {
+        "fragmentos": fragmentos, "cor": frag_proc_color, "vgg": features_vgg, "sobel": sobel_frag, "medias": medias,
+        "opcoes": np.array(json.dumps(opcoes, sort_keys=True)),
+    }
+
+
+def montar_matriz_custo(
+        features1_vgg, features2_vgg,
+        frag1_proc_color, frag2_proc_color,
+        sobel1, sobel2,
+        medias1, medias2,
+        weights: tuple[float, float, float, float],
+        metrica: str,
+        espaco_cor: str = "rgb",
+        l2_doadora: tuple[np.ndarray, np.ndarray] | None = None
+) -> np.ndarray:
+    """
+    Monta a matriz de custo densa (n1, n2) entre dois conjuntos de fragmentos, combinando os
+    kernels par a par (GPU ou CPU) com os termos calculados em bloco (L2, VGG e média de cor).
+    Também serve para sub-blocos: basta passar os descritores já fatiados. Cor e Sobel podem ser
+    grids (h, w, fh, fw, 3) ou fragmentos achatados (n, fh, fw, 3).
+    Além da matriz, cada termo em bloco usa no máximo dois arrays temporários (n1, n2).
+    :param espaco_cor: Espaço de cor dos fragmentos e das médias; as diferenças de cor são
+        normalizadas pela amplitude de cada canal dele (ver `amplitude_cor`).
+    :param l2_doadora: `preparar_l2(frag2_proc_color, amplitude)` já calculado, para não converter
+        os doadores de novo a cada bloco de linhas.
+    """
+    peso_dif_imagens, peso_vgg, peso_sobel, peso_media_cor = weights
+    amplitude = amplitude_cor(espaco_cor)
+
+    # Com a métrica L2 o termo de diferença sai dos kernels par a par e é aplicado em bloco
+    peso_dif_pares = peso_dif_imagens if metrica == "l1" else 0.0
+
+    # O termo VGG também é aplicado em bloco; os kernels recebem descritores vazios
+    vgg_vazio_1 = np.zeros((contar_fragmentos(frag1_proc_color), 1), dtype=np.float32)
+    vgg_vazio_2 = np.zeros((contar_fragmentos(frag2_proc_color), 1), dtype=np.float32)
 
     # Cálculo da matriz de custo (GPU ou CPU)
     cost_matrix = None
     if cuda.is_available():
         print("\n==> GPU com suporte a CUDA detectada. Usando GPU para cálculo. <==\n")
         cost_matrix = calc_cost_matrix_cuda(
-            features1_vgg, features2_vgg, frag1_proc_color, frag2_proc_color, sobel1, sobel2,
-            n, peso_dif_imagens, peso_vgg, peso_sobel, peso_media_cor # Passar novo peso
+            vgg_vazio_1, vgg_vazio_2, como_grade(frag1_proc_color), como_grade(frag2_proc_color),
+            como_grade(sobel1), como_grade(sobel2), amplitude, peso_dif_pares, 0.0, peso_sobel
         )
     else:
         print("\n==> GPU com CUDA não encontrada. Usando CPU para cálculo. <==\n")
         cost_matrix = calc_cost_matrix(
-            features1_vgg, features2_vgg, frag1_proc_color, frag2_proc_color, sobel1, sobel2,
-            n, peso_dif_imagens, peso_vgg, peso_sobel, peso_media_cor # Passar novo peso
+            vgg_vazio_1, vgg_vazio_2, como_grade(frag1_proc_color), como_grade(frag2_proc_color),
+            como_grade(sobel1), como_grade(sobel2), amplitude, peso_dif_pares, 0.0, peso_sobel
         )
 
-    # Resolução do problema de atribuição
-    print("Resolvendo atribuição com Algoritmo do Jonker-Volgenant (lap.lapjv)...")
-    cost, col_ind, _ = lap.lapjv(cost_matrix.astype(np.float32))
-    print(f"Custo total da atribuição: {cost}")
+    # Similaridade de cosseno VGG: uma multiplicação de matrizes sobre os vetores normalizados
+    if peso_vgg > 0:
+        print("Calculando similaridade VGG via multiplicação de matrizes...")
+        termo = matriz_similaridade_cosseno(features1_vgg, features2_vgg)
+        termo *= np.float32(peso_vgg)
+        cost_matrix -= termo
+        del termo
 
-    # Reconstrução da imagem final
-    print("Reconstruindo a imagem final...")
-    output_array = np.zeros((h * fh, w * fw, 3), dtype=np.uint8)
-    for idx, frag_idx in enumerate(col_ind):
-        i, j = divmod(idx, w)
-        output_array[i * fh:(i + 1) * fh, j * fw:(j + 1) * fw] = frag2_flat[frag_idx]
+    # Diferença quadrática (L2): bloco inteiro calculado por uma multiplicação de matrizes
+    if metrica == "l2" and peso_dif_imagens > 0:
+        print("Calculando diferença quadrática (L2) via multiplicação de matrizes...")
+        termo = matriz_similaridade_l2(frag1_proc_color, frag2_proc_color, amplitude, l2_doadora)
+        termo *= np.float32(peso_dif_imagens)
+        cost_matrix -= termo
+        del termo
 
-    print("Processo finalizado.")
-    return output_array
+    # Similaridade por média de cor: bloco montado com broadcast sobre as médias,
+    # em vez de recalcular as médias em cada par
+    if peso_media_cor > 0:
+        print("Calculando similaridade por média de cor...")
+        termo = matriz_similaridade_media_cor(medias1, medias2, amplitude)
+        termo *= np.float32(peso_media_cor)
+        cost_matrix -= termo
+
+    return cost_matrix
+
+
+def linhas_alteradas(anteriores: dict[str, np.ndarray], atuais: dict[str, np.ndarray]) -> np.ndarray:
+    """
+    Compara os descritores de dois conjuntos de fragmentos alvo, linha a linha.
+    :return: Array booleano (n,) com True nas linhas em que algum descritor mudou.
+    """
+    n = atuais["medias"].shape[0]
+    mudou = np.zeros(n, dtype=bool)
+    for chave in ("cor", "vgg", "sobel", "medias"):
+        if anteriores[chave].shape != atuais[chave].shape:
+            return np.ones(n, dtype=bool)
+        mudou |= np.any((anteriores[chave] != atuais[chave]).reshape((n, -1)), axis=1)
+    return mudou
+
+
+def hash_descritores(descritores: dict[str, np.ndarray]) -> str:
+    """
+    Hash do conteúdo (forma, tipo e valores) dos descritores usados na matriz de custo.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    for nome in DESCRITORES[1:]:
+        array = np.ascontiguousarray(descritores[nome])
+        h.update(f"{nome}{array.shape}{array.dtype}".encode())
+        h.update(array.data)
+    return h.hexdigest()
+
+
+def hash_doadora(estado: dict, descritores: dict[str, np.ndarray]) -> str:
+    """
+    `hash_descritores` da doadora, calculado uma única vez por conjunto de arrays: se os arrays
+    forem os mesmos objetos da chamada anterior (comparados por identidade, com as referências
+    guardadas em `estado`, para que um id reciclado não engane a comparação), o hash guardado é
+    reaproveitado. Arrays novos, mesmo com o mesmo conteúdo, são hasheados de novo.
+    Alterar os arrays da doadora no lugar entre chamadas exige descartar o `estado`.
+    """
+    arrays = tuple(descritores[nome] for nome in DESCRITORES[1:])
+    anteriores = estado.get("arrays_doadora")
+    if anteriores is None or any(a is not b for a, b in zip(anteriores, arrays)):
+        estado.update(arrays_doadora=arrays, hash_doadora=hash_descritores(descritores))
+    return estado["hash_doadora"]
+
+
+def atualizar_matriz_custo(
+        estado: dict,
+        descritores_1: dict[str, np.ndarray],
+        descritores_2: dict[str, np.ndarray],
+        weights: tuple[float, float, float, float],
+        metrica: str,
+        espaco_cor: str = "rgb"
+) -> np.ndarray:
+    """
+    Monta a matriz de custo reaproveitando a da chamada anterior guardada em `estado`.
+    Se a doadora (comparada pelo conteúdo, ver `hash_doadora`), os pesos, a métrica e o espaço de cor forem
+    os mesmos, só as linhas dos fragmentos alvo cujos descritores mudaram são recalculadas; as demais são mantidas.
+    :param estado: Dicionário reaproveitado entre chamadas; recebe a matriz, os descritores alvo,
+        o hash da doadora e a métrica "fracao_recalculada".
+    :return: A matriz de custo (n, n) atualizada.
+    """
+    n = descritores_1["medias"].shape[0]
+    chave = (weights, metrica, espaco_cor, hash_doadora(estado, descritores_2))
+
+    cost_matrix = estado.get("cost_matrix")
+    if cost_matrix is not None and cost_matrix.shape == (n, n) and estado.get("chave_custo") == chave:
+        linhas = np.flatnonzero(linhas_alteradas(estado["descritores_1"], descritores_1))
+        if linhas.size > 0:
+            cost_matrix[linhas] = montar_matriz_custo(
+                descritores_1["vgg"][linhas], descritores_2["vgg"],
+                selecionar_fragmentos(descritores_1["cor"], linhas), descritores_2["cor"],
+                selecionar_fragmentos(descritores_1["sobel"], linhas), descritores_2["sobel"],
+                descritores_1["medias"][linhas], descritores_2["medias"],
+                weights, metrica, espaco_cor
+            )
+    else:
+        linhas = np.arange(n)
+        cost_matrix = montar_matriz_custo(
+            descritores_1["vgg"], descritores_2["vgg"],
+            descritores_1["cor"], descritores_2["cor"],
+            descritores_1["sobel"], descritores_2["sobel"],
+            descritores_1["medias"], descritores_2["medias"],
+            weights, metrica, espaco_cor
+        )
+
+    fracao = linhas.size / n
+    print(f"Linhas da matriz de custo recalculadas: {linhas.size}/{n} ({100 * fracao:.1f}%)")
+    estado.update(
+        cost_matrix=cost_matrix, chave_custo=chave, descritores_1=descritores_1, fracao_recalculada=fracao
+    )
+    return cost_matrix
+
+
+def preencher_matriz_custo(
+        cost_matrix: np.ndarray,
+        features1_vgg, features2_vgg,
+        frag1_proc_color, frag2_proc_color,
+        sobel1, sobel2,
+        medias1, medias2,
+        weights: tuple[float, float, float, float],
+        metrica: str,
+        espaco_cor: str = "rgb",
+        linhas_por_bloco: int | None = None,
+        progresso: Callable[[float], None] | None = None
+):
+    """
+    Preenche a matriz de custo densa (n1, n2) em blocos de linhas, cada um calculado em paralelo
+    por `montar_matriz_custo`. O lado doador (pixels normalizados da L2 e descritores VGG em
+    float32) é preparado uma única vez, fora do laço.
+    :param cost_matrix: Destino float32 (n1, n2): um array em memória ou um np.memmap.
+    :param linhas_por_bloco: Linhas calculadas por vez; None divide a matriz em `BLOCOS_MATRIZ` blocos.
+    :param progresso: Chamado como progresso(fracao) depois de cada bloco; uma exceção levantada
+        por ele interrompe a montagem (ver o cancelamento em `replace`).
+    """
+    n1 = contar_fragmentos(frag1_proc_color)
+    peso_dif_imagens, peso_vgg = weights[:2]
+    if linhas_por_bloco is None:
+        linhas_por_bloco = -(-n1 // BLOCOS_MATRIZ)
+
+    # O lado doador é o mesmo em todos os blocos: converte-o uma única vez
+    usa_l2 = metrica == "l2" and peso_dif_imagens > 0
+    l2_doadora = preparar_l2(frag2_proc_color, amplitude_cor(espaco_cor)) if usa_l2 else None
+    if peso_vgg > 0:
+        features2_vgg = np.asarray(features2_vgg, dtype=np.float32)
+
+    for inicio in tqdm(range(0, n1, linhas_por_bloco)):
+        fim = min(inicio + linhas_por_bloco, n1)
+        bloco = np.arange(inicio, fim)
+        cost_matrix[inicio:fim] = montar_matriz_custo(
+            features1_vgg[inicio:fim], features2_vgg,
+            selecionar_fragmentos(frag1_proc_color, bloco), frag2_proc_color,
+            selecionar_fragmentos(sobel1, bloco), sobel2,
+            medias1[inicio:fim], medias2,
+            weights, metrica, espaco_cor, l2_doadora
+        )
+        if progresso is not None:
+            progresso(fim / n1)
+
+
+def montar_matriz_custo_em_disco(
+        features1_vgg, features2_vgg,
+        frag1_proc_color, frag2_proc_color,
+        sobel1, sobel2,
+        medias1, medias2,
+        weights: tuple[float, float, float, float],
+        metrica: str,
+        caminho: str,
+        memoria_bloco_mb: float = 512.0,
+        espaco_cor: str = "rgb",
+        progresso: Callable[[float], None] | None = None
+) -> np.memmap:
+    """
+    Monta a matriz de custo densa (n, n) em blocos de linhas (ver `preencher_matriz_custo`),
+    gravando cada bloco num arquivo mapeado em memória. O pico de memória fica limitado por
+    `memoria_bloco_mb` em vez de crescer com n².
+    :param caminho: Arquivo onde a matriz float32 será gravada.
+    :param memoria_bloco_mb: Orçamento de memória de cada bloco de linhas, em MB.
+    :param progresso: Ver `preencher_matriz_custo`.
+    :return: A matriz como um np.memmap somente leitura sobre `caminho`.
+    """
+    n1 = contar_fragmentos(frag1_proc_color)
+    n2 = contar_fragmentos(frag2_proc_color)
+    peso_dif_imagens, peso_vgg = weights[:2]
+
+    # Bytes por linha do bloco: a linha da matriz e até dois temporários do mesmo tamanho
+    # (a diferença e o acumulador da média de cor), as cópias das linhas de cor e Sobel, os
+    # pixels normalizados da L2 e os descritores VGG promovidos a float32
+    bytes_por_linha = 3 * 4 * n2
+    bytes_por_linha += np.prod(frag1_proc_color.shape[-3:]) + np.prod(sobel1.shape[-3:])
+    if metrica == "l2" and peso_dif_imagens > 0:
+        bytes_por_linha += 4 * np.prod(frag1_proc_color.shape[-3:])
+    if peso_vgg > 0 and features1_vgg.dtype != np.float32:
+        bytes_por_linha += 4 * features1_vgg.shape[1]
+    # Pelo menos `BLOCOS_MATRIZ` blocos, para que o progresso seja informado entre eles
+    linhas_por_bloco = max(1, min(int(memoria_bloco_mb * 1024 ** 2 // bytes_por_linha), -(-n1 // BLOCOS_MATRIZ)))
+    print(f"Montando matriz de custo em disco ({n1}×{n2}) em blocos de {linhas_por_bloco} linhas...")
+
+    cost_matrix = np.memmap(caminho, dtype=np.float32, mode="w+", shape=(n1, n2))
+    preencher_matriz_custo(
+        cost_matrix, features1_vgg, features2_vgg, frag1_proc_color, frag2_proc_color, sobel1, sobel2,
+        medias1, medias2, weights, metrica, espaco_cor, linhas_por_bloco, progresso
+    )
+    cost_matrix.flush()
+    del cost_matrix
+
+    return np.memmap(caminho, dtype=np.float32, mode="r", shape=(n1, n2))
+
+
+# Nomes dos descritores enviados aos workers do modo "clusters" pela memória compartilhada
+DESCRITORES_GRUPO = ("vgg1", "vgg2", "cor1", "cor2", "sobel1", "sobel2", "medias1", "medias2")
+
+# Pool de processos do modo "clusters" usado quando o chamador não passa um `executor`: criado no
+# primeiro uso e mantido entre chamadas, para que cada worker importe o torch e carregue os kernels
+# uma só vez
+_pool_clusters: dict = {}
+_trava_pool_clusters = threading.Lock()
+
+
+def obter_pool_clusters(processos: int | None = None) -> ProcessPoolExecutor:
+    """
+    Devolve o pool persistente do modo "clusters", criando-o (contexto spawn) no primeiro uso ou
+    quando `processos` muda.
+    """
+    with _trava_pool_clusters:
+        if "executor" in _pool_clusters and _pool_clusters["processos"] != processos:
+            _pool_clusters.pop("executor").shutdown()
+        if "executor" not in _pool_clusters:
+            # 'spawn' evita herdar, via fork, os pools de threads já iniciados pelo numba e pelo torch
+            _pool_clusters.update(
+                executor=ProcessPoolExecutor(max_workers=processos, mp_context=multiprocessing.get_context("spawn")),
+                processos=processos
+            )
+        return _pool_clusters["executor"]
+
+
+@atexit.register
+def encerrar_pool_clusters():
+    """Encerra o pool persistente do modo "clusters", se existir; o próximo uso cria outro."""
+    with _trava_pool_clusters:
+        executor = _pool_clusters.pop("executor", None)
+    if executor is not None:
+        executor.shutdown()
+
+
+def resolver_grupo(
+        descritores: dict[str, np.ndarray],
+        linhas: np.ndarray,
+        colunas: np.ndarray,
+        weights: tuple[float, float, float, float],
+        metrica: str,
+        espaco_cor: str = "rgb"
+) -> tuple[float, np.ndarray]:
+    """Monta o bloco de custo de um grupo (linhas × colunas) e o resolve com lap.lapjv."""
+    d = descritores
+    return resolver_denso(montar_matriz_custo(
+        d["vgg1"][linhas], d["vgg2"][colunas],
+        selecionar_fragmentos(d["cor1"], linhas), selecionar_fragmentos(d["cor2"], colunas),
+        selecionar_fragmentos(d["sobel1"], linhas), selecionar_fragmentos(d["sobel2"], colunas),
+        d["medias1"][linhas], d["medias2"][colunas],
+        weights, metrica, espaco_cor
+    ))
+
+
+def resolver_grupo_compartilhado(specs, linhas, colunas, weights, metrica, espaco_cor) -> tuple[float, np.ndarray]:
+    """`resolver_grupo` num worker, sobre os descritores anexados da memória compartilhada."""
+    descritores, blocos = anexar_arrays(specs)
+    try:
+        return resolver_grupo(descritores, linhas, colunas, weights, metrica, espaco_cor)
+    finally:
+        for bloco in blocos:
+            bloco.close()
+
+
+def atribuir_por_clusters(
+        features1_vgg, features2_vgg,
+        frag1_proc_color, frag2_proc_color,
+        sobel1, sobel2,
+        medias1, medias2,
+        medias1_rgb, medias2_rgb,
+        weights: tuple[float, float, float, float],
+        metrica: str,
+        n_grupos: int,
+        processos: int | None = None,
+        executor: Executor | None = None,
+        espaco_cor: str = "rgb",
+        progresso: Callable[[float], None] | None = None
+) -> tuple[float, np.ndarray]:
+    """
+    Divide alvos e doadores em grupos balanceados pelos quantis de luminância e resolve o
+    problema de atribuição de cada grupo separadamente, em paralelo num pool de processos.
+    Os descritores vão uma vez para a memória compartilhada; cada worker monta e resolve o bloco
+    de custo do seu grupo, e as permutações locais são depois costuradas numa só.
+    Dentro de um processo daemon (workers de `main.py` e de `PoolReplace`), que não pode ter
+    filhos, e sem `executor`, os grupos são resolvidos em sequência no próprio processo.
+    :param executor: Pool de processos a usar; sem ele, é usado o pool persistente de
+        `obter_pool_clusters` com `processos` processos.
+    :param progresso: Chamado como progresso(fracao) a cada grupo resolvido; se ele levanta uma
+        exceção, os grupos ainda não iniciados são cancelados.
+    :return: Tupla (custo total, col_ind).
+    """
+    n = contar_fragmentos(frag1_proc_color)
+    progresso = progresso or (lambda fracao: None)
+    grupos = particionar_por_luminancia(medias1_rgb, medias2_rgb, n_grupos)
+    print(f"Resolvendo atribuição em {len(grupos)} grupos de ~{n // len(grupos)} fragmentos...")
+
+    descritores = dict(zip(DESCRITORES_GRUPO, (
+        features1_vgg, features2_vgg, frag1_proc_color, frag2_proc_color, sobel1, sobel2, medias1, medias2
+    )))
+    if executor is None and multiprocessing.current_process().daemon:
+        print("Processo daemon: resolvendo os grupos em sequência...")
+        resultados = []
+        for linhas, colunas in grupos:
+            resultados.append(resolver_grupo(descritores, linhas, colunas, weights, metrica, espaco_cor))
+            progresso(len(resultados) / len(grupos))
+    else:
+        blocos, specs = compartilhar_arrays(descritores)
+        try:
+            if executor is not None:
+                resultados = _resolver_grupos_no_pool(executor, specs, grupos, weights, metrica, espaco_cor, progresso)
+            else:
+                try:
+                    resultados = _resolver_grupos_no_pool(
+                        obter_pool_clusters(processos), specs, grupos, weights, metrica, espaco_cor, progresso
+                    )
+                except BrokenProcessPool:
+                    # Um worker morreu: o pool não serve mais, e a próxima chamada cria outro
+                    encerrar_pool_clusters()
+                    raise
+        finally:
+            liberar_arrays(blocos)
+
+    col_ind = np.empty(n, dtype=np.int64)
+    cost = 0.0
+    for (linhas, colunas), (custo_grupo, col_ind_grupo) in zip(grupos, resultados):
+        col_ind[linhas] = colunas[col_ind_grupo]
+        cost += custo_grupo
+    return cost, col_ind
+
+
+def _resolver_grupos_no_pool(
+        executor: Executor, specs, grupos, weights, metrica, espaco_cor, progresso
+) -> list[tuple[float, np.ndarray]]:
+    futuros = [
+        executor.submit(resolver_grupo_compartilhado, specs, linhas, colunas, weights, metrica, espaco_cor)
+        for linhas, colunas in grupos
+    ]
+    try:
+        for concluidos, _ in enumerate(as_completed(futuros), 1):
+            progresso(concluidos / len(futuros))
+    except BaseException:
+        # Os grupos que ainda não começaram não rodam; os em andamento terminam antes que a
+        # memória compartilhada seja liberada
+        for futuro in futuros:
+            futuro.cancel()
+        wait(futuros)
+        raise
+    return [futuro.result() for futuro in futuros]
+
+
+def atribuir_esparso(
+        features1_vgg, features2_vgg,
+        frag1_proc_color, frag2_proc_color,
+        sobel1, sobel2,
+        medias1, medias2,
+        weights: tuple[float, float, float, float],
+        metrica: str,
+        k_candidatos: int,
+        espaco_cor: str = "rgb"
+) -> tuple[float, np.ndarray]:
+    """
+    Resolve a atribuição considerando apenas os k melhores candidatos doadores de cada fragmento
+    alvo (e os k melhores alvos de cada doador), evitando a matriz de custo densa n×n. Os candidatos
+    são buscados por vizinhos mais próximos sobre descritores compactos de cor e o problema esparso
+    é resolvido com lap.lapmod.
+    Se o grafo de candidatos não admitir emparelhamento perfeito, arestas extras para doadores
+    livres são adicionadas (ver `completar_emparelhamento`).
+    :return: Tupla (custo total, col_ind).
+    """
+    n = contar_fragmentos(frag1_proc_color)
+    peso_dif_imagens, peso_vgg, peso_sobel, peso_media_cor = weights
+
+    print(f"Buscando os {k_candidatos} candidatos mais próximos de cada fragmento...")
+    descritores1 = descritores_compactos(frag1_proc_color)
+    descritores2 = descritores_compactos(frag2_proc_color)
+    # Vizinhos nos dois sentidos: cada alvo recebe seus k doadores mais próximos e cada doador
+    # é oferecido aos seus k alvos mais próximos, para que nenhuma coluna fique sem arestas
+    vizinhos = candidatos_knn(descritores1, descritores2, k_candidatos)
+    vizinhos_reversos = candidatos_knn(descritores2, descritores1, k_candidatos)
+    linhas = np.concatenate((np.repeat(np.arange(n), vizinhos.shape[1]), vizinhos_reversos.ravel()))
+    colunas = np.concatenate((vizinhos.ravel(), np.repeat(np.arange(n), vizinhos_reversos.shape[1])))
+
+    linhas_extra, colunas_extra = completar_emparelhamento(linhas, colunas, descritores1, descritores2, k_candidatos)
+    if linhas_extra.size > 0:
+        print(f"Grafo de candidatos sem emparelhamento perfeito: adicionando {linhas_extra.size} arestas extras...")
+        linhas = np.concatenate((linhas, linhas_extra))
+        colunas = np.concatenate((colunas, colunas_extra))
+
+    # Remove arestas repetidas (um par pode aparecer nos dois sentidos da busca)
+    linhas, colunas = np.divmod(np.unique(linhas.astype(np.int64) * n + colunas), n)
+
+    print(f"Calculando custos de {linhas.size} arestas candidatas...")
+    custos = calc_cost_pares(
+        features1_vgg.astype(np.float32, copy=False), features2_vgg.astype(np.float32, copy=False),
+        como_grade(frag1_proc_color), como_grade(frag2_proc_color), como_grade(sobel1), como_grade(sobel2),
+        medias1, medias2, amplitude_cor(espaco_cor), linhas, colunas, peso_dif_imagens, peso_vgg, peso_sobel, peso_media_cor, metrica == "l2"
+    )
+
+    print("Resolvendo atribuição esparsa com Algoritmo do Jonker-Volgenant (lap.lapmod)...")
+    return resolver_esparso(n, linhas, colunas, custos)
 
 
-@njit(parallel=True)
-def calc_cost_matrix(features1_vgg, features2_vgg, frag1_proc_color, frag2_proc_color, sobel1, sobel2, n, peso_dif_imagens,
-                       peso_vgg, peso_sobel, peso_media_cor): # Adicionar peso_media_cor
-    """Calcula a matriz de custo na CPU."""
-    cost_matrix = np.zeros((n, n), dtype=np.float32)
+@njit(parallel=True, cache=True)
+def calc_cost_pares(features1_vgg, features2_vgg, frag1_proc_color, frag2_proc_color, sobel1, sobel2, medias1, medias2,
+                    amplitude, linhas, colunas, peso_dif_imagens, peso_vgg, peso_sobel, peso_media_cor, usar_l2):
+    """
+    Calcula na CPU o custo combinado apenas dos pares (linhas[e], colunas[e]). Cor e Sobel são
+    grids (h, w, fh, fw, 3), lidos como grid[k // w, k % w] (ver `como_grade`).
+    """
+    w1, w2 = frag1_proc_color.shape[1], frag2_proc_color.shape[1]
+    ws1, ws2 = sobel1.shape[1], sobel2.shape[1]
+    custos = np.zeros(linhas.shape[0], dtype=np.float32)
+    for e in prange(linhas.shape[0]):
+        i = linhas[e]
+        j = colunas[e]
+        cor1 = frag1_proc_color[i // w1, i % w1]
+        cor2 = frag2_proc_color[j // w2, j % w2]
+        # Similaridade de diferença de imagens
+        sim_dif_imagens = 0.0
+        if peso_dif_imagens > 0:
+            if usar_l2:
+                sim_dif_imagens = comp_imgs_dif_l2(cor1, cor2, amplitude)
+            else:
+                sim_dif_imagens = comp_imgs_dif(cor1, cor2, amplitude)
+        # Similaridade VGG
+        sim_vgg = np.dot(features1_vgg[i], features2_vgg[j]) if peso_vgg > 0 else 0.0
+        # Similaridade Sobel
+        sim_sobel = comp_sobel_dif(sobel1[i // ws1, i % ws1], sobel2[j // ws2, j % ws2]) if peso_sobel > 0 else 0.0
+        # Similaridade Média de Cor
+        sim_media_cor = 1.0 - np.sum(np.abs(medias1[i] - medias2[j]) / amplitude) / 3 if peso_media_cor > 0 else 0.0
+
+        final_similarity = (sim_dif_imagens * peso_dif_imagens) + \
+                           (sim_vgg * peso_vgg) + \
+                           (sim_sobel * peso_sobel) + \
+                           (sim_media_cor * peso_media_cor)
+        custos[e] = 1.0 - final_similarity
+    return custos
+
+
+@njit(parallel=True, cache=True)
+def calc_cost_matrix(features1_vgg, features2_vgg, frag1_proc_color, frag2_proc_color, sobel1, sobel2, amplitude,
+                       peso_dif_imagens, peso_vgg, peso_sobel):
+    """
+    Calcula a matriz de custo na CPU.
+    O termo de média de cor (e, conforme a métrica e os pesos, os termos L2 e VGG) é aplicado depois,
+    de forma vetorizada, em `montar_matriz_custo`.
+    Cor e Sobel são grids (h, w, fh, fw, 3), lidos como grid[k // w, k % w] (ver `como_grade`).
+    """
+    w1, w2 = frag1_proc_color.shape[1], frag2_proc_color.shape[1]
+    ws1, ws2 = sobel1.shape[1], sobel2.shape[1]
+    n1 = frag1_proc_color.shape[0] * w1
+    n2 = frag2_proc_color.shape[0] * w2
+    cost_matrix = np.zeros((n1, n2), dtype=np.float32)
     print("Calculando matriz de custo combinada na CPU...")
-    for i in prange(n):
-        for j in prange(n):
+    for i in prange(n1):
+        for j in prange(n2):
             # Similaridade de diferença de imagens
-            sim_dif_imagens = comp_imgs_dif(frag1_proc_color[i], frag2_proc_color[j]) if peso_dif_imagens > 0 else 0.0
+            sim_dif_imagens = comp_imgs_dif(frag1_proc_color[i // w1, i % w1], frag2_proc_color[j // w2, j % w2],
+                                            amplitude) if peso_dif_imagens > 0 else 0.0
             # Similaridade VGG
             sim_vgg = np.dot(features1_vgg[i], features2_vgg[j]) if peso_vgg > 0 else 0.0
             # Similaridade Sobel
-            sim_sobel = comp_sobel_dif(sobel1[i], sobel2[j]) if peso_sobel > 0 else 0.0
-            # Similaridade Média de Cor
-            sim_media_cor = comp_imgs_media_cor(frag1_proc_color[i], frag2_proc_color[j]) if peso_media_cor > 0 else 0.0
-
+            sim_sobel = comp_sobel_dif(sobel1[i // ws1, i % ws1], sobel2[j // ws2, j % ws2]) \
+                if peso_sobel > 0 else 0.0
 
             # Combinação ponderada das similaridades
             final_similarity = (sim_dif_imagens * peso_dif_imagens) + \
                                (sim_vgg * peso_vgg) + \
-                               (sim_sobel * peso_sobel) + \
-                               (sim_media_cor * peso_media_cor) # Incluir nova similaridade
+                               (sim_sobel * peso_sobel)
             cost_matrix[i, j] = 1.0 - final_similarity
     return cost_matrix
 
@@ -123,14 +948,21 @@ def calc_cost_matrix_kernel(
         features1_vgg, features2_vgg,
         frag1_proc_color, frag2_proc_color,
         sobel1, sobel2,
+        amplitude,
         cost_matrix,
-        peso_dif_imagens, peso_vgg, peso_sobel, peso_media_cor # Adicionar peso_media_cor
+        peso_dif_imagens, peso_vgg, peso_sobel
 ):
-    """Kernel CUDA para calcular a matriz de custo na GPU."""
+    """
+    Kernel CUDA para calcular a matriz de custo na GPU (sem o termo de média de cor). Cor e Sobel
+    são grids (h, w, fh, fw, 3), lidos como grid[k // w, k % w].
+    """
     i, j = cuda.grid(2)
     if i < cost_matrix.shape[0] and j < cost_matrix.shape[1]:
+        w1, w2 = frag1_proc_color.shape[1], frag2_proc_color.shape[1]
+        ws1, ws2 = sobel1.shape[1], sobel2.shape[1]
         # Similaridade de diferença de imagens
-        sim_dif_imagens = cu_comp_imgs_dif(frag1_proc_color[i], frag2_proc_color[j]) if peso_dif_imagens > 0 else 0.0
+        sim_dif_imagens = cu_comp_imgs_dif(frag1_proc_color[i // w1, i % w1], frag2_proc_color[j // w2, j % w2],
+                                           amplitude) if peso_dif_imagens > 0 else 0.0
 
         # Similaridade VGG
         sim_vgg = 0.0
@@ -139,16 +971,12 @@ def calc_cost_matrix_kernel(
                 sim_vgg += features1_vgg[i, k] * features2_vgg[j, k]
 
         # Similaridade Sobel
-        sim_sobel = cu_comp_sobel_dif(sobel1[i], sobel2[j]) if peso_sobel > 0 else 0.0
-
-        # Similaridade Média de Cor
-        sim_media_cor = cu_comp_imgs_media_cor(frag1_proc_color[i], frag2_proc_color[j]) if peso_media_cor > 0 else 0.0
+        sim_sobel = cu_comp_sobel_dif(sobel1[i // ws1, i % ws1], sobel2[j // ws2, j % ws2]) if peso_sobel > 0 else 0.0
 
         # Combinação ponderada e custo final
         final_similarity = (sim_dif_imagens * peso_dif_imagens) + \
                            (sim_vgg * peso_vgg) + \
-                           (sim_sobel * peso_sobel) + \
-                           (sim_media_cor * peso_media_cor) # Incluir nova similaridade
+                           (sim_sobel * peso_sobel)
         cost_matrix[i, j] = 1.0 - final_similarity
 
 
@@ -156,25 +984,29 @@ def calc_cost_matrix_cuda(
         features1_vgg, features2_vgg,
         frag1_proc_color, frag2_proc_color,
         sobel1, sobel2,
-        n, peso_dif_imagens, peso_vgg, peso_sobel, peso_media_cor # Adicionar peso_media_cor
+        amplitude,
+        peso_dif_imagens, peso_vgg, peso_sobel
 ):
     """Orquestra o cálculo da matriz de custo na GPU."""
     print("Iniciando cálculo da matriz de custo na GPU...")
 
-    # Transferir dados do Host (CPU) para o Device (GPU)
+    # Transferir dados do Host (CPU) para o Device (GPU); a cópia exige buffers contíguos
     print("Movendo dados para a memória da GPU...")
     d_features1_vgg = cuda.to_device(features1_vgg)
     d_features2_vgg = cuda.to_device(features2_vgg)
-    d_frag1_proc_color = cuda.to_device(frag1_proc_color)
-    d_frag2_proc_color = cuda.to_device(frag2_proc_color)
-    d_sobel1 = cuda.to_device(sobel1)
-    d_sobel2 = cuda.to_device(sobel2)
-    d_cost_matrix = cuda.device_array((n, n), dtype=np.float32)
+    d_frag1_proc_color = cuda.to_device(np.ascontiguousarray(frag1_proc_color))
+    d_frag2_proc_color = cuda.to_device(np.ascontiguousarray(frag2_proc_color))
+    d_sobel1 = cuda.to_device(np.ascontiguousarray(sobel1))
+    d_sobel2 = cuda.to_device(np.ascontiguousarray(sobel2))
+    d_amplitude = cuda.to_device(amplitude)
+    n1 = frag1_proc_color.shape[0] * frag1_proc_color.shape[1]
+    n2 = frag2_proc_color.shape[0] * frag2_proc_color.shape[1]
+    d_cost_matrix = cuda.device_array((n1, n2), dtype=np.float32)
 
     # Configuração de lançamento do Kernel
     threads_per_block = (16, 16)
-    blocks_per_grid_x = int(np.ceil(n / threads_per_block[0]))
-    blocks_per_grid_y = int(np.ceil(n / threads_per_block[1]))
+    blocks_per_grid_x = int(np.ceil(n1 / threads_per_block[0]))
+    blocks_per_grid_y = int(np.ceil(n2 / threads_per_block[1]))
     blocks_per_grid = (blocks_per_grid_x, blocks_per_grid_y)
 
     # Lançar o Kernel
@@ -183,8 +1015,9 @@ def calc_cost_matrix_cuda(
         d_features1_vgg, d_features2_vgg,
         d_frag1_proc_color, d_frag2_proc_color,
         d_sobel1, d_sobel2,
+        d_amplitude,
         d_cost_matrix,
-        peso_dif_imagens, peso_vgg, peso_sobel, peso_media_cor # Passar novo peso
+        peso_dif_imagens, peso_vgg, peso_sobel
     )
 
     # Copiar o resultado de volta para o Host
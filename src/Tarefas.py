@@ -0,0 +1,158 @@
+import threading
+import time
+import uuid
+
+# Estados de uma tarefa; as três últimas são finais
+ESTADOS = ("na_fila", "executando", "concluida", "erro", "cancelada")
+ESTADOS_FINAIS = ("concluida", "erro", "cancelada")
+# Tarefas finalizadas mantidas no registro para consulta; as mais antigas são descartadas
+MAX_TAREFAS_FINALIZADAS = 100
+# Total de bytes das codificações guardadas nos resultados das tarefas; ao anexar um resultado
+# novo, os que vencem primeiro são descartados até caber
+MAX_BYTES_RESULTADOS = 256 * 2 ** 20
+
+_tarefas: dict[str, dict] = {}
+_bytes_resultados = 0
+_trava = threading.Lock()
+
+
+class TarefaCancelada(Exception):
+    """Levantada dentro da tarefa, na chamada de progresso seguinte a um pedido de cancelamento."""
+
+
+def criar_tarefa(parametros: dict) -> dict:
+    """Registra uma nova tarefa na fila e a devolve."""
+    tarefa = {
+        "id": uuid.uuid4().hex,
+        "estado": "na_fila",
+        "etapa": None,
+        "fracao": 0.0,
+        "erro": None,
+        "parametros": parametros,
+        "criada": time.time(),
+        "finalizada": None,
+        "eventos": [],
+        "resultado": None,
+    }
+    with _trava:
+        _tarefas[tarefa["id"]] = tarefa
+        _descartar_antigas()
+    return tarefa
+
+
+def obter_tarefa(id_tarefa: str) -> dict | None:
+    with _trava:
+        return _tarefas.get(id_tarefa)
+
+
+def ler_eventos(id_tarefa: str, inicio: int) -> tuple[list[dict], bool] | None:
+    """
+    Eventos da tarefa a partir do índice `inicio`, lidos com `_trava`.
+    :return: (eventos novos, se a tarefa já está num estado final), ou None se a tarefa não está
+        (ou não está mais) no registro.
+    """
+    with _trava:
+        tarefa = _tarefas.get(id_tarefa)
+        if tarefa is None:
+            return None
+        return tarefa["eventos"][inicio:], tarefa["estado"] in ESTADOS_FINAIS
+
+
+def publicar(tarefa: dict, etapa: str, fracao: float, estado: str | None = None, erro: str | None = None):
+    """
+    Registra o avanço da tarefa e acrescenta um evento à sua lista, lida pelos assinantes do
+    progresso.
+    """
+    with _trava:
+        tarefa["etapa"] = etapa
+        tarefa["fracao"] = fracao
+        if estado is not None:
+            tarefa["estado"] = estado
+        if erro is not None:
+            tarefa["erro"] = erro
+        if tarefa["estado"] in ESTADOS_FINAIS:
+            tarefa["finalizada"] = time.time()
+        tarefa["eventos"].append(resumo(tarefa))
+
+
+def anexar_resultado(tarefa: dict, ttl: float, codificados: dict[tuple[str, int], bytes]):
+    """
+    Guarda o resultado da tarefa em memória por `ttl` segundos, só já codificado (a imagem em si
+    não é mantida), e descarta os resultados vencidos das demais tarefas e, se o total passar de
+    `MAX_BYTES_RESULTADOS`, os que vencem primeiro.
+    :param codificados: Codificações prontas, por (formato, nivel); ao menos a padrão.
+    """
+    global _bytes_resultados
+    with _trava:
+        _descartar_resultado(tarefa)
+        tarefa["resultado"] = {"codificados": dict(codificados), "expira": time.time() + ttl}
+        _bytes_resultados += sum(len(dados) for dados in codificados.values())
+
+        agora = time.time()
+        for outra in sorted(
+                (t for t in _tarefas.values() if t["resultado"] is not None and t is not tarefa),
+                key=lambda t: t["resultado"]["expira"]
+        ):
+            if outra["resultado"]["expira"] >= agora and _bytes_resultados <= MAX_BYTES_RESULTADOS:
+                break
+            _descartar_resultado(outra)
+
+
+def guardar_codificacao(tarefa: dict, chave: tuple[str, int], dados: bytes):
+    """
+    Acrescenta ao resultado da tarefa mais uma codificação, se ele ainda existe e se ela cabe em
+    `MAX_BYTES_RESULTADOS`; senão ela só é servida, sem ficar guardada.
+    """
+    global _bytes_resultados
+    with _trava:
+        resultado = tarefa["resultado"]
+        if resultado is None or chave in resultado["codificados"]:
+            return
+        if _bytes_resultados + len(dados) > MAX_BYTES_RESULTADOS:
+            return
+        resultado["codificados"][chave] = dados
+        _bytes_resultados += len(dados)
+
+
+def obter_resultado_tarefa(tarefa: dict) -> dict | None:
+    """
+    :return: {"codificados", "expira"} da tarefa, ou None se ela não tem resultado ou se ele já
+        venceu (ou foi descartado).
+    """
+    with _trava:
+        resultado = tarefa["resultado"]
+        if resultado is not None and resultado["expira"] < time.time():
+            _descartar_resultado(tarefa)
+            resultado = None
+        return resultado
+
+
+def resumo(tarefa: dict) -> dict:
+    """Campos públicos (serializáveis em JSON) da tarefa."""
+    return {
+        "id": tarefa["id"],
+        "estado": tarefa["estado"],
+        "etapa": tarefa["etapa"],
+        "fracao": tarefa["fracao"],
+        "erro": tarefa["erro"],
+        "criada": tarefa["criada"],
+        "finalizada": tarefa["finalizada"],
+        "resultado": tarefa["resultado"] is not None,
+    }
+
+
+def _descartar_antigas():
+    finalizadas = sorted(
+        (t for t in _tarefas.values() if t["estado"] in ESTADOS_FINAIS), key=lambda t: t["finalizada"]
+    )
+    for tarefa in finalizadas[:max(0, len(finalizadas) - MAX_TAREFAS_FINALIZADAS)]:
+        _descartar_resultado(tarefa)
+        del _tarefas[tarefa["id"]]
+
+
+def _descartar_resultado(tarefa: dict):
+    """Chamada com `_trava`: descarta o resultado da tarefa, descontando seus bytes do total."""
+    global _bytes_resultados
+    if tarefa["resultado"] is not None:
+        _bytes_resultados -= sum(len(dados) for dados in tarefa["resultado"]["codificados"].values())
+        tarefa["resultado"] = None
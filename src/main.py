@@ -1,79 +1,256 @@
+import argparse
+import glob
+import json
 import os
+import time
 from multiprocessing import Pool, cpu_count
+
+import numba
 from tqdm import tqdm
 
-from src.Features.Dif import replace
-from src.Fragmentos import LoadImage, get_fragmentos, SaveImage
+from src.MemoriaCompartilhada import compartilhar_arrays, anexar_arrays, liberar_arrays
+from src.Replace import replace, calcular_descritores
+from src.Fragmentos import LoadImage, fragmentos_view, SaveImage
 
+TAMANHO_FRAGMENTO = 10
+PESOS = (1.0, 0.0, 0.0, 0.0)
+YUV = False
+# Modo dos descritores VGG (ver Replace.MODOS_VGG); só é usado quando o peso VGG é maior que zero
+MODO_VGG = "fragmento"
+ENTRADA = "imgs/frames_bad_apple/*.jpg"
+SAIDA = "imgs/frames_bad_apple_replaced/{nome}.jpg"
+DOADORA = "imgs/frierin_bad_apple.png"
+# Processa os frames em ordem num único processo, partindo da atribuição do frame anterior
+MODO_SEQUENCIAL = False
+# Frames concluídos entre duas gravações do manifesto (ele também é gravado no fim)
+INTERVALO_MANIFESTO = 50
 
-def get_process_count():
-    max_cpus = cpu_count()
-    print(f"\nSeu sistema tem {max_cpus} núcleos de CPU disponíveis")
+# Descritores da imagem doadora, anexados da memória compartilhada em cada worker
+_descritores_doadora = None
+_blocos_doadora = None
 
-    while True:
-        try:
-            num_processes = int(input(f"Quantos processos deseja utilizar (1-{max_cpus})? "))
-            if 1 <= num_processes <= max_cpus:
-                return num_processes
-            print(f"Por favor, insira um número entre 1 e {max_cpus}")
-        except ValueError:
-            print("Por favor, insira um número válido")
+
+def init_worker(specs, processos):
+    """
+    Anexa, somente para leitura, os descritores da doadora calculados no processo principal, e
+    limita as threads do numba à parte dos núcleos de cada um dos `processos` workers.
+    """
+    global _descritores_doadora, _blocos_doadora
+    numba.set_num_threads(max(1, cpu_count() // processos))
+    _descritores_doadora, _blocos_doadora = anexar_arrays(specs)
+
+
+def caminho_saida(entrada: str, padrao_saida: str) -> str:
+    """
+    Caminho de saída de um frame: `{nome}` no padrão é trocado pelo nome do arquivo de entrada
+    sem extensão.
+    """
+    return padrao_saida.format(nome=os.path.splitext(os.path.basename(entrada))[0])
+
+
+def salvar_atomico(img, caminho: str):
+    """
+    Salva num arquivo temporário ao lado do destino e o renomeia, para que uma interrupção nunca
+    deixe um frame pela metade que seria tomado como pronto ao retomar.
+    """
+    raiz, extensao = os.path.splitext(caminho)
+    temporario = f"{raiz}.parcial{extensao}"
+    SaveImage(img, temporario)
+    os.replace(temporario, caminho)
+
+
+def renderizar_frame(entrada, saida, tamanho_fragmento, yuv, descritores, **kwargs):
+    img_1 = LoadImage(entrada)
+    fragmentos_1 = fragmentos_view(img_1, tamanho_fragmento)
+
+    replaced_img = replace(
+        fragmentos_1, None, weights=PESOS, yuv=yuv, modo_vgg=MODO_VGG, descritores_2=descritores, **kwargs
+    )
+    salvar_atomico(replaced_img, saida)
 
 
 def process_frame(args):
-    i, yuv_flag = args
+    entrada, saida, tamanho_fragmento, yuv = args
+    inicio = time.perf_counter()
     try:
-        img_2 = LoadImage(f"imgs/frierin_bad_apple.png")
-        img_1 = LoadImage(f"imgs/frames_bad_apple/{i + 1:03d}.jpg")
+        renderizar_frame(entrada, saida, tamanho_fragmento, yuv, _descritores_doadora)
+        return entrada, saida, time.perf_counter() - inicio, None
+    except Exception as e:
+        return entrada, saida, time.perf_counter() - inicio, str(e)
 
-        fragmentos_1 = get_fragmentos(img_1, 10)
-        fragmentos_2 = get_fragmentos(img_2, 10)
 
-        replaced_img = replace(fragmentos_1, fragmentos_2, yuv=yuv_flag)
-        SaveImage(replaced_img, f"imgs/frames_bad_apple_replaced/{i + 1:03d}.jpg")
+def carregar_manifesto(caminho: str, config: dict) -> tuple[dict, bool]:
+    """
+    Lê o manifesto de um render anterior.
+    :return: O manifesto e se as saídas já gravadas valem para esta configuração. Se o render
+        anterior foi feito com outra configuração, o manifesto recomeça vazio.
+    """
+    if os.path.exists(caminho):
+        with open(caminho, encoding="utf-8") as arquivo:
+            manifesto = json.load(arquivo)
+        if manifesto.get("config") == config:
+            return manifesto, True
+        print("Configuração diferente da do manifesto existente: todos os frames serão refeitos")
+        return {"config": config, "frames": {}}, False
+    return {"config": config, "frames": {}}, True
 
-        return True
-    except Exception as e:
-        print(f"\nErro ao processar frame {i}: {str(e)}")
-        return False
+
+def salvar_manifesto(caminho: str, manifesto: dict):
+    temporario = caminho + ".parcial"
+    with open(temporario, "w", encoding="utf-8") as arquivo:
+        json.dump(manifesto, arquivo, indent=2, ensure_ascii=False)
+    os.replace(temporario, caminho)
 
 
-def process_chunk(start, end, num_processes, yuv=False):
-    tasks = [(i, yuv) for i in range(start, end)]
+def registrar_frame(caminho: str, manifesto: dict, entrada: str, saida: str, segundos: float):
+    """
+    Registra um frame concluído no manifesto e o grava a cada `INTERVALO_MANIFESTO` frames, para
+    que o custo de gravação não cresça com o quadrado do número de frames. Um frame concluído
+    depois da última gravação não se perde ao retomar: a saída dele já existe e é pulada.
+    """
+    manifesto["frames"][entrada] = {"saida": saida, "segundos": round(segundos, 3)}
+    if len(manifesto["frames"]) % INTERVALO_MANIFESTO == 0:
+        salvar_manifesto(caminho, manifesto)
 
-    with Pool(processes=num_processes) as pool:
-        with tqdm(total=len(tasks), desc=f"Processando {start}-{end}", unit='frame') as pbar:
-            results = []
-            for result in pool.imap_unordered(process_frame, tasks):
+
+def process_pool(tarefas, num_processes, specs, manifesto, caminho_manifesto):
+    """
+    Um único pool persistente consome todos os frames pendentes: cada worker anexa os
+    descritores da doadora e compila os kernels uma só vez. Os frames concluídos viram
+    checkpoints no manifesto (ver `registrar_frame`).
+    """
+    falhas = 0
+    with Pool(processes=num_processes, initializer=init_worker, initargs=(specs, num_processes)) as pool:
+        with tqdm(total=len(tarefas), desc="Processando", unit='frame') as pbar:
+            try:
+                for entrada, saida, segundos, erro in pool.imap_unordered(process_frame, tarefas):
+                    if erro is None:
+                        registrar_frame(caminho_manifesto, manifesto, entrada, saida, segundos)
+                    else:
+                        falhas += 1
+                        print(f"\nErro ao processar frame {entrada}: {erro}")
+                    pbar.update(1)
+            finally:
+                salvar_manifesto(caminho_manifesto, manifesto)
+    return falhas
+
+
+def process_sequential(tarefas, descritores, manifesto, caminho_manifesto):
+    """
+    Processa os frames em ordem, reaproveitando do frame anterior a matriz de custo e a solução
+    da atribuição (permutação e variáveis duais). Entre frames parecidos, só as linhas de
+    fragmentos alterados são recalculadas e reatribuídas.
+    """
+    estado = {}
+    falhas = 0
+    with tqdm(total=len(tarefas), desc="Processando (sequencial)", unit='frame') as pbar:
+        try:
+            for entrada, saida, tamanho_fragmento, yuv in tarefas:
+                inicio = time.perf_counter()
+                try:
+                    renderizar_frame(
+                        entrada, saida, tamanho_fragmento, yuv, descritores,
+                        atribuicao="incremental", estado=estado
+                    )
+                except Exception as e:
+                    falhas += 1
+                    estado.clear()
+                    print(f"\nErro ao processar frame {entrada}: {str(e)}")
+                    pbar.update(1)
+                    continue
+
+                registrar_frame(caminho_manifesto, manifesto, entrada, saida, time.perf_counter() - inicio)
+
+                print(f"\nFrame {entrada}: {100 * estado['fracao_recalculada']:.1f}% das linhas de custo "
+                      f"recalculadas, {estado['linhas_reinseridas']} linhas reinseridas, "
+                      f"{estado['iteracoes']} iterações até convergir")
+                pbar.set_postfix(iteracoes=estado['iteracoes'])
                 pbar.update(1)
-                results.append(result)
+        finally:
+            salvar_manifesto(caminho_manifesto, manifesto)
+    return falhas
+
 
-            success_rate = (sum(results) / len(results)) * 100
-            print(f"\nIntervalo {start}-{end} concluído com {success_rate:.2f}% de sucesso")
+def parse_args():
+    parser = argparse.ArgumentParser(description="Renderiza em lote os frames de entrada com os fragmentos da doadora.")
+    parser.add_argument("--entrada", default=ENTRADA, help="Glob dos frames de entrada")
+    parser.add_argument("--saida", default=SAIDA, help="Padrão do caminho de saída; {nome} é o nome do frame")
+    parser.add_argument("--doadora", default=DOADORA, help="Imagem doadora dos fragmentos")
+    parser.add_argument("--fragmento", type=int, default=TAMANHO_FRAGMENTO, help="Tamanho do fragmento em pixels")
+    parser.add_argument("--processos", type=int, default=cpu_count(), help="Número de processos do pool")
+    parser.add_argument("--manifesto", default=None,
+                        help="Arquivo de checkpoints (padrão: manifesto.json na pasta de saída)")
+    parser.add_argument("--yuv", action="store_true", default=YUV, help="Compara as cores em YUV")
+    parser.add_argument("--sequencial", action="store_true", default=MODO_SEQUENCIAL,
+                        help="Processa em ordem num único processo, partindo do frame anterior")
+    parser.add_argument("--refazer", action="store_true", help="Refaz também os frames que já têm saída")
+    args = parser.parse_args()
+    if "{nome}" not in args.saida:
+        parser.error("--saida precisa conter {nome}; sem ele todos os frames iriam para o mesmo arquivo")
+    return args
 
 
 def main():
-    # Configuração inicial
-    full_end = len(os.listdir("imgs/frames_bad_apple/"))
+    args = parse_args()
 
-    # Obter número de processos desejado
-    num_processes = get_process_count()
-    print(f"\nIniciando processamento com {num_processes} processos...")
+    entradas = sorted(glob.glob(args.entrada))
+    if not entradas:
+        print(f"Nenhum frame encontrado em {args.entrada}")
+        return
 
-    # Dividir o trabalho em partes
-    chunk_size = max(1, full_end // num_processes)
-    ranges = []
-    for i in range(num_processes):
-        start = i * chunk_size
-        end = (i + 1) * chunk_size if i < num_processes - 1 else full_end
-        ranges.append((start, end))
+    pasta_saida = os.path.dirname(caminho_saida(entradas[0], args.saida)) or "."
+    os.makedirs(pasta_saida, exist_ok=True)
+    caminho_manifesto = args.manifesto or os.path.join(pasta_saida, "manifesto.json")
 
-    # Processar cada parte
-    for start, end in ranges:
-        process_chunk(start, end, num_processes)
+    config = {
+        "doadora": os.path.abspath(args.doadora),
+        "fragmento": args.fragmento,
+        "pesos": list(PESOS),
+        "modo_vgg": MODO_VGG,
+        "yuv": args.yuv,
+        "saida": args.saida,
+    }
+    manifesto, compativel = carregar_manifesto(caminho_manifesto, config)
+    refazer = args.refazer or not compativel
+    if refazer:
+        manifesto["frames"] = {}
+
+    # Frames com saída já gravada são pulados; as saídas são escritas de forma atômica, então
+    # um arquivo existente é sempre um frame completo
+    tarefas = []
+    for entrada in entradas:
+        saida = caminho_saida(entrada, args.saida)
+        if not refazer and os.path.exists(saida):
+            continue
+        tarefas.append((entrada, saida, args.fragmento, args.yuv))
+
+    print(f"{len(entradas) - len(tarefas)} de {len(entradas)} frames já renderizados")
+    if not tarefas:
+        print("\nProcessamento concluído!")
+        return
+
+    # A doadora é a mesma em todos os frames: fragmentos e descritores são calculados uma
+    # única vez e compartilhados com os workers
+    print("Calculando descritores da imagem doadora...")
+    img_2 = LoadImage(args.doadora)
+    descritores = calcular_descritores(
+        fragmentos_view(img_2, args.fragmento), PESOS, args.yuv, rotulo="doador", modo_vgg=MODO_VGG
+    )
+
+    if args.sequencial:
+        falhas = process_sequential(tarefas, descritores, manifesto, caminho_manifesto)
+    else:
+        num_processes = max(1, min(args.processos, len(tarefas)))
+        print(f"\nIniciando processamento com {num_processes} processos...")
+
+        blocos, specs = compartilhar_arrays(descritores)
+        try:
+            falhas = process_pool(tarefas, num_processes, specs, manifesto, caminho_manifesto)
+        finally:
+            liberar_arrays(blocos)
 
-    print("\nProcessamento concluído!")
+    print(f"\nProcessamento concluído! {len(tarefas) - falhas} frames renderizados, {falhas} falhas")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -3,9 +3,10 @@ import shutil
 
 import pygame as pg
 
-from Fragmentos import get_fragmentos, save_fragmentos, SaveImage, LoadImage
-from Features.Edge import *
-from Features.Dif import replace, covert_to_YUV
+from src.Fragmentos import get_fragmentos, save_fragmentos, SaveImage, LoadImage
+from src.Features.Edge import *
+from src.Features.Filtros import gaussian_blur, save_array_as_image
+from src.Features.Dif import covert_to_YUV
 
 pg.init()
 
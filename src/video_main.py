@@ -0,0 +1,220 @@
+import argparse
+import multiprocessing
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+from src.MemoriaCompartilhada import compartilhar_arrays, anexar_arrays, liberar_arrays
+from src.Replace import replace, calcular_descritores
+from src.Fragmentos import LoadImage, fragmentos_view
+from src.main import PESOS, TAMANHO_FRAGMENTO, YUV, MODO_VGG, DOADORA
+
+VIDEO_ENTRADA = "imgs/bad_apple.mp4"
+VIDEO_SAIDA = "imgs/bad_apple_replaced.mp4"
+
+
+def worker_video(specs, specs_quadros, tarefas, resultados, tamanho_fragmento, yuv):
+    """
+    Laço de um worker: recebe (índice, frame BGR, slot) da fila de tarefas até encontrar None,
+    monta o frame renderizado, já em BGR, direto no slot compartilhado que vai para o
+    `cv2.VideoWriter` e devolve (índice, slot, erro) na fila de resultados. Se o frame falhar, o
+    slot recebe o próprio frame de entrada para não abrir um buraco no vídeo.
+    """
+    descritores, blocos = anexar_arrays(specs)
+    quadros, blocos_quadros = anexar_arrays(specs_quadros, somente_leitura=False)
+    quadros = quadros["quadros"]
+    try:
+        while (tarefa := tarefas.get()) is not None:
+            i, frame, slot = tarefa
+            try:
+                fragmentos_1 = fragmentos_view(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), tamanho_fragmento)
+                replace(
+                    fragmentos_1, None, weights=PESOS, yuv=yuv, modo_vgg=MODO_VGG,
+                    descritores_2=descritores, saida=quadros[slot], saida_bgr=True
+                )
+                resultados.put((i, slot, None))
+            except Exception as e:
+                altura, largura = quadros.shape[1:3]
+                quadros[slot] = 0
+                recorte = frame[:altura, :largura]
+                quadros[slot, :recorte.shape[0], :recorte.shape[1]] = recorte
+                resultados.put((i, slot, str(e)))
+    finally:
+        for bloco in blocos + blocos_quadros:
+            bloco.close()
+
+
+def ler_frames(captura, tarefas, livres: queue.Queue, n_workers: int, lidos: list[int]):
+    """
+    Decodifica o vídeo e enfileira cada frame com um slot livre de saída. Há um slot por frame
+    em processamento ou esperando no buffer de reordenação, então a leitura pausa quando a
+    escrita fica para trás. Ao final, envia um None por worker e registra o total lido em `lidos`.
+    """
+    i = 0
+    while True:
+        ok, frame = captura.read()
+        if not ok:
+            break
+        tarefas.put((i, frame, livres.get()))
+        i += 1
+    lidos.append(i)
+    for _ in range(n_workers):
+        tarefas.put(None)
+
+
+def renderizar_video(
+        video_entrada: str,
+        video_saida: str,
+        descritores: dict[str, np.ndarray],
+        num_processes: int,
+        tamanho_fragmento: int = TAMANHO_FRAGMENTO,
+        yuv: bool = YUV,
+        max_em_voo: int | None = None,
+        fourcc: str = "mp4v",
+        fps: float | None = None
+) -> int:
+    """
+    Renderiza um vídeo frame a frame sem diretórios intermediários: uma thread decodifica com
+    `cv2.VideoCapture` para uma fila limitada, os workers a consomem e escrevem o resultado num
+    dos slots de quadro em memória compartilhada, e um buffer de reordenação entrega os slots,
+    em ordem, ao `cv2.VideoWriter`.
+    :param descritores: Descritores da doadora, compartilhados com os workers.
+    :param max_em_voo: Máximo de frames decodificados ainda não escritos, que é também o número de
+        slots de quadro (padrão: 2 por worker).
+    :param fps: FPS do vídeo de saída (padrão: o da entrada).
+    :return: Número de frames que falharam e foram escritos sem substituição.
+    """
+    captura = cv2.VideoCapture(video_entrada)
+    if not captura.isOpened():
+        raise ValueError(f"Não foi possível abrir o vídeo {video_entrada}")
+    fps = fps or captura.get(cv2.CAP_PROP_FPS) or 24.0
+    total = int(captura.get(cv2.CAP_PROP_FRAME_COUNT)) or None
+    max_em_voo = max_em_voo or 2 * num_processes
+
+    # O frame de saída é a área coberta por fragmentos inteiros
+    altura = int(captura.get(cv2.CAP_PROP_FRAME_HEIGHT)) // tamanho_fragmento * tamanho_fragmento
+    largura = int(captura.get(cv2.CAP_PROP_FRAME_WIDTH)) // tamanho_fragmento * tamanho_fragmento
+    if altura == 0 or largura == 0:
+        captura.release()
+        raise ValueError(f"O vídeo {video_entrada} é menor que um fragmento")
+
+    # spawn: os workers não herdam as threads da leitura nem as do numba/torch do processo principal
+    contexto = multiprocessing.get_context("spawn")
+    tarefas = contexto.Queue(maxsize=max_em_voo)
+    resultados = contexto.Queue()
+    livres = queue.Queue()
+    for slot in range(max_em_voo):
+        livres.put(slot)
+    lidos = []
+
+    blocos, specs = compartilhar_arrays(descritores)
+    blocos_quadros, specs_quadros = compartilhar_arrays(
+        {"quadros": np.zeros((max_em_voo, altura, largura, 3), dtype=np.uint8)}
+    )
+    quadros, blocos_anexados = anexar_arrays(specs_quadros)
+    quadros = quadros["quadros"]
+    workers = [
+        contexto.Process(
+            target=worker_video, args=(specs, specs_quadros, tarefas, resultados, tamanho_fragmento, yuv),
+            daemon=True
+        )
+        for _ in range(num_processes)
+    ]
+    leitor = threading.Thread(
+        target=ler_frames, args=(captura, tarefas, livres, num_processes, lidos), daemon=True
+    )
+
+    writer = cv2.VideoWriter(video_saida, cv2.VideoWriter_fourcc(*fourcc), fps, (largura, altura))
+    falhas = 0
+    proximo = 0
+    reordenacao = {}
+    concluido = False
+    try:
+        if not writer.isOpened():
+            raise ValueError(f"Não foi possível abrir {video_saida} para escrita")
+        for worker in workers:
+            worker.start()
+        leitor.start()
+
+        with tqdm(total=total, desc="Renderizando vídeo", unit='frame') as pbar:
+            while not (lidos and proximo == lidos[0]):
+                # Um worker só sai com código 0 depois de receber None, ao fim da leitura; qualquer
+                # outro código (exceção fora do frame, sinal, falta de memória) significa que o frame
+                # dele nunca vai chegar, e esperar deixaria a renderização parada para sempre
+                mortos = [worker for worker in workers if worker.exitcode not in (None, 0)]
+                if mortos:
+                    raise RuntimeError(
+                        f"Worker {mortos[0].pid} terminou com código {mortos[0].exitcode} com frames pendentes"
+                    )
+                try:
+                    i, slot, erro = resultados.get(timeout=1.0)
+                except queue.Empty:
+                    if not any(worker.is_alive() for worker in workers):
+                        raise RuntimeError("Todos os workers terminaram antes do fim do vídeo")
+                    continue
+
+                if erro is not None:
+                    falhas += 1
+                    print(f"\nErro ao processar frame {i}: {erro}")
+                reordenacao[i] = slot
+
+                while proximo in reordenacao:
+                    slot = reordenacao.pop(proximo)
+                    writer.write(quadros[slot])
+                    livres.put(slot)
+                    proximo += 1
+                    pbar.update(1)
+        concluido = True
+    finally:
+        for worker in workers:
+            if not concluido and worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            if worker.pid is not None:
+                worker.join(timeout=5.0)
+        captura.release()
+        writer.release()
+        for bloco in blocos_anexados:
+            bloco.close()
+        liberar_arrays(blocos + blocos_quadros)
+
+    return falhas
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Renderiza um vídeo com os fragmentos da doadora, sem frames em disco.")
+    parser.add_argument("--entrada", default=VIDEO_ENTRADA, help="Vídeo de entrada")
+    parser.add_argument("--saida", default=VIDEO_SAIDA, help="Vídeo de saída")
+    parser.add_argument("--doadora", default=DOADORA, help="Imagem doadora dos fragmentos")
+    parser.add_argument("--fragmento", type=int, default=TAMANHO_FRAGMENTO, help="Tamanho do fragmento em pixels")
+    parser.add_argument("--processos", type=int, default=os.cpu_count(), help="Número de processos workers")
+    parser.add_argument("--em-voo", type=int, default=None,
+                        help="Máximo de frames decodificados ainda não escritos (padrão: 2 por worker)")
+    parser.add_argument("--fourcc", default="mp4v", help="Codec do vídeo de saída")
+    parser.add_argument("--fps", type=float, default=None, help="FPS da saída (padrão: o da entrada)")
+    parser.add_argument("--yuv", action="store_true", default=YUV, help="Compara as cores em YUV")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    print("Calculando descritores da imagem doadora...")
+    img_2 = LoadImage(args.doadora)
+    descritores = calcular_descritores(
+        fragmentos_view(img_2, args.fragmento), PESOS, args.yuv, rotulo="doador", modo_vgg=MODO_VGG
+    )
+
+    falhas = renderizar_video(
+        args.entrada, args.saida, descritores, max(1, args.processos), args.fragmento, args.yuv,
+        args.em_voo, args.fourcc, args.fps
+    )
+    print(f"\nVídeo {args.saida} concluído com {falhas} falhas")
+
+
+if __name__ == "__main__":
+    main()
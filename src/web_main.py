@@ -1,15 +1,81 @@
-import os
-import shutil
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
 from typing import Optional
 
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, StreamingResponse, Response
+from PIL import UnidentifiedImageError
 
-from src.Fragmentos import get_fragmentos, SaveImage, LoadImage
-from src.Replace import replace
+from src.CacheResultados import configurar_cache_resultados, chave_resultado, obter_resultado, guardar_resultado, \
+    estatisticas_cache_resultados
+from src.Fragmentos import EncodeImage, FromBytes, ReadUpload, ImageSize
+from src.Replace import METRICAS
+from src.PoolReplace import iniciar_pool, encerrar_pool, pool_ativo, fila_cheia, submeter, cancelar, info_pool, \
+    modelos_pool
+from src.Tarefas import criar_tarefa, obter_tarefa, ler_eventos, publicar, resumo, anexar_resultado, \
+    guardar_codificacao, obter_resultado_tarefa, ESTADOS_FINAIS
 
-app = FastAPI()
+# Cache em disco dos descritores: reenviar a mesma imagem pula direto para a matriz de custo
+CACHE_DESCRITORES = "cache/descritores"
+CACHE_MAX_MB = 2048.0
+
+# Cache dos resultados já codificados, por conteúdo das imagens e parâmetros: reenviar o mesmo par
+# (recarregar a página, clique duplo) responde na hora. A camada em disco sobrevive a reinícios.
+CACHE_RESULTADOS_MB = 256.0
+CACHE_RESULTADOS_DISCO = "cache/resultados"
+CACHE_RESULTADOS_DISCO_MB = 1024.0
+
+# Formatos de /jobs/{id}/result: tipo MIME, nível padrão e faixa do nível (compressão do PNG,
+# qualidade do WebP/JPEG). O PNG padrão usa compressão rápida; é também o formato guardado no cache.
+FORMATOS_RESULTADO = {
+    "png": ("image/png", 1, range(0, 10)),
+    "webp": ("image/webp", 90, range(1, 101)),
+    "jpeg": ("image/jpeg", 90, range(1, 101)),
+}
+# Tempo, em segundos, que o resultado de cada tarefa fica em memória
+TTL_RESULTADO = 600.0
+
+# Limites das imagens enviadas: tamanho do arquivo e pixels (largura * altura) do original
+MAX_BYTES_UPLOAD = 32 * 2 ** 20
+MAX_PIXELS_UPLOAD = 100_000_000
+# Imagens com mais fragmentos que isso são reduzidas já na decodificação (ver Fragmentos.FromBytes),
+# limitando a matriz de custo a MAX_FRAGMENTOS² entradas. None desativa a redução.
+MAX_FRAGMENTOS = 4096
+
+# Cada worker carrega a VGG16 ao subir o servidor, em vez de na primeira requisição com peso VGG
+PRE_CARREGAR_VGG = True
+
+# Processos workers, cada um com uma tarefa por vez (limite de concorrência); os núcleos são
+# divididos entre eles
+PROCESSOS_REPLACE = 2
+# Tarefas esperando um worker livre; além disso o /update responde 429
+MAX_FILA = 8
+# Sugestão de espera (Retry-After) para o cliente quando a fila está cheia, em segundos
+ESPERA_FILA_CHEIA = 5
+
+# Intervalo, em segundos, com que o fluxo de eventos de uma tarefa verifica novos eventos
+INTERVALO_EVENTOS = 0.2
+# Duração máxima, em segundos, de um fluxo de eventos; depois disso ele é fechado e o cliente
+# pode reconectar ou consultar /jobs/{id}
+DURACAO_MAX_EVENTOS = 3600.0
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    # Os workers compilam os kernels (e carregam a VGG) em paralelo; tarefas recebidas antes
+    # disso esperam na fila
+    configurar_cache_resultados(
+        int(CACHE_RESULTADOS_MB * 2 ** 20), CACHE_RESULTADOS_DISCO, int(CACHE_RESULTADOS_DISCO_MB * 2 ** 20)
+    )
+    iniciar_pool(PROCESSOS_REPLACE, MAX_FILA, PRE_CARREGAR_VGG, ao_concluir=concluir_tarefa)
+    yield
+    await asyncio.to_thread(encerrar_pool)
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Permite acesso do frontend local (CORS)
 app.add_middleware(
@@ -54,6 +120,7 @@ async def update(
         receptora: Optional[UploadFile] = File(None),
         doadora: Optional[UploadFile] = File(None),
         yuv: bool = Form(True),
+        metrica: str = Form("l1"),
         tamanho: int = Form(...),
         # Novos parâmetros para os pesos da similaridade
         peso_dif_imagens: float = Form(...), # Renomeado
@@ -61,6 +128,11 @@ async def update(
         peso_sobel: float = Form(...),
         peso_media_cor: float = Form(...) # Novo peso para média de cor
 ):
+    """
+    Recebe as imagens e os parâmetros e cria uma tarefa, que roda fora do event loop.
+    Devolve o id da tarefa na hora; o andamento sai em /jobs/{id} e /jobs/{id}/eventos, e a
+    imagem em /jobs/{id}/result.
+    """
     # Normaliza os pesos para que a soma seja 1, garantindo uma ponderação consistente.
     total_peso = peso_dif_imagens + peso_vgg + peso_sobel + peso_media_cor
     if total_peso > 0:
@@ -79,51 +151,190 @@ async def update(
     print("Recebendo parâmetros...")
     print(f"""
     YUV: {yuv}
+    Métrica da diferença de imagens: {metrica}
     Tamanho do fragmento: {tamanho}
     Pesos Normalizados (Dif Imagens, VGG, Sobel, Média Cor): {weights}
     """)
 
-    # Verifica se o diretório de uploads existe, caso contrário, cria
-    if not os.path.exists("uploads"):
-        os.makedirs("uploads")
+    if metrica not in METRICAS:
+        return {"status": "error", "msg": f"Métrica '{metrica}' inválida."}
+    if not (receptora and doadora):
+        return {"status": "error", "msg": "Envie a imagem receptora e a doadora."}
+    if tamanho < 1:
+        return {"status": "error", "msg": "O tamanho do fragmento deve ser positivo."}
+
+    # As imagens ficam só em memória: os limites são verificados aqui, lendo apenas o cabeçalho,
+    # e a decodificação (já reduzida) acontece no worker. A leitura (até MAX_BYTES_UPLOAD cada)
+    # é bloqueante, então fica numa thread, fora do event loop
+    try:
+        dados_r = await asyncio.to_thread(ReadUpload, receptora, MAX_BYTES_UPLOAD)
+        dados_d = await asyncio.to_thread(ReadUpload, doadora, MAX_BYTES_UPLOAD)
+        ImageSize(dados_r, MAX_PIXELS_UPLOAD)
+        ImageSize(dados_d, MAX_PIXELS_UPLOAD)
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except UnidentifiedImageError:
+        raise HTTPException(status_code=400, detail="Arquivo de imagem não reconhecido")
+
+    # O limite de fragmentos muda a resolução da saída, então entra na chave do cache
+    parametros = {
+        "tamanho": tamanho, "yuv": yuv, "metrica": metrica, "pesos": [round(p, 6) for p in weights],
+        "max_fragmentos": MAX_FRAGMENTOS
+    }
+    # O hash das imagens e a leitura da camada em disco bloqueiam, então rodam numa thread
+    chave = await asyncio.to_thread(chave_resultado, dados_r, dados_d, parametros)
+
+    # Mesmo par com os mesmos parâmetros: a tarefa já nasce concluída, sem passar pelo pool
+    png = await asyncio.to_thread(obter_resultado, chave)
+    if png is not None:
+        print(f"Resultado encontrado no cache ({chave[:12]})")
+        tarefa = criar_tarefa(parametros)
+        anexar_resultado(tarefa, TTL_RESULTADO, codificados={("png", FORMATOS_RESULTADO["png"][1]): png})
+        publicar(tarefa, "concluida", 1.0, estado="concluida")
+        return {"status": "ok", "msg": "Resultado em cache", "id": tarefa["id"], "cache": True}
+
+    # Admissão: não há await entre a verificação e o submeter, então nenhuma outra requisição
+    # ocupa a vaga no meio
+    if not pool_ativo():
+        raise HTTPException(status_code=503, detail="Pool de workers indisponível")
+    if fila_cheia():
+        raise HTTPException(status_code=429, detail="Fila de tarefas cheia",
+                            headers={"Retry-After": str(ESPERA_FILA_CHEIA)})
+
+    tarefa = criar_tarefa(parametros)
+    tarefa["chave_resultado"] = chave
+    publicar(tarefa, "na_fila", 0.0)
+    submeter(tarefa, {
+        "receptora": dados_r, "doadora": dados_d, "tamanho": tamanho, "max_pixels": MAX_PIXELS_UPLOAD,
+        "max_fragmentos": MAX_FRAGMENTOS, "weights": weights, "yuv": yuv, "metrica": metrica,
+        "cache_descritores": CACHE_DESCRITORES, "cache_max_mb": CACHE_MAX_MB
+    })
+    return {"status": "ok", "msg": "Tarefa criada", "id": tarefa["id"], "cache": False}
+
+
+def concluir_tarefa(tarefa: dict, img):
+    """
+    Na thread do pool: codifica o PNG padrão, que fica na tarefa (para /jobs/{id}/result) e no
+    cache de resultados. A imagem em si não é guardada; outros formatos são gerados do PNG.
+    """
+    nivel = FORMATOS_RESULTADO["png"][1]
+    png = EncodeImage(img, "PNG", nivel)
+    anexar_resultado(tarefa, TTL_RESULTADO, codificados={("png", nivel): png})
+    guardar_resultado(tarefa["chave_resultado"], png)
+    print("Imagens processadas e salvas.")
+
+
+def codificar_resultado(tarefa: dict, resultado: dict, formato: str, nivel: int) -> bytes:
+    """
+    Codifica o resultado no formato pedido a partir do PNG padrão, decodificado a cada pedido
+    (numa thread, fora do event loop), e guarda a codificação para os próximos pedidos iguais
+    (ver `guardar_codificacao`).
+    """
+    png = resultado["codificados"][("png", FORMATOS_RESULTADO["png"][1])]
+    dados = EncodeImage(FromBytes(png), formato.upper(), nivel)
+    guardar_codificacao(tarefa, (formato, nivel), dados)
+    return dados
+
+
+# ----------- API /jobs -----------
+
+def _tarefa_ou_404(id_tarefa: str) -> dict:
+    tarefa = obter_tarefa(id_tarefa)
+    if tarefa is None:
+        raise HTTPException(status_code=404, detail="Tarefa não encontrada")
+    return tarefa
+
+
+@app.get("/jobs/{id_tarefa}")
+async def status_tarefa(id_tarefa: str):
+    """Estado, etapa atual e fração concluída da tarefa."""
+    return resumo(_tarefa_ou_404(id_tarefa))
+
+
+@app.get("/jobs/{id_tarefa}/eventos")
+async def eventos_tarefa(id_tarefa: str):
+    """
+    Progresso da tarefa como Server-Sent Events: um evento JSON (o mesmo de /jobs/{id}) por etapa,
+    desde a criação, até o estado final. O fluxo também termina se a tarefa sai do registro ou
+    depois de `DURACAO_MAX_EVENTOS` segundos.
+    """
+    _tarefa_ou_404(id_tarefa)
+
+    async def fluxo():
+        enviados = 0
+        limite = time.monotonic() + DURACAO_MAX_EVENTOS
+        while (leitura := ler_eventos(id_tarefa, enviados)) is not None:
+            novos, final = leitura
+            for evento in novos:
+                yield f"data: {json.dumps(evento)}\n\n"
+            enviados += len(novos)
+            # Os eventos lidos junto com o estado final já incluem o último
+            if final or time.monotonic() > limite:
+                break
+            await asyncio.sleep(INTERVALO_EVENTOS)
+
+    return StreamingResponse(fluxo(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/jobs/{id_tarefa}/result")
+async def resultado_tarefa(id_tarefa: str, formato: str = "png", nivel: Optional[int] = None):
+    """
+    Imagem resultante da tarefa, guardada em memória por `TTL_RESULTADO` segundos.
+    :param formato: Uma das chaves de `FORMATOS_RESULTADO`.
+    :param nivel: Compressão do PNG (0-9) ou qualidade do WebP/JPEG (1-100).
+    """
+    tarefa = _tarefa_ou_404(id_tarefa)
+    if formato not in FORMATOS_RESULTADO:
+        raise HTTPException(status_code=400, detail=f"Formato '{formato}' inválido. Use um de {tuple(FORMATOS_RESULTADO)}.")
+    tipo, nivel_padrao, niveis = FORMATOS_RESULTADO[formato]
+    nivel = nivel_padrao if nivel is None else nivel
+    if nivel not in niveis:
+        raise HTTPException(status_code=400, detail=f"Nível {nivel} fora da faixa {niveis.start}-{niveis.stop - 1}.")
+    if tarefa["estado"] != "concluida":
+        raise HTTPException(status_code=409, detail=f"Tarefa ainda não concluída ({tarefa['estado']})")
+
+    resultado = obter_resultado_tarefa(tarefa)
+    if resultado is None:
+        raise HTTPException(status_code=410, detail="Resultado expirado")
+    dados = resultado["codificados"].get((formato, nivel))
+    if dados is None:
+        dados = await asyncio.to_thread(codificar_resultado, tarefa, resultado, formato, nivel)
+    return Response(dados, media_type=tipo, headers={"Cache-Control": f"private, max-age={int(TTL_RESULTADO)}"})
+
 
-    # Salva as imagens recebidas no servidor
-    path_r, path_d = None, None
-    if receptora:
-        path_r = f"uploads/{receptora.filename}"
-        with open(path_r, "wb") as f:
-            shutil.copyfileobj(receptora.file, f)
+@app.post("/jobs/{id_tarefa}/cancelar")
+async def cancelar_tarefa(id_tarefa: str):
+    """
+    Pede o cancelamento. Uma tarefa na fila sai dela; uma em execução para no próximo mini-lote da
+    VGG, bloco de linhas da matriz de custo ou etapa do replace (só a resolução da atribuição em
+    si não é interrompida no meio).
+    """
+    tarefa = _tarefa_ou_404(id_tarefa)
+    ativa = tarefa["estado"] not in ESTADOS_FINAIS
+    if ativa:
+        cancelar(tarefa)
+    return {"cancelada": ativa, **resumo(tarefa)}
 
-    if doadora:
-        path_d = f"uploads/{doadora.filename}"
-        with open(path_d, "wb") as f:
-            shutil.copyfileobj(doadora.file, f)
 
-    if receptora and doadora:
-        print("Processando imagens...")
-        img_1 = LoadImage(path_r)
-        img_2 = LoadImage(path_d)
+# ----------- API /pool -----------
 
-        print("Dividindo imagens em fragmentos...")
-        fragmentos_1 = get_fragmentos(img_1, tamanho)
-        fragmentos_2 = get_fragmentos(img_2, tamanho)
+@app.get("/pool")
+async def pool():
+    """Workers livres e ocupados, tamanho da fila e tempo de aquecimento de cada worker."""
+    return info_pool()
 
-        print("Iniciando a substituição de fragmentos...")
-        replaced_img = replace(fragmentos_1, fragmentos_2, weights=weights, yuv=yuv)
 
-        # Salva a imagem resultante para preview
-        SaveImage(replaced_img, "imgs/preview.png")
-        print("Imagens processadas e salvas.")
+# ----------- API /cache -----------
 
-    return {"status": "ok", "msg": "Imagens e parâmetros recebidos"}
+@app.get("/cache")
+async def cache():
+    """Acertos, faltas e ocupação do cache de resultados."""
+    return estatisticas_cache_resultados()
 
 
-# ----------- API /preview -----------
+# ----------- API /modelos -----------
 
-@app.get("/preview.png")
-async def get_preview():
-    print("Enviando preview...")
-    preview_path = "imgs/preview.png"
-    if os.path.exists(preview_path):
-        return FileResponse(preview_path, media_type="image/png")
-    return {"error": "Preview não encontrado"}
\ No newline at end of file
+@app.get("/modelos")
+async def modelos():
+    """Tempo de carga e memória dos modelos carregados em cada worker do pool, por índice do worker."""
+    return modelos_pool()
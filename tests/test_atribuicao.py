@@ -0,0 +1,158 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import lap
+import numpy as np
+import pytest
+
+from src.Atribuicao import resolver_incremental, resolver_esparso, completar_emparelhamento, candidatos_knn, \
+    _violacoes_duais, _emparelhamento_maximo
+from src.Fragmentos import fragmentos_view
+from src.Replace import replace
+
+
+def custo_lapjv(cost_matrix: np.ndarray) -> float:
+    """Custo ótimo de referência, resolvido do zero com `lap.lapjv` em float64."""
+    custo, _, _ = lap.lapjv(cost_matrix.astype(np.float64))
+    return custo
+
+
+def custo_de(cost_matrix: np.ndarray, col_ind: np.ndarray) -> float:
+    n = cost_matrix.shape[0]
+    assert np.array_equal(np.sort(col_ind), np.arange(n)), "col_ind não é uma permutação"
+    return float(cost_matrix[np.arange(n), col_ind].sum(dtype=np.float64))
+
+
+def matriz_aleatoria(rng: np.random.Generator, n: int) -> np.ndarray:
+    return rng.random((n, n), dtype=np.float32)
+
+
+@pytest.mark.parametrize("semente", range(5))
+def test_incremental_do_zero_bate_com_lapjv(semente):
+    cost_matrix = matriz_aleatoria(np.random.default_rng(semente), 40)
+
+    custo, col_ind, _, _, linhas_reinseridas, _ = resolver_incremental(cost_matrix)
+    assert linhas_reinseridas == 40
+    assert custo == pytest.approx(custo_de(cost_matrix, col_ind))
+    assert custo == pytest.approx(custo_lapjv(cost_matrix), abs=1e-4)
+
+
+@pytest.mark.parametrize("semente", range(5))
+@pytest.mark.parametrize("perturbacao", ("linhas", "colunas", "linhas_e_colunas"))
+def test_incremental_depois_de_perturbar_bate_com_lapjv(semente, perturbacao):
+    rng = np.random.default_rng(semente)
+    n = 50
+    cost_matrix = matriz_aleatoria(rng, n)
+    _, col_ind, u, v, _, _ = resolver_incremental(cost_matrix)
+
+    nova = cost_matrix.copy()
+    if perturbacao in ("linhas", "linhas_e_colunas"):
+        linhas = rng.choice(n, 5, replace=False)
+        nova[linhas] = rng.random((5, n), dtype=np.float32)
+    if perturbacao in ("colunas", "linhas_e_colunas"):
+        colunas = rng.choice(n, 5, replace=False)
+        nova[:, colunas] += rng.normal(scale=0.3, size=5).astype(np.float32)
+
+    custo, novo_col_ind, u, v, linhas_reinseridas, _ = resolver_incremental(nova, u, v, col_ind)
+    assert 0 < linhas_reinseridas < n
+    assert custo == pytest.approx(custo_de(nova, novo_col_ind))
+    assert custo == pytest.approx(custo_lapjv(nova), abs=1e-4)
+    # A solução devolvida é ótima para os próprios potenciais: nada a reparar numa nova chamada
+    assert not _violacoes_duais(nova, u, v, novo_col_ind, 1e-5).any()
+
+
+def test_violacoes_duais_marca_so_as_linhas_alteradas():
+    rng = np.random.default_rng(7)
+    cost_matrix = matriz_aleatoria(rng, 30)
+    _, col_ind, u, v, _, _ = resolver_incremental(cost_matrix)
+    assert not _violacoes_duais(cost_matrix, u, v, col_ind, 1e-5).any()
+
+    # Encarecer a aresta atribuída da linha 3 a torna não justa; baratear uma aresta livre da
+    # linha 11 cria um custo reduzido negativo
+    nova = cost_matrix.copy()
+    nova[3, col_ind[3]] += 1.0
+    livre = (col_ind[11] + 1) % 30
+    nova[11, livre] = u[11] + v[livre] - 1.0
+    assert np.array_equal(np.flatnonzero(_violacoes_duais(nova, u, v, col_ind, 1e-5)), [3, 11])
+
+    sem_coluna = col_ind.copy()
+    sem_coluna[20] = -1
+    assert _violacoes_duais(cost_matrix, u, v, sem_coluna, 1e-5)[20]
+
+
+@pytest.mark.parametrize("semente", range(3))
+def test_esparso_com_grafo_completo_bate_com_lapjv(semente):
+    n = 30
+    # Custos com sinal: `resolver_esparso` desloca para o lapmod, que só aceita não negativos
+    cost_matrix = np.random.default_rng(semente).normal(size=(n, n)).astype(np.float32)
+    linhas, colunas = np.divmod(np.arange(n * n), n)
+
+    custo, col_ind = resolver_esparso(n, linhas, colunas, cost_matrix[linhas, colunas])
+    assert custo == pytest.approx(custo_de(cost_matrix, col_ind), abs=1e-4)
+    assert custo == pytest.approx(custo_lapjv(cost_matrix), abs=1e-4)
+
+
+def test_completar_emparelhamento_nao_muda_grafo_perfeito():
+    n = 20
+    linhas, colunas = np.arange(n), np.random.default_rng(0).permutation(n)
+    descritores = np.random.default_rng(1).random((n, 4))
+
+    linhas_extra, colunas_extra = completar_emparelhamento(linhas, colunas, descritores, descritores, 2)
+    assert linhas_extra.size == 0 and colunas_extra.size == 0
+
+
+@pytest.mark.parametrize("max_rodadas", (0, 4))
+def test_k_pequeno_demais_e_completado_ate_um_emparelhamento_perfeito(max_rodadas):
+    rng = np.random.default_rng(3)
+    n = 40
+    # Todos os alvos ficam perto dos mesmos poucos doadores: com k=1 o grafo de candidatos liga
+    # muitas linhas a poucas colunas e não admite emparelhamento perfeito
+    descritores2 = rng.random((n, 3))
+    descritores1 = descritores2[:4].repeat(n // 4, axis=0) + rng.normal(scale=1e-3, size=(n, 3))
+    vizinhos = candidatos_knn(descritores1, descritores2, 1)
+    linhas, colunas = np.arange(n), vizinhos.ravel()
+    assert (_emparelhamento_maximo(linhas, colunas, n) < 0).any()
+
+    linhas_extra, colunas_extra = completar_emparelhamento(
+        linhas, colunas, descritores1, descritores2, 1, max_rodadas=max_rodadas
+    )
+    assert linhas_extra.size > 0
+    linhas = np.concatenate((linhas, linhas_extra))
+    colunas = np.concatenate((colunas, colunas_extra))
+    assert (_emparelhamento_maximo(linhas, colunas, n) >= 0).all()
+
+    # O problema restrito às arestas tem solução, que usa só arestas do grafo
+    custos = np.linalg.norm(descritores1[linhas] - descritores2[colunas], axis=1)
+    _, col_ind = resolver_esparso(n, linhas, colunas, custos)
+    arestas = set(zip(linhas.tolist(), colunas.tolist()))
+    assert np.array_equal(np.sort(col_ind), np.arange(n))
+    assert all((i, j) in arestas for i, j in enumerate(col_ind.tolist()))
+
+
+@pytest.fixture(scope="module")
+def grids():
+    rng = np.random.default_rng(5)
+    img_1 = rng.integers(0, 256, (48, 48, 3), dtype=np.uint8)
+    img_2 = rng.integers(0, 256, (48, 48, 3), dtype=np.uint8)
+    return fragmentos_view(img_1, 8), fragmentos_view(img_2, 8)
+
+
+def test_replace_esparso_com_k_pequeno_monta_imagem_com_todos_os_doadores(grids):
+    fragmentos_1, fragmentos_2 = grids
+    saida = replace(fragmentos_1, fragmentos_2, weights=(1, 0, 1, 1), atribuicao="esparsa", k_candidatos=1)
+
+    # Cada fragmento doador aparece exatamente uma vez na imagem montada
+    blocos = fragmentos_view(saida, 8).reshape((36, -1))
+    doadores = fragmentos_2.reshape((36, -1))
+    usados = sorted(int(np.flatnonzero((doadores == bloco).all(axis=1))[0]) for bloco in blocos)
+    assert usados == list(range(36))
+
+
+def test_clusters_com_um_grupo_nao_tem_diferenca_para_o_exato(grids):
+    fragmentos_1, fragmentos_2 = grids
+    estado = {}
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        replace(
+            fragmentos_1, fragmentos_2, weights=(1, 0, 1, 1), atribuicao="clusters", n_grupos=1,
+            executor=executor, comparar_exato=True, estado=estado
+        )
+    assert estado["diferenca_exato"] == pytest.approx(0.0, abs=1e-4)
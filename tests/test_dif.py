@@ -0,0 +1,61 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from src.Features.Dif import ESPACOS_COR, amplitude_cor, converter_espaco_cor, comp_imgs_dif, comp_imgs_dif_l2, \
+    matriz_similaridade_l2
+from src.Features.MediaCor import medias_fragmentos, matriz_similaridade_media_cor
+from src.Replace import montar_matriz_custo
+
+# Os 8 vértices do cubo RGB: pretos, brancos e primárias/secundárias saturadas
+CANTOS_RGB = np.array(list(itertools.product((0, 255), repeat=3)), dtype=np.uint8)
+
+
+def fragmentos_extremos(espaco: str) -> np.ndarray:
+    """Um fragmento 4×4 liso de cada vértice do cubo RGB, no espaço de cor pedido."""
+    fragmentos = np.broadcast_to(CANTOS_RGB[:, None, None, :], (len(CANTOS_RGB), 4, 4, 3)).copy()
+    return fragmentos if espaco == "rgb" else converter_espaco_cor(fragmentos, espaco)
+
+
+@pytest.mark.parametrize("espaco", ESPACOS_COR)
+def test_amplitude_cobre_o_cubo_rgb(espaco):
+    valores = np.arange(0, 256, 5, dtype=np.uint8)
+    cubo = np.stack(np.meshgrid(valores, valores, valores, indexing="ij"), axis=-1).reshape((-1, 3))
+    convertido = cubo.astype(np.float32) if espaco == "rgb" else converter_espaco_cor(cubo, espaco)
+    faixa = convertido.max(axis=0) - convertido.min(axis=0)
+    assert np.all(faixa <= amplitude_cor(espaco))
+
+
+@pytest.mark.parametrize("espaco", ESPACOS_COR)
+def test_similaridades_ficam_em_0_1_para_cores_extremas(espaco):
+    fragmentos = fragmentos_extremos(espaco)
+    amplitude = amplitude_cor(espaco)
+    medias = medias_fragmentos(fragmentos)
+
+    blocos = [
+        matriz_similaridade_l2(fragmentos, fragmentos, amplitude),
+        matriz_similaridade_media_cor(medias, medias, amplitude),
+        np.array([[comp_imgs_dif(a, b, amplitude) for b in fragmentos] for a in fragmentos]),
+        np.array([[comp_imgs_dif_l2(a, b, amplitude) for b in fragmentos] for a in fragmentos]),
+    ]
+    for bloco in blocos:
+        assert bloco.min() >= -1e-6
+        assert bloco.max() <= 1 + 1e-6
+        np.testing.assert_allclose(np.diag(bloco), 1.0, atol=1e-6)
+
+
+@pytest.mark.parametrize("espaco", ESPACOS_COR)
+@pytest.mark.parametrize("metrica", ("l1", "l2"))
+def test_custo_de_cor_fica_em_0_1_para_cores_extremas(espaco, metrica):
+    fragmentos = fragmentos_extremos(espaco)
+    n = len(fragmentos)
+    vgg = np.zeros((n, 1), dtype=np.float32)
+    sobel = np.zeros((n, 4, 4, 3), dtype=np.uint8)
+    medias = medias_fragmentos(fragmentos)
+
+    custo = montar_matriz_custo(
+        vgg, vgg, fragmentos, fragmentos, sobel, sobel, medias, medias, (0.5, 0.0, 0.0, 0.5), metrica, espaco
+    )
+    assert custo.min() >= -1e-6
+    assert custo.max() <= 1 + 1e-6
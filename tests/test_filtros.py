@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from src.Features.Edge import SOBEL_X, SOBEL_Y, sobel, sobel_imagem
+from src.Features.Filtros import filtrar, kernel_gaussiano, kernel_caixa, decompor_separavel, gradientes_sobel
+
+rng = np.random.default_rng(0)
+
+# Kernels de lado ímpar (para os quais a origem do scipy coincide com a de `Edge.convolve`)
+KERNELS_SEPARAVEIS = {
+    "gaussiano_5": kernel_gaussiano(1.0, 5),
+    "caixa_3": kernel_caixa(3),
+    "gaussiano_15": kernel_gaussiano(2.5, 15),
+    "retangular_3x7": np.outer([1, 2, 1], [1, -1, 2, 0, -2, 1, -1]).astype(np.float32),
+}
+KERNELS_NAO_SEPARAVEIS = {
+    "aleatorio_3": rng.random((3, 3), dtype=np.float32),
+    "aleatorio_7x5": rng.random((7, 5), dtype=np.float32),
+    "laplaciano_3": np.array([[0, 1, 0], [1, -4, 1], [0, 1, 0]], dtype=np.float32),
+}
+
+
+def referencia(img: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    """Correlação com borda zerada, como `Edge.convolve`: convolução do scipy com o kernel invertido."""
+    invertido = kernel[::-1, ::-1].astype(np.float64)
+    canais = [img] if img.ndim == 2 else [img[:, :, c] for c in range(img.shape[2])]
+    saidas = [ndimage.convolve(canal.astype(np.float64), invertido, mode="constant", cval=0.0) for canal in canais]
+    return saidas[0] if img.ndim == 2 else np.stack(saidas, axis=2)
+
+
+@pytest.fixture(params=[(37, 29), (16, 16, 3)], ids=["um_canal", "tres_canais"])
+def img(request):
+    return np.random.default_rng(1).random(request.param, dtype=np.float32) * 255
+
+
+@pytest.mark.parametrize("nome", KERNELS_SEPARAVEIS)
+@pytest.mark.parametrize("metodo", ("direto", "separavel", "fft", "auto"))
+def test_kernels_separaveis_batem_com_scipy(img, nome, metodo):
+    kernel = KERNELS_SEPARAVEIS[nome]
+    resultado = filtrar(img, kernel, metodo)
+    assert resultado.dtype == np.float32 and resultado.shape == img.shape
+    np.testing.assert_allclose(resultado, referencia(img, kernel), rtol=1e-4, atol=1e-2)
+
+
+@pytest.mark.parametrize("nome", KERNELS_NAO_SEPARAVEIS)
+@pytest.mark.parametrize("metodo", ("direto", "fft", "auto"))
+def test_kernels_nao_separaveis_batem_com_scipy(img, nome, metodo):
+    kernel = KERNELS_NAO_SEPARAVEIS[nome]
+    np.testing.assert_allclose(filtrar(img, kernel, metodo), referencia(img, kernel), rtol=1e-4, atol=1e-2)
+
+
+def test_decomposicao_separavel():
+    for kernel in KERNELS_SEPARAVEIS.values():
+        coluna, linha = decompor_separavel(kernel)
+        np.testing.assert_allclose(np.outer(coluna, linha), kernel, atol=1e-5)
+    for kernel in KERNELS_NAO_SEPARAVEIS.values():
+        assert decompor_separavel(kernel) is None
+
+
+def test_separavel_rejeita_kernel_nao_separavel():
+    with pytest.raises(ValueError):
+        filtrar(np.zeros((8, 8), dtype=np.float32), KERNELS_NAO_SEPARAVEIS["aleatorio_3"], "separavel")
+
+
+def test_gradientes_sobel_usam_os_kernels_de_edge():
+    canal = np.random.default_rng(2).integers(0, 256, (24, 20)).astype(np.float32)
+    gx, gy = gradientes_sobel(canal)
+    np.testing.assert_allclose(gx, referencia(canal, SOBEL_X), atol=1e-3)
+    np.testing.assert_allclose(gy, referencia(canal, SOBEL_Y), atol=1e-3)
+
+    # A magnitude normalizada de `Edge.sobel` sai dos mesmos gradientes
+    img = np.repeat(canal.astype(np.uint8)[:, :, None], 3, axis=2)
+    magnitude = np.hypot(gx, gy)
+    esperado = (magnitude / magnitude.max() * 255).astype(np.uint8)
+    np.testing.assert_allclose(sobel(img)[:, :, 0].astype(int), esperado.astype(int), atol=1)
+
+
+def test_gradientes_sobel_separavel_e_exato_e_usado_por_sobel_imagem():
+    canal = np.random.default_rng(3).integers(0, 256, (31, 26)).astype(np.float32)
+    # Com pixels inteiros todas as somas são exatas: a forma separável bate com a direta bit a bit
+    gx, gy = gradientes_sobel(canal, "separavel")
+    gx_direto, gy_direto = gradientes_sobel(canal, "direto")
+    np.testing.assert_array_equal(gx, gx_direto)
+    np.testing.assert_array_equal(gy, gy_direto)
+
+    img = np.repeat(canal.astype(np.uint8)[:, :, None], 3, axis=2)
+    magnitude = np.hypot(gx, gy)
+    esperado = (magnitude * (255 / magnitude.max())).astype(np.uint8)
+    np.testing.assert_array_equal(sobel_imagem(img)[:, :, 0], esperado)
@@ -0,0 +1,18 @@
+import os
+
+import numpy as np
+
+from src.Features.VGG import ajustar_pca, salvar_pca, carregar_pca, projetar_pca
+
+
+def test_pca_salva_exatamente_no_caminho_pedido(tmp_path):
+    features = np.random.default_rng(0).normal(size=(50, 16)).astype(np.float32)
+    pca = ajustar_pca(features, componentes=4)
+
+    caminho = str(tmp_path / "pca_vgg")
+    salvar_pca(pca, caminho)
+    assert os.path.exists(caminho)
+    assert not os.path.exists(caminho + ".npz")
+
+    carregada = carregar_pca(caminho)
+    np.testing.assert_array_equal(projetar_pca(features, carregada), projetar_pca(features, pca))